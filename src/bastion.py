@@ -5,19 +5,24 @@ Simple HTTP forwarder to run on bastion instance. It forwards traffic to
 the parent of the Nitro enclave.
 """
 import asyncio
-import pprint
 import os
+import time
 
 import click
 import requests
 import uvicorn
 
 from pydantic import BaseModel
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 
-from common.config import PARENT_API_URL, DEFAULT_TIMEOUT, BASTION_HOST, BASTION_PORT
+from common.config import PARENT_API_URL, DEFAULT_TIMEOUT, BASTION_HOST, BASTION_PORT, LOG_LEVEL
+from common.limits import LimitMiddleware
+from common.log import configure_logging, get_logger, StageTimer
+from common.metrics import export_prometheus, observe_stages, PROMETHEUS_CONTENT_TYPE
+
+logger = get_logger('bastion')
 
 class Message(BaseModel):
     """Basic API message
@@ -27,6 +32,8 @@ class Message(BaseModel):
 # Set up the FastAPI app and define the endpoints
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"])
+# Reject the requests that are too large or beyond the concurrency limit before reading them
+app.add_middleware(LimitMiddleware, hop='bastion')
 
 @app.get("/")
 async def root():
@@ -34,12 +41,18 @@ async def root():
     """
     return "Hello from bastion"
 
+@app.get("/metrics", summary="Latency metrics of the bastion", response_class=PlainTextResponse)
+def metrics():
+    """Export the latency histograms of the bastion in the Prometheus text format."""
+    return PlainTextResponse(export_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.post("/post/", summary="Forward message to the next server", response_model=str)
-def forward(message: Message) -> str:
+def forward(message: Message, x_request_id: str = Header('')) -> str:
     """Forward the message received to the 
 
     Args:
         message (Message): Basic API message with string payload.
+        x_request_id (str): Identifier of the request set by the client, if any.
 
     Returns:
         str: Response from the next server
@@ -47,18 +60,32 @@ def forward(message: Message) -> str:
     # Hack
     api_url = os.getenv('API_URL')
 
-    print('Message received:')
-    pprint.PrettyPrinter(indent=4).pprint(message)
+    timer = StageTimer()
+    start = time.perf_counter()
 
     try:
-        print(f'Connecting to {api_url}. Sending: {message.dict()}')
-        response = requests.post(api_url, json=message.dict(), timeout=DEFAULT_TIMEOUT)
+        logger.debug('Forwarding request', to=api_url, request_id=x_request_id,
+                     size=len(message.payload))
+        with timer.stage('forward'):
+            response = requests.post(api_url, json=message.dict(), timeout=DEFAULT_TIMEOUT,
+                                     headers={'X-Request-ID': x_request_id})
+        if response.status_code in (413, 503):
+            # Pass the rejections of the parent on to the client
+            logger.warning('Request rejected by the parent', request_id=x_request_id,
+                           status=response.status_code)
+            headers = {'Retry-After': response.headers['Retry-After']} \
+                if 'Retry-After' in response.headers else None
+            return JSONResponse(status_code=response.status_code, content=response.json(),
+                                headers=headers)
         response.raise_for_status()
     except requests.exceptions.RequestException as error:
+        logger.error('Forwarding failed', to=api_url, request_id=x_request_id, reason=error)
         return JSONResponse(status_code=500, content={'reason': str(error)})
 
-    print('Response received:')
-    pprint.PrettyPrinter(indent=4).pprint(response)
+    timer.timings['total'] = time.perf_counter() - start
+    observe_stages('bastion', timer)
+    logger.debug('Request forwarded', status=response.status_code, request_id=x_request_id,
+                 size=len(response.content), **timer.fields())
 
     return response.json()
 
@@ -66,17 +93,23 @@ def forward(message: Message) -> str:
 @click.command()
 @click.option('--api', type=str, default=PARENT_API_URL,
               help='API URL of bastion server.')
-def bastion(api: str):
+@click.option('--log-level', type=str, default=LOG_LEVEL,
+              help=f'Log level. Per-request records are logged at DEBUG. Default is {LOG_LEVEL}.')
+def bastion(api: str, log_level: str):
     """Launch bastion API server after updating global parameter
 
     Args:
         api (str): API URL of next server (i.e., parent server)
+        log_level (str): Minimum level of the log records to print.
     """
+    configure_logging(log_level)
+
     # Hack to pass argument to routing function
     os.environ['API_URL'] = api
 
     # Launch server
-    config = uvicorn.Config("bastion:app", port=BASTION_PORT, host=BASTION_HOST, log_level="debug")
+    config = uvicorn.Config("bastion:app", port=BASTION_PORT, host=BASTION_HOST,
+                            log_level=log_level.lower())
     server = uvicorn.Server(config)
     asyncio.run(server.serve())
 
@@ -0,0 +1,188 @@
+"""
+AWS Nitro Test
+
+Peak memory allocated by the enclave server to handle one request, measured with
+tracemalloc. Each request is received by the Dispatcher of the server on one end of a
+socket pair, as for an accepted connection, while a thread sends the frame and reads
+the response on the other end. It reports the peak allocation per request and its
+ratio to the size of the CBOR payload before compression, for message requests of
+several sizes and process requests of several batch sizes. It exits with an error if
+a peak exceeds --max-peak-per-byte times the payload size plus --max-overhead.
+
+Run from the src directory:
+    python -m benchmark.allocations --message-size 10000,1000000 --batch-size 1,64
+"""
+import importlib.util
+import os
+import socket
+import sys
+import threading
+import tracemalloc
+
+import cbor2
+import click
+
+from Crypto.Cipher import AES
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+from benchmark.corpus import generate_corpus, LANGUAGE_MODELS
+from benchmark.report import summarize, save_results, compare_results
+from common.compression import compress
+from common.config import COMPRESSION_CODECS, RSA_PRIVATE_KEY
+from common.encryption import encrypt
+from common.messages import send_frame, recv_exact, FRAME_HEADER
+from server.ner_api import MODEL_NAMES
+from server.nsmutil import NSMUtil
+from server.scheduler import ModelPools
+
+
+def load_enclave_server():
+    """Import server.py, whose name is shadowed by the server package"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+    spec = importlib.util.spec_from_file_location('enclave_server', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+enclave_server = load_enclave_server()
+
+
+def encrypted_request(public_key: bytes, action: str, parameter: any,
+                      compression: tuple) -> tuple:
+    """Build the envelope and the ciphertext of an encrypted request, as
+    send_encrypted_message does"""
+    aes_key = get_random_bytes(32)
+    parameter_cbor = cbor2.dumps(parameter)
+    data_cbor, codec = compress(parameter_cbor, compression)
+    cipher = AES.new(aes_key, AES.MODE_EAX)
+    cipher.update(codec.encode())
+    ciphertext, tag = cipher.encrypt_and_digest(data_cbor)
+    envelope = {
+        'action': action,
+        'parameter': {
+            'encrypted_key': encrypt(public_key, aes_key),
+            'nonce': cipher.nonce,
+            'tag': tag,
+            'codec': codec,
+            'accept': list(compression)
+        },
+        'request_id': ''
+    }
+    return envelope, ciphertext, len(parameter_cbor)
+
+
+def peer(soc: socket.socket, envelope: dict, ciphertext: bytes, buffer: bytearray,
+         start: threading.Event):
+    """Send a request and receive the response into a preallocated buffer"""
+    header = bytearray(FRAME_HEADER.size)
+    start.wait()
+    send_frame(soc, envelope, ciphertext)
+    recv_exact(soc, memoryview(header))
+    size = sum(FRAME_HEADER.unpack(header))
+    recv_exact(soc, memoryview(buffer)[:size])
+
+
+def measure(dispatcher: 'enclave_server.Dispatcher', envelope: dict, ciphertext: bytes) -> int:
+    """Handle one request and return the peak memory traced until its response is
+    received. Process requests run on the workers of the scheduler, which are traced
+    as well."""
+    server_socket, client_socket = socket.socketpair()
+    # Large enough for the responses, which are at most a bit larger than the requests
+    buffer = bytearray(2 * len(ciphertext) + (1 << 20))
+    start = threading.Event()
+    thread = threading.Thread(target=peer, args=(client_socket, envelope, ciphertext, buffer,
+                                                 start))
+    thread.start()
+    tracemalloc.start()
+    try:
+        start.set()
+        # Run on this thread the task that Dispatcher.dispatch submits for a connection
+        dispatcher._receive(server_socket, ('allocations', 0))  # pylint: disable=protected-access
+        thread.join()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        server_socket.close()
+        client_socket.close()
+    return peak
+
+
+def run(dispatcher: 'enclave_server.Dispatcher', public_key: bytes, action: str,
+        parameter: any, compression: tuple, repeats: int) -> dict:
+    """Measure the peak allocation of repeated requests"""
+    samples = []
+    for _ in range(repeats + 1):
+        envelope, ciphertext, size = encrypted_request(public_key, action, parameter,
+                                                       compression)
+        samples.append(measure(dispatcher, envelope, ciphertext))
+    # The first request may grow the receive buffer and start threads
+    stats = summarize(samples[1:])
+    return {'payload_size': size, 'peak_bytes': stats,
+            'peak_per_payload_byte': stats['p50'] / max(size, 1)}
+
+
+@click.command()
+@click.option('--message-size', type=str, default='10000,100000,1000000',
+              help='Comma separated sizes of the message requests. Default is 10000,100000,1000000.')
+@click.option('--batch-size', type=str, default='1,16,64',
+              help='Comma separated numbers of texts of the process requests. Default is 1,16,64.')
+@click.option('--repeats', type=int, default=5,
+              help='Number of measured requests of each kind. Default is 5.')
+@click.option('--max-peak-per-byte', type=float, default=7.0,
+              help='Maximum peak allocation per byte of payload. Default is 7.')
+@click.option('--max-peak-per-text', type=int, default=2 << 20,
+              help='Maximum peak allocation per text of a process request, for the '
+              'inference. Default is 2 MiB.')
+@click.option('--max-overhead', type=int, default=256 << 10,
+              help='Peak allocation allowed on top of the above. Default is 256 KiB.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(message_size: str, batch_size: str, repeats: int, max_peak_per_byte: float,
+         max_peak_per_text: int, max_overhead: int, output: str, compare: str):
+    """Run the allocation benchmark of the enclave request path"""
+    # Without rebalancing, which would start a thread of its own
+    pools = ModelPools(MODEL_NAMES, interval=0)
+    dispatcher = enclave_server.Dispatcher(NSMUtil(True), False, pools)
+    public_key = RSA.import_key(RSA_PRIVATE_KEY).publickey().export_key('DER')
+
+    results = {}
+    for compression, name in ((COMPRESSION_CODECS, 'compressed'), ((), 'raw')):
+        for size in (int(value) for value in message_size.split(',')):
+            key = f'message_{size}_{name}'
+            results[key] = run(dispatcher, public_key, 'message', 'x' * size, compression,
+                               repeats)
+            results[key]['texts'] = 0
+        for count in (int(value) for value in batch_size.split(',')):
+            texts = [text['content'] for text in generate_corpus(count, ('nl',))]
+            parameter = {'texts': [{'content': text} for text in texts],
+                         'model': LANGUAGE_MODELS['nl'], 'output': 'compact', 'echo_text': False}
+            key = f'process_{count}_{name}'
+            results[key] = run(dispatcher, public_key, 'process', parameter, compression,
+                               repeats)
+            results[key]['texts'] = count
+    failed = []
+    for key, stats in results.items():
+        stats['max_peak_bytes'] = (max_peak_per_byte * stats['payload_size']
+                                   + max_peak_per_text * stats['texts'] + max_overhead)
+        print(f'{key}: payload={stats["payload_size"]} bytes '
+              f'peak={stats["peak_bytes"]["p50"] / 1e3:.1f} kB '
+              f'({stats["peak_per_payload_byte"]:.2f} per payload byte, '
+              f'limit {stats["max_peak_bytes"] / 1e3:.1f} kB)')
+        if stats['peak_bytes']['max'] > stats['max_peak_bytes']:
+            failed.append(key)
+
+    path = save_results('allocations', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+    if failed:
+        print(f'Peak allocation above the limit: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,120 @@
+"""
+AWS Nitro Test
+
+Benchmark of the token-budget batching of run_pipeline (server/ner_api.py) on skewed
+length distributions: many short texts mixed with a few long documents, in random
+order. For each token budget it measures the throughput of nlp.pipe, the time at
+which the short texts are done and the peak memory allocated (tracemalloc). A budget
+of 0 gives all the texts to nlp.pipe at once, in their order.
+
+Run from the src directory:
+    python -m benchmark.batching --short 500 --long 5 --long-characters 40000
+"""
+import random
+import time
+import tracemalloc
+
+from typing import List
+
+import click
+
+from benchmark.corpus import generate_text, LANGUAGE_MODELS
+from benchmark.report import summarize, save_results, compare_results
+from server import ner_api
+
+
+def skewed_texts(lang: str, short: int, long: int, long_characters: int,
+                 seed: int) -> List[str]:
+    """Generate short texts of one to three sentences and long documents of about
+    long_characters characters, shuffled."""
+    rng = random.Random(seed)
+    texts = [generate_text(rng, lang, rng.randint(1, 3)) for _ in range(short)]
+    for _ in range(long):
+        lines = []
+        while sum(len(line) + 1 for line in lines) < long_characters:
+            lines.append(generate_text(rng, lang, 12))
+        texts.append('\n'.join(lines)[:long_characters])
+    rng.shuffle(texts)
+    return texts
+
+
+def run_batches(nlp, texts: List[str], budget: int) -> List[float]:
+    """Process texts as run_pipeline does and return the time at which each one is done"""
+    done = [0.0] * len(texts)
+    start = time.perf_counter()
+    for batch in ner_api.token_batches(texts, budget):
+        for index, _ in zip(batch, nlp.pipe((texts[index] for index in batch),
+                                            batch_size=len(batch))):
+            done[index] = time.perf_counter() - start
+    return done
+
+
+def measure(nlp, texts: List[str], budget: int, short_characters: int, repeats: int) -> dict:
+    """Measure the throughput, completion times and peak memory for a budget"""
+    best = None
+    for _ in range(repeats):
+        done = run_batches(nlp, texts, budget)
+        if best is None or max(done) < max(best):
+            best = done
+    short = sorted(seconds for text, seconds in zip(texts, best)
+                   if len(text) <= short_characters)
+    tracemalloc.start()
+    run_batches(nlp, texts, budget)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': max(best),
+        'docs_per_second': len(texts) / max(best),
+        'batches': len(ner_api.token_batches(texts, budget)),
+        'short_done': summarize(short),
+        'peak_mib': peak / 2 ** 20
+    }
+
+
+@click.command()
+@click.option('--short', type=int, default=500,
+              help='Number of short texts per language. Default is 500.')
+@click.option('--long', type=int, default=5,
+              help='Number of long documents per language. Default is 5.')
+@click.option('--long-characters', type=int, default=40000,
+              help='Characters of each long document. Default is 40000.')
+@click.option('--budget', type=str, default='0,2000,10000,50000',
+              help='Comma separated token budgets, 0 for a single batch. '
+              'Default is 0,2000,10000,50000.')
+@click.option('--seed', type=int, default=0, help='Seed of the texts. Default is 0.')
+@click.option('--repeats', type=int, default=3,
+              help='Number of repetitions of each measurement. Default is 3.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(short: int, long: int, long_characters: int, budget: str, seed: int, repeats: int,
+         output: str, compare: str):
+    """Run the nlp.pipe batching benchmark"""
+    budgets = [int(value) for value in budget.split(',')]
+    results = {'short': short, 'long': long, 'long_characters': long_characters, 'models': {}}
+    for lang, name in sorted(LANGUAGE_MODELS.items()):
+        nlp = ner_api.MODELS[name]
+        texts = skewed_texts(lang, short, long, long_characters, seed)
+        # Short texts have at most 3 sentences
+        short_characters = max(sorted(map(len, texts))[:short])
+        print(f'{name}: {short} short texts, {long} texts of {long_characters} characters')
+
+        model_results = {}
+        for token_budget in budgets:
+            stats = measure(nlp, texts, token_budget, short_characters, repeats)
+            model_results[f'budget{token_budget}'] = stats
+            print(f'    budget={token_budget}: {stats["docs_per_second"]:.1f} docs/s in '
+                  f'{stats["batches"]} batches, short texts done p50='
+                  f'{stats["short_done"]["p50"]:.3f}s p95={stats["short_done"]["p95"]:.3f}s, '
+                  f'peak {stats["peak_mib"]:.1f} MiB')
+        results['models'][name] = model_results
+
+    path = save_results('batching', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
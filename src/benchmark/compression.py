@@ -0,0 +1,115 @@
+"""
+AWS Nitro Test
+
+Compression ratio and throughput of the payload codecs of common/compression.py on
+the sample texts of common/config.py. It measures the CBOR request of a process
+action for each sample and for batches of copies of them, and a response carrying the
+displaCy page of each text. Batches of copies overstate the compression ratio, so the
+same payloads are also measured on a synthetic corpus of distinct texts.
+
+Run from the src directory:
+    python -m benchmark.compression --repeat-texts 1,16,128
+"""
+import json
+import time
+
+import cbor2
+import click
+
+from spacy import displacy
+
+from benchmark.corpus import generate_corpus
+from benchmark.report import save_results, compare_results
+from common.compression import CODECS
+from common.config import CONTENT_1, CONTENT_2, CONTENT_3
+
+SAMPLES = {'content_1': CONTENT_1, 'content_2': CONTENT_2, 'content_3': CONTENT_3}
+
+
+def request_payload(texts: list) -> bytes:
+    """CBOR encoded parameter of a process request, as sent by the client"""
+    return cbor2.dumps(json.dumps({'texts': [{'content': text} for text in texts]}))
+
+
+def response_payload(texts: list) -> bytes:
+    """CBOR encoded process response with the displaCy page of each text"""
+    result = [{
+        'text': text,
+        'entities': [],
+        'html': displacy.render({'text': text, 'ents': [], 'title': None}, style='ent',
+                                manual=True, page=True)
+    } for text in texts]
+    return cbor2.dumps(json.dumps({'result': result}))
+
+
+def time_codec(codec: str, data: bytes, min_time: float) -> dict:
+    """Measure the compression ratio and throughput of a codec on some data"""
+    compress, decompress_bounded = CODECS[codec]
+    compressed = compress(data)
+
+    def decompress(compressed: bytes) -> bytes:
+        return decompress_bounded(compressed, len(data))
+
+    assert decompress(compressed) == data
+
+    rates = {}
+    for name, function, argument in (('compress', compress, data),
+                                     ('decompress', decompress, compressed)):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function(argument)
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        rates[f'{name}_mb_per_second'] = len(data) * calls / elapsed / 1e6
+        rates[f'{name}_us'] = elapsed / calls * 1e6
+    return {'size': len(data), 'compressed_size': len(compressed),
+            'ratio': len(data) / len(compressed), **rates}
+
+
+@click.command()
+@click.option('--repeat-texts', type=str, default='1,16,128',
+              help='Comma separated number of copies of the samples in the batch payloads. '
+              'Default is 1,16,128.')
+@click.option('--synthetic', type=int, default=128,
+              help='Number of texts of the synthetic batch payloads, 0 to skip them. '
+              'Default is 128.')
+@click.option('--min-time', type=float, default=0.2,
+              help='Minimum duration in seconds of each throughput measurement. Default is 0.2.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(repeat_texts: str, synthetic: int, min_time: float, output: str, compare: str):
+    """Run the payload compression benchmark"""
+    payloads = {f'request_{name}': request_payload([text]) for name, text in SAMPLES.items()}
+    for repeat in (int(value) for value in repeat_texts.split(',')):
+        texts = list(SAMPLES.values()) * repeat
+        payloads[f'request_batch_{len(texts)}'] = request_payload(texts)
+        payloads[f'response_batch_{len(texts)}'] = response_payload(texts)
+    if synthetic:
+        texts = [text['content'] for text in generate_corpus(synthetic)]
+        payloads[f'request_synthetic_{synthetic}'] = request_payload(texts)
+        payloads[f'response_synthetic_{synthetic}'] = response_payload(texts)
+
+    results = {'codecs': list(CODECS), 'payloads': {}}
+    for payload, data in payloads.items():
+        results['payloads'][payload] = {}
+        print(f'{payload}: {len(data)} bytes')
+        for codec in CODECS:
+            stats = time_codec(codec, data, min_time)
+            results['payloads'][payload][codec] = stats
+            print(f'    {codec:5s} ratio={stats["ratio"]:.2f} '
+                  f'compress={stats["compress_mb_per_second"]:.0f} MB/s '
+                  f'decompress={stats["decompress_mb_per_second"]:.0f} MB/s')
+
+    path = save_results('compression', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,226 @@
+"""
+AWS Nitro Test
+
+Corpora of Dutch and French texts used by the benchmarks and a generator of
+synthetic but realistic legal texts with names, companies, addresses and
+enterprise (KBO/BCE) and social security (NISS/INSZ) numbers.
+
+Write a synthetic corpus to a JSONL file:
+    python -m benchmark.corpus --size 1000 --output corpus.jsonl
+"""
+import json
+import random
+
+from typing import Dict, List
+
+import click
+
+from common.config import CONTENT_1, CONTENT_2, CONTENT_3
+
+# NER model used for each language
+LANGUAGE_MODELS = {'nl': 'socsec_ner_nl', 'fr': 'socsec_ner_fr'}
+
+# cSpell:disable #
+FIRST_NAMES = ['Koen', 'Archie', 'Charlotte', 'Marie', 'Jan', 'Sofie', 'Luc', 'Nathalie',
+               'Pieter', 'Isabelle', 'Mohamed', 'Els', 'Thomas', 'Camille', 'Wim', 'Julie']
+LAST_NAMES = ['DESMARET', 'PASQUALE', 'DUPUIS', 'Peeters', 'Janssens', 'Maes', 'Dubois',
+              'Lambert', 'Claes', 'Martin', 'Goossens', 'Wouters', 'Lejeune', 'Van Damme']
+COMPANIES = ['HELLO', 'P&G', 'Bouwwerken Vermeulen', 'Transports Leroy', 'Delta Consult',
+             'Immo Schelde', 'Boulangerie Renard', 'Garage Verhaegen', 'Solaris Energy']
+CITIES = [('1000', 'BRUSSEL', 'BRUXELLES'), ('2000', 'ANTWERPEN', 'ANVERS'),
+          ('3000', 'LEUVEN', 'LOUVAIN'), ('3500', 'HASSELT', 'HASSELT'),
+          ('4000', 'LUIK', 'LIÈGE'), ('5000', 'NAMEN', 'NAMUR'), ('9000', 'GENT', 'GAND'),
+          ('1300', 'WAVER', 'WAVRE'), ('8000', 'BRUGGE', 'BRUGES'), ('7000', 'BERGEN', 'MONS')]
+STREETS = {'nl': ['Koning Boudewijnlaan', 'Kerkstraat', 'Stationsstraat', 'Molenweg', 'Dorpsplein'],
+           'fr': ['rue de la Clairière', 'chemin de la Terre', 'avenue Louise', 'place du Marché',
+                  'rue de la Station']}
+TITLES = {'nl': ['Meester', 'mevrouw', 'de heer', 'dhr.', 'Dr.'],
+          'fr': ['Maître', 'Madame', 'Monsieur', 'M.', 'Me']}
+LEGAL_FORMS = {'nl': ['BVBA', 'NV', 'VZW', 'BV', 'CommV'], 'fr': ['SPRL', 'SA', 'ASBL', 'SRL', 'SCS']}
+MONTHS = {'nl': ['januari', 'februari', 'maart', 'april', 'mei', 'juni', 'juli', 'augustus',
+                 'september', 'oktober', 'november', 'december'],
+          'fr': ['janvier', 'février', 'mars', 'avril', 'mai', 'juin', 'juillet', 'août',
+                 'septembre', 'octobre', 'novembre', 'décembre']}
+TEMPLATES = {
+    'nl': [
+        'De vennootschap {company} {legal_form}, ingeschreven onder ondernemingsnummer {kbo}, '
+        'is gevestigd te {street} {number}, {zip} {city_nl}.',
+        '{title} {first} {last}, rijksregisternummer {niss}, woont te {zip} {city_nl}.',
+        'Dit doet inderdaad vermoeden dat de vennootschap {company} {legal_form} werd gebruikt '
+        'om kosten door te sluizen, aldus {title} {first} {last}.',
+        'HASSELT, {day} {month} {year}',
+        'Tel.: 0{phone} - e-mail: {email_user}@{email_domain}.be - {url}',
+        'Gelet op het verzoekschrift neergelegd ter griffie op {day} {month} {year}.',
+        'De rechtbank verklaart de vordering ontvankelijk maar ongegrond.',
+        'Het beroep wordt afgewezen en de kosten worden ten laste gelegd van de eisende partij.',
+    ],
+    'fr': [
+        'La {legal_form} {company}, inscrite à la B.C.E. sous le numéro : BCE {kbo}, dont le '
+        'siège social est situé {street} {number} à {zip} {city_fr}.',
+        'Comparaissant par {title} {first} {last}, avocat, à {zip} {city_fr}, NISS {niss}.',
+        '{title} {last} {first}, domicilié {street} {number}, {zip} {city_fr}.',
+        'Fait à {city_fr}, le {day} {month} {year}.',
+        'Tél. : 0{phone} - courriel : {email_user}@{email_domain}.be - {url}',
+        'Vu la requête déposée au greffe le {day} {month} {year}.',
+        'Le tribunal déclare la demande recevable mais non fondée.',
+        'Les dépens sont mis à charge de la partie demanderesse.',
+    ]
+}
+# cSpell:enable #
+
+
+def kbo_number(rng: random.Random, valid: bool = True) -> str:
+    """Generate a Belgian enterprise number (KBO/BCE), e.g., 0206.731.645.
+
+    Args:
+        rng (random.Random): Random number generator.
+        valid (bool, optional): If False, the check digits are wrong. Defaults to True.
+
+    Returns:
+        str: Formatted enterprise number.
+    """
+    base = rng.randrange(2000000, 19999999)
+    check = 97 - base % 97
+    if not valid:
+        check = (check % 97) + 1
+    digits = f'{base:08d}{check:02d}'
+    return f'{digits[:4]}.{digits[4:7]}.{digits[7:]}'
+
+
+def niss_number(rng: random.Random, valid: bool = True) -> str:
+    """Generate a Belgian national number (NISS/INSZ), e.g., 85.07.30-033.28.
+    Persons born after 2000 use the alternative checksum.
+
+    Args:
+        rng (random.Random): Random number generator.
+        valid (bool, optional): If False, the check digits are wrong. Defaults to True.
+
+    Returns:
+        str: Formatted national number.
+    """
+    year = rng.randrange(1940, 2020)
+    base = f'{year % 100:02d}{rng.randrange(1, 13):02d}{rng.randrange(1, 29):02d}' \
+           f'{rng.randrange(1, 999):03d}'
+    check = 97 - int(('2' if year >= 2000 else '') + base) % 97
+    if not valid:
+        check = (check % 97) + 1
+    return f'{base[0:2]}.{base[2:4]}.{base[4:6]}-{base[6:9]}.{check:02d}'
+
+
+def generate_text(rng: random.Random, lang: str, sentences: int,
+                  invalid_rate: float = 0.1) -> str:
+    """Generate a synthetic legal text.
+
+    Args:
+        rng (random.Random): Random number generator.
+        lang (str): Language of the text ('nl' or 'fr').
+        sentences (int): Number of sentences of the text.
+        invalid_rate (float, optional): Fraction of KBO and NISS numbers with wrong
+            check digits. Defaults to 0.1.
+
+    Returns:
+        str: Generated text.
+    """
+    lines = []
+    for _ in range(sentences):
+        zip_code, city_nl, city_fr = rng.choice(CITIES)
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        lines.append(rng.choice(TEMPLATES[lang]).format(
+            company=rng.choice(COMPANIES), legal_form=rng.choice(LEGAL_FORMS[lang]),
+            kbo=kbo_number(rng, rng.random() >= invalid_rate),
+            niss=niss_number(rng, rng.random() >= invalid_rate),
+            title=rng.choice(TITLES[lang]), first=first, last=last,
+            street=rng.choice(STREETS[lang]), number=rng.randrange(1, 250),
+            zip=zip_code, city_nl=city_nl, city_fr=city_fr,
+            day=rng.randrange(1, 29), month=rng.choice(MONTHS[lang]), year=rng.randrange(1990, 2024),
+            phone=f'{rng.randrange(10, 99)}/{rng.randrange(100, 999)}.{rng.randrange(100, 999)}',
+            email_user=f'{first}.{last}'.lower().replace(' ', ''),
+            email_domain=rng.choice(COMPANIES).lower().replace(' ', '').replace('&', ''),
+            url=f'www.{rng.choice(COMPANIES).lower().replace(" ", "-").replace("&", "")}.be'))
+    return '\n'.join(lines)
+
+
+def generate_corpus(size: int, languages: tuple = ('nl', 'fr'), seed: int = 0,
+                    min_sentences: int = 1, max_sentences: int = 12) -> List[Dict[str, str]]:
+    """Generate a synthetic corpus. The number of sentences of each text follows a
+    log-uniform distribution so that short texts are more frequent than long ones.
+
+    Args:
+        size (int): Number of texts.
+        languages (tuple, optional): Languages of the texts. Defaults to ('nl', 'fr').
+        seed (int, optional): Seed of the random number generator. Defaults to 0.
+        min_sentences (int, optional): Minimum number of sentences per text. Defaults to 1.
+        max_sentences (int, optional): Maximum number of sentences per text. Defaults to 12.
+
+    Returns:
+        List[Dict[str, str]]: Texts with their language.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(size):
+        lang = languages[index % len(languages)]
+        sentences = int(round(min_sentences * (max_sentences / min_sentences) ** rng.random()))
+        corpus.append({'lang': lang, 'content': generate_text(rng, lang, sentences)})
+    return corpus
+
+
+def load_corpus(path: str = '') -> List[Dict[str, str]]:
+    """Load a corpus of texts.
+
+    Args:
+        path (str, optional): JSONL file with one {"lang": "nl"|"fr", "content": "..."}
+            object per line. Defaults to '', in which case the sample contents of the
+            configuration are used.
+
+    Returns:
+        List[Dict[str, str]]: Texts with their language.
+    """
+    if not path:
+        return [{'lang': 'nl', 'content': CONTENT_1},
+                {'lang': 'nl', 'content': CONTENT_2},
+                {'lang': 'fr', 'content': CONTENT_3}]
+
+    corpus = []
+    with open(path, mode='r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                corpus.append({'lang': record['lang'], 'content': record['content']})
+    return corpus
+
+
+def by_language(corpus: List[Dict[str, str]]) -> Dict[str, List[str]]:
+    """Group the contents of a corpus by language.
+
+    Args:
+        corpus (List[Dict[str, str]]): Texts with their language.
+
+    Returns:
+        Dict[str, List[str]]: Contents per language.
+    """
+    groups = {}
+    for record in corpus:
+        groups.setdefault(record['lang'], []).append(record['content'])
+    return groups
+
+
+@click.command()
+@click.option('--size', type=int, default=1000, help='Number of texts. Default is 1000.')
+@click.option('--languages', type=str, default='nl,fr',
+              help='Comma separated languages of the texts. Default is nl,fr.')
+@click.option('--max-sentences', type=int, default=12,
+              help='Maximum number of sentences per text. Default is 12.')
+@click.option('--seed', type=int, default=0, help='Random seed. Default is 0.')
+@click.option('--output', type=str, required=True, help='JSONL file to write.')
+def main(size: int, languages: str, max_sentences: int, seed: int, output: str):
+    """Write a synthetic corpus to a JSONL file"""
+    corpus = generate_corpus(size, tuple(languages.split(',')), seed,
+                             max_sentences=max_sentences)
+    with open(output, mode='w', encoding='utf-8') as file:
+        for record in corpus:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f'Wrote {len(corpus)} texts to {output}')
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
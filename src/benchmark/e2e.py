@@ -0,0 +1,359 @@
+"""
+AWS Nitro Test
+
+End-to-end benchmark. Starts the server (simulating a Nitro enclave), the parent,
+the bastion and the client on the loopback interface, replays a corpus of Dutch and
+French texts through the client API at several concurrency levels and batch sizes and
+reports throughput, latency percentiles per hop, CPU time and RSS of each application.
+
+Run from the src directory:
+    python -m benchmark.e2e --concurrency 1,4 --batch-size 1,16 --requests 50
+"""
+import itertools
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import click
+import requests
+
+from benchmark.corpus import load_corpus, by_language, LANGUAGE_MODELS
+from benchmark.report import summarize, save_results, compare_results
+from common.config import BASTION_PORT, CLIENT_PORT, ENCLAVE_HOST, PARENT_PORT, DEFAULT_TIMEOUT, \
+    SIMULATION_PORT
+from common.messages import send_request_to_enclave
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCALHOST = '127.0.0.1'
+PARENT_URL = f'http://{LOCALHOST}:{PARENT_PORT}'
+BASTION_URL = f'http://{LOCALHOST}:{BASTION_PORT}'
+CLIENT_URL = f'http://{LOCALHOST}:{CLIENT_PORT}'
+
+_SAMPLE_RE = re.compile(r'^(\w+)_bucket\{(.*)\} (\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+class ProcessMonitor(threading.Thread):
+    """Sample the CPU time and resident set size of processes from /proc"""
+    def __init__(self, pids: Dict[str, int], interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._rss = {name: [] for name in pids}
+        self._cpu_start = {}
+        self._cpu_end = {}
+        self._start = self._end = 0.0
+
+    @staticmethod
+    def cpu_seconds(pid: int) -> float:
+        """Get the user and system CPU time consumed by a process"""
+        with open(f'/proc/{pid}/stat', mode='r', encoding='ascii') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    @staticmethod
+    def rss_bytes(pid: int) -> int:
+        """Get the resident set size of a process"""
+        with open(f'/proc/{pid}/statm', mode='r', encoding='ascii') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def run(self):
+        self._start = time.perf_counter()
+        self._cpu_start = {name: self.cpu_seconds(pid) for name, pid in self.pids.items()}
+        while not self._stop_event.wait(self.interval):
+            for name, pid in self.pids.items():
+                self._rss[name].append(self.rss_bytes(pid))
+        self._cpu_end = {name: self.cpu_seconds(pid) for name, pid in self.pids.items()}
+        self._end = time.perf_counter()
+
+    def stop(self) -> Dict[str, dict]:
+        """Stop sampling and return the CPU usage and RSS of each process"""
+        self._stop_event.set()
+        self.join()
+        elapsed = self._end - self._start
+        usage = {}
+        for name in self.pids:
+            cpu = self._cpu_end[name] - self._cpu_start[name]
+            rss = self._rss[name] or [self.rss_bytes(self.pids[name])]
+            usage[name] = {
+                'cpu_seconds': cpu,
+                'cpu_percent': 100 * cpu / elapsed if elapsed else math.nan,
+                'rss_peak_mb': max(rss) / 2**20,
+                'rss_mean_mb': sum(rss) / len(rss) / 2**20
+            }
+        return usage
+
+
+def parse_histograms(exposition: str) -> Dict[Tuple, Dict[float, float]]:
+    """Parse the buckets of the histograms of a Prometheus text exposition.
+
+    Args:
+        exposition (str): Metrics in the Prometheus text format.
+
+    Returns:
+        Dict[Tuple, Dict[float, float]]: Cumulative count per bucket upper bound, for each
+            metric name and label set (without the 'le' label).
+    """
+    histograms = {}
+    for line in exposition.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if not match:
+            continue
+        labels = dict(_LABEL_RE.findall(match.group(2)))
+        bound = float(labels.pop('le'))
+        key = (match.group(1), tuple(sorted(labels.items())))
+        histograms.setdefault(key, {})[bound] = float(match.group(3))
+    return histograms
+
+
+def histogram_quantile(fraction: float, buckets: Dict[float, float]) -> float:
+    """Estimate a quantile from cumulative histogram buckets, like Prometheus does.
+
+    Args:
+        fraction (float): Quantile as a fraction between 0 and 1.
+        buckets (Dict[float, float]): Cumulative count per bucket upper bound.
+
+    Returns:
+        float: Estimated quantile, NaN if the histogram is empty.
+    """
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if total <= 0:
+        return math.nan
+    rank = fraction * total
+    lower_bound, lower_count = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if math.isinf(bound):
+                # Quantile in the +Inf bucket: return the highest finite bound
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def scrape(url: str) -> Dict[Tuple, Dict[float, float]]:
+    """Scrape and parse the histograms exposed by an application"""
+    response = requests.get(f'{url}/metrics', timeout=DEFAULT_TIMEOUT)
+    response.raise_for_status()
+    return parse_histograms(response.text)
+
+
+def hop_latencies(before: Dict, after: Dict) -> Dict[str, dict]:
+    """Compute per hop and stage latency percentiles of the requests made between
+    two scrapes of the histograms."""
+    hops = {}
+    for (name, labels), buckets in after.items():
+        match = re.match(r'nitro_(\w+)_stage_seconds$', name)
+        if not match:
+            continue
+        previous = before.get((name, labels), {})
+        delta = {bound: count - previous.get(bound, 0.0) for bound, count in buckets.items()}
+        if delta[max(delta)] <= 0:
+            continue
+        labels = dict(labels)
+        if labels.get('action') == 'metrics':
+            # Requests made by the scrapes themselves
+            continue
+        stage_name = labels['stage'] if not labels.get('action') else \
+            f'{labels["stage"]}:{labels["action"]}'
+        hops.setdefault(match.group(1), {})[stage_name] = {
+            'count': delta[max(delta)],
+            'p50': histogram_quantile(0.50, delta),
+            'p95': histogram_quantile(0.95, delta),
+            'p99': histogram_quantile(0.99, delta)
+        }
+    return hops
+
+
+def wait_until(check, process: subprocess.Popen, timeout: float, what: str):
+    """Call check until it returns without raising an exception, the process exits
+    or the timeout expires"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            check()
+            return
+        except (OSError, requests.exceptions.RequestException, ValueError, KeyError) as error:
+            if process.poll() is not None:
+                raise click.ClickException(f'{what} exited with code {process.returncode}')
+            if time.monotonic() > deadline:
+                raise click.ClickException(f'{what} not ready after {timeout}s: {error}')
+            time.sleep(0.5)
+
+
+def launch_applications(log_dir: str, log_level: str, processes: Dict[str, subprocess.Popen],
+                        enclaves: int = 1):
+    """Start the server (simulation), parent, bastion and client and wait until they are ready.
+
+    Args:
+        log_dir (str): Directory where the output of each application is written.
+        log_level (str): Log level of the applications.
+        processes (Dict[str, subprocess.Popen]): Filled with the processes started by
+            application name, so that they can be terminated even if a later one fails.
+        enclaves (int, optional): Number of enclave simulators behind the parent. Defaults to 1.
+    """
+    commands, checks = {}, {}
+    for index in range(enclaves):
+        name = f'enclave-{index}' if index else 'enclave'
+        port = SIMULATION_PORT + index
+        commands[name] = ['server.py', '--simulate', 'True', '--port', str(port)]
+        checks[name] = lambda port=port: send_request_to_enclave(action='health',
+                                                                 host=ENCLAVE_HOST, port=port)
+    commands.update({
+        'parent': ['parent.py', '--simulate', 'True', '--enclaves', str(enclaves)],
+        'bastion': ['bastion.py', '--api', f'{PARENT_URL}/post/'],
+        'client': ['client.py', '--api', f'{BASTION_URL}/post/']
+    })
+    checks.update({
+        'parent': lambda: requests.get(PARENT_URL, timeout=1).raise_for_status(),
+        'bastion': lambda: requests.get(BASTION_URL, timeout=1).raise_for_status(),
+        'client': lambda: requests.get(CLIENT_URL, timeout=1).raise_for_status()
+    })
+    for name, command in commands.items():
+        log_file = open(os.path.join(log_dir, f'{name}.log'), mode='w', encoding='utf-8')  # pylint: disable=consider-using-with
+        processes[name] = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable] + command + ['--log-level', log_level],
+            cwd=SRC_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+        wait_until(checks[name], processes[name], 180, name)
+        print(f'{name} ready (pid {processes[name].pid})')
+
+
+def run_load(corpus: Dict[str, List[str]], concurrency: int, batch_size: int,
+             num_requests: int) -> Tuple[List[float], int, int, float]:
+    """Send batches of texts to the client API.
+
+    Args:
+        corpus (Dict[str, List[str]]): Contents per language.
+        concurrency (int): Number of requests in flight.
+        batch_size (int): Number of texts per request.
+        num_requests (int): Number of requests to send.
+
+    Returns:
+        Tuple[List[float], int, int, float]: Latency of the successful requests, number of
+            errors, number of texts processed and elapsed time.
+    """
+    languages = itertools.cycle(sorted(corpus))
+    cursors = {lang: itertools.cycle(texts) for lang, texts in corpus.items()}
+    batches = []
+    for _ in range(num_requests):
+        lang = next(languages)
+        texts = [{'content': next(cursors[lang])} for _ in range(batch_size)]
+        batches.append({'texts': texts, 'model': LANGUAGE_MODELS[lang]})
+
+    def send(batch: dict) -> float:
+        start = time.perf_counter()
+        response = requests.post(f'{CLIENT_URL}/processtexts/', json=batch, timeout=300)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(send, batch) for batch in batches]:
+            try:
+                latencies.append(future.result())
+            except requests.exceptions.RequestException:
+                errors += 1
+    elapsed = time.perf_counter() - start
+    return latencies, errors, len(latencies) * batch_size, elapsed
+
+
+@click.command()
+@click.option('--corpus', 'corpus_file', type=str, default='',
+              help='JSONL corpus with "lang" (nl or fr) and "content" fields. '
+              'Default uses the sample contents of the configuration.')
+@click.option('--concurrency', type=str, default='1,4',
+              help='Comma separated numbers of requests in flight. Default is 1,4.')
+@click.option('--batch-size', type=str, default='1,16',
+              help='Comma separated numbers of texts per request. Default is 1,16.')
+@click.option('--requests', 'num_requests', type=int, default=50,
+              help='Number of requests per configuration. Default is 50.')
+@click.option('--warmup', type=int, default=5,
+              help='Number of requests sent before measuring each configuration. Default is 5.')
+@click.option('--enclaves', type=int, default=1,
+              help='Number of enclave simulators started behind the parent. Default is 1.')
+@click.option('--launch/--no-launch', default=True,
+              help='Start the applications or use those already running. Default is to start them.')
+@click.option('--log-level', type=str, default='WARNING',
+              help='Log level of the applications. Default is WARNING.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(corpus_file: str, concurrency: str, batch_size: str, num_requests: int, warmup: int,
+         enclaves: int, launch: bool, log_level: str, output: str, compare: str):
+    """Run the end-to-end benchmark"""
+    corpus = by_language(load_corpus(corpus_file))
+    concurrencies = [int(value) for value in concurrency.split(',')]
+    batch_sizes = [int(value) for value in batch_size.split(',')]
+
+    log_dir = tempfile.mkdtemp(prefix='nitro-e2e-')
+    print(f'Application logs in {log_dir}')
+    processes = {}
+    try:
+        if launch:
+            launch_applications(log_dir, log_level, processes, enclaves)
+        monitor_pids = {name: process.pid for name, process in processes.items()}
+
+        results = {'corpus': {lang: len(texts) for lang, texts in corpus.items()}, 'runs': {}}
+        for num_concurrent, size in itertools.product(concurrencies, batch_sizes):
+            run_load(corpus, num_concurrent, size, warmup)
+
+            before = {url: scrape(url) for url in (CLIENT_URL, BASTION_URL, PARENT_URL)}
+            monitor = ProcessMonitor(monitor_pids)
+            monitor.start()
+            latencies, errors, texts, elapsed = run_load(corpus, num_concurrent, size,
+                                                         num_requests)
+            usage = monitor.stop()
+            after = {url: scrape(url) for url in (CLIENT_URL, BASTION_URL, PARENT_URL)}
+
+            hops = {}
+            for url in after:
+                hops.update(hop_latencies(before[url], after[url]))
+            run = {
+                'concurrency': num_concurrent,
+                'batch_size': size,
+                'errors': errors,
+                'requests_per_second': len(latencies) / elapsed,
+                'texts_per_second': texts / elapsed,
+                'latency': summarize(latencies),
+                'hops': hops,
+                'processes': usage
+            }
+            results['runs'][f'c{num_concurrent}_b{size}'] = run
+            print(f'concurrency={num_concurrent} batch={size}: '
+                  f'{run["requests_per_second"]:.2f} req/s, {run["texts_per_second"]:.2f} texts/s, '
+                  f'p50={run["latency"]["p50"] * 1000:.1f}ms p95={run["latency"]["p95"] * 1000:.1f}ms '
+                  f'p99={run["latency"]["p99"] * 1000:.1f}ms errors={errors}')
+            for hop, stages in sorted(hops.items()):
+                for stage, stats in sorted(stages.items()):
+                    if stage.split(':')[0] == 'total':
+                        print(f'    {hop:8s} {stage:16s} p50={stats["p50"] * 1000:.1f}ms '
+                              f'p95={stats["p95"] * 1000:.1f}ms p99={stats["p99"] * 1000:.1f}ms')
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+    path = save_results('e2e', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
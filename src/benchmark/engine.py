@@ -0,0 +1,172 @@
+"""
+AWS Nitro Test
+
+Benchmark of the NumPy NER engine (server/engine.py) against the NER component of
+spaCy. For each model, the components before the NER (the entity ruler) run on the
+texts, then the NER of spaCy, the engine and the engine with int8 weights each find
+the entities of fresh copies of these docs. It reports the time per token, the
+speedup over spaCy, the size of the weights and the texts whose entities differ from
+those of spaCy, on a synthetic or given corpus. It then checks that a fresh engine
+shared by several threads, as by the workers of a model, finds the same entities
+while they add labels.
+
+Run from the src directory:
+    python -m benchmark.engine --size 1000 --repeats 3
+"""
+import os
+import threading
+import time
+
+from typing import List
+
+import click
+import spacy
+
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
+from benchmark.corpus import by_language, generate_corpus, load_corpus, LANGUAGE_MODELS
+from benchmark.report import save_results, compare_results
+from server.engine import NumpyNER
+
+# Directory of the models
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'server', 'models')
+
+
+def prepare(nlp: Language, texts: List[str]) -> List[Doc]:
+    """Docs of texts processed by the components before the NER"""
+    docs = [nlp.make_doc(text) for text in texts]
+    for name, component in nlp.pipeline:
+        if name == 'ner':
+            break
+        docs = [component(doc) for doc in docs]
+    return docs
+
+
+def time_ner(component, nlp: Language, texts: List[str], batch_size: int,
+             repeats: int) -> tuple:
+    """Measure the time taken by a NER component to process texts (best of the
+    repeats), and return it with the docs it processed"""
+    best = None
+    for _ in range(repeats):
+        docs = prepare(nlp, texts)
+        start = time.perf_counter()
+        docs = list(component.pipe(docs, batch_size=batch_size))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, docs
+
+
+def entities(docs: List[Doc]) -> list:
+    """Entities of docs, with their offsets and labels"""
+    return [[(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents] for doc in docs]
+
+
+def check_threads(engine: NumpyNER, nlp: Language, texts: List[str], batch_size: int,
+                  threads: int, reference: list) -> dict:
+    """Run an engine on threads at once, each on its own copy of the docs, and count
+    the failed threads and the texts whose entities differ from the reference. A text
+    at a different position of each copy gets an entity with a new label, so that the
+    threads add labels while the others find entities. These texts are not compared."""
+    copies, marked = [], []
+    for index in range(threads):
+        docs = prepare(nlp, texts)
+        position = next((position for position in range(index * len(docs) // threads,
+                                                         len(docs)) if len(docs[position])),
+                        None)
+        if position is not None:
+            docs[position].ents = [Span(docs[position], 0, 1, label=f'CHECK{index}')]
+        copies.append(docs)
+        marked.append(position)
+    errors, different = [], []
+    barrier = threading.Barrier(threads)
+
+    def run(docs, position):
+        barrier.wait()
+        try:
+            docs = list(engine.pipe(docs, batch_size=batch_size))
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(repr(error))
+            return
+        different.append(sum(ents != expected for index, (ents, expected)
+                             in enumerate(zip(entities(docs), reference)) if index != position))
+
+    workers = [threading.Thread(target=run, args=args) for args in zip(copies, marked)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {'threads': threads, 'errors': len(errors), 'different_texts': sum(different),
+            'first_error': errors[0] if errors else ''}
+
+
+@click.command()
+@click.option('--corpus', 'corpus_file', type=str, default='',
+              help='JSONL corpus with "lang" (nl or fr) and "content" fields. '
+              'Default generates a synthetic corpus.')
+@click.option('--size', type=int, default=1000,
+              help='Number of synthetic texts per language. Default is 1000.')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic corpus. Default is 0.')
+@click.option('--batch-size', type=int, default=256,
+              help='Batch size of the pipe of the components. Default is 256.')
+@click.option('--repeats', type=int, default=3,
+              help='Number of repetitions of each measurement. Default is 3.')
+@click.option('--threads', type=int, default=8,
+              help='Number of threads sharing an engine in the concurrency check. Default is 8.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(corpus_file: str, size: int, seed: int, batch_size: int, repeats: int, threads: int,
+         output: str, compare: str):
+    """Run the NER engine benchmark"""
+    if corpus_file:
+        corpus = by_language(load_corpus(corpus_file))
+    else:
+        corpus = by_language(generate_corpus(size * len(LANGUAGE_MODELS),
+                                             tuple(LANGUAGE_MODELS), seed))
+
+    results = {'batch_size': batch_size, 'models': {}}
+    for lang, texts in sorted(corpus.items()):
+        name = LANGUAGE_MODELS[lang]
+        nlp = spacy.load(os.path.join(MODELS_DIR, name))
+        ner = nlp.get_pipe('ner')
+        seconds, docs = time_ner(ner, nlp, texts, batch_size, repeats)
+        reference = entities(docs)
+        tokens = sum(len(doc) for doc in docs)
+        model_results = {'texts': len(texts), 'tokens': tokens,
+                         'entities': sum(len(ents) for ents in reference),
+                         'engines': {'spacy': {'us_per_token': seconds / tokens * 1e6}}}
+        print(f'{name}: {len(texts)} texts, {tokens} tokens, {model_results["entities"]} '
+              f'entities\n    spacy: {seconds / tokens * 1e6:.1f} us/token')
+
+        for engine_name, quantize in (('numpy', False), ('numpy_int8', True)):
+            engine = NumpyNER.from_spacy(ner, quantize)
+            engine_seconds, docs = time_ner(engine, nlp, texts, batch_size, repeats)
+            different = sum(ents != expected
+                            for ents, expected in zip(entities(docs), reference))
+            stats = {'us_per_token': engine_seconds / tokens * 1e6,
+                     'speedup': seconds / engine_seconds,
+                     'weights_mib': engine.nbytes / 2 ** 20, 'different_texts': different}
+            model_results['engines'][engine_name] = stats
+            print(f'    {engine_name}: {stats["us_per_token"]:.1f} us/token, '
+                  f'{stats["speedup"]:.2f}x, {stats["weights_mib"]:.2f} MiB of weights, '
+                  f'{different} texts with different entities')
+
+        concurrency = check_threads(NumpyNER.from_spacy(ner), nlp, texts, batch_size, threads,
+                                    reference)
+        model_results['concurrency'] = concurrency
+        print(f'    numpy on {threads} threads: {concurrency["errors"]} failed threads, '
+              f'{concurrency["different_texts"]} texts with different entities '
+              f'{concurrency["first_error"]}')
+        results['models'][name] = model_results
+
+    path = save_results('engine', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
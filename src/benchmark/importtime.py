@@ -0,0 +1,98 @@
+"""
+AWS Nitro Test
+
+Benchmark of the import time of the entry points (client, parent, bastion, server).
+Each entry point is run with --help in a fresh interpreter with -X importtime, after
+a first run that compiles the bytecode. It reports the total import time of the
+entry point and the packages taking the most time to import, by their own (self)
+import time, which shows the dependencies that are worth loading lazily.
+
+Run from the src directory:
+    python -m benchmark.importtime --entry-point client.py,parent.py,bastion.py --repeats 5
+"""
+import re
+import statistics
+import subprocess
+import sys
+
+from collections import Counter
+from typing import Dict
+
+import click
+
+from benchmark.report import save_results, compare_results
+
+# import time: self [us] | cumulative | imported package
+LINE = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+\d+ \| +(?P<name>\S+)$')
+
+
+def import_times(script: str) -> Dict[str, int]:
+    """Run a script with --help in a fresh interpreter with -X importtime.
+
+    Args:
+        script (str): Python script, e.g., parent.py.
+
+    Returns:
+        Dict[str, int]: Self import time of every imported module, in microseconds.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'],
+                             capture_output=True, text=True, check=True)
+    modules = {}
+    for line in process.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            modules[match['name']] = int(match['self'])
+    return modules
+
+
+def measure(script: str, repeats: int, top: int) -> dict:
+    """Measure the import time of an entry point (median of the repeats)"""
+    # The first run compiles the bytecode of the modules that changed
+    import_times(script)
+    totals, packages = [], []
+    for _ in range(repeats):
+        modules = import_times(script)
+        totals.append(sum(modules.values()))
+        by_package = Counter()
+        for name, self_us in modules.items():
+            by_package[name.split('.')[0]] += self_us
+        packages.append(by_package)
+    medians = {package: statistics.median(sample[package] for sample in packages)
+               for package in packages[0]}
+    heaviest = sorted(medians.items(), key=lambda item: -item[1])[:top]
+    return {
+        'import_ms': statistics.median(totals) / 1000,
+        'modules': len(modules),
+        'packages_ms': {package: us / 1000 for package, us in heaviest}
+    }
+
+
+@click.command()
+@click.option('--entry-point', type=str, default='client.py,parent.py,bastion.py,server.py',
+              help='Comma separated scripts. Default is client.py,parent.py,bastion.py,server.py.')
+@click.option('--repeats', type=int, default=5,
+              help='Number of imports of each entry point. Default is 5.')
+@click.option('--top', type=int, default=10,
+              help='Number of packages reported by import time. Default is 10.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(entry_point: str, repeats: int, top: int, output: str, compare: str):
+    """Run the import time benchmark"""
+    results = {'repeats': repeats, 'entry_points': {}}
+    for script in entry_point.split(','):
+        stats = measure(script, repeats, top)
+        results['entry_points'][script] = stats
+        print(f'{script}: {stats["import_ms"]:.1f} ms, {stats["modules"]} modules')
+        for package, milliseconds in stats['packages_ms'].items():
+            print(f'    {package}: {milliseconds:.1f} ms')
+
+    path = save_results('importtime', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
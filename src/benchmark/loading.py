@@ -0,0 +1,112 @@
+"""
+AWS Nitro Test
+
+Benchmark of the load time of the NER models from their directory (spacy.load) and
+from their single-file bundle (server/bundle.py). Each load runs in a fresh
+interpreter, after the imports, so that it does not benefit from the state of the
+previous loads. It also measures the resident memory added by the load (the
+memory-mapped vector table is only resident once read) and checks
+that both formats return the same entities on a synthetic corpus.
+
+Run from the src directory, after python -m server.bundle:
+    python -m benchmark.loading --repeats 5
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import click
+import spacy
+
+from benchmark.corpus import by_language, generate_corpus, LANGUAGE_MODELS
+from benchmark.report import save_results, compare_results
+from server.bundle import BUNDLE_SUFFIX, load_bundle
+
+# Source directory, from which the models are loaded, and directory of the models
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_DIR = os.path.join(SRC_DIR, 'server', 'models')
+# Loads a model in a fresh interpreter and prints its load time and the resident
+# memory it added
+LOAD_SCRIPT = '''
+import json, os, sys, time
+import spacy
+from benchmark.e2e import ProcessMonitor
+from server.bundle import load_bundle
+load = load_bundle if sys.argv[1].endswith('.bundle') else spacy.load
+rss = ProcessMonitor.rss_bytes(os.getpid())
+start = time.perf_counter()
+nlp = load(sys.argv[1])
+seconds = time.perf_counter() - start
+rss = ProcessMonitor.rss_bytes(os.getpid()) - rss
+print(json.dumps({'seconds': seconds, 'rss_mib': rss / 2 ** 20}))
+'''
+
+
+def measure_load(path: str, repeats: int) -> dict:
+    """Load a model repeats times in fresh interpreters (median of the load times)"""
+    runs = []
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, '-c', LOAD_SCRIPT, path], capture_output=True,
+                                 text=True, check=True, cwd=SRC_DIR)
+        runs.append(json.loads(process.stdout.splitlines()[-1]))
+    return {
+        'seconds': statistics.median(run['seconds'] for run in runs),
+        'rss_mib': statistics.median(run['rss_mib'] for run in runs),
+        'size_mib': (os.path.getsize(path) if os.path.isfile(path) else sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path) for name in names)) / 2 ** 20
+    }
+
+
+def entities(nlp, texts) -> list:
+    """Entities found in texts, with their offsets and labels"""
+    return [[(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents]
+            for doc in nlp.pipe(texts)]
+
+
+@click.command()
+@click.option('--repeats', type=int, default=5,
+              help='Number of loads of each model and format. Default is 5.')
+@click.option('--size', type=int, default=100,
+              help='Number of synthetic texts per language compared. Default is 100.')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic corpus. Default is 0.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(repeats: int, size: int, seed: int, output: str, compare: str):
+    """Run the model loading benchmark"""
+    corpus = by_language(generate_corpus(size * len(LANGUAGE_MODELS), tuple(LANGUAGE_MODELS),
+                                         seed))
+    models = {name: lang for lang, name in LANGUAGE_MODELS.items()}
+    results = {'repeats': repeats, 'models': {}}
+    for entry in sorted(os.listdir(MODELS_DIR)):
+        model_dir = os.path.join(MODELS_DIR, entry)
+        bundle = model_dir + BUNDLE_SUFFIX
+        if not os.path.isdir(model_dir) or not os.path.isfile(bundle):
+            continue
+        model_results = {'directory': measure_load(model_dir, repeats),
+                         'bundle': measure_load(bundle, repeats)}
+        for variant, stats in model_results.items():
+            print(f'{entry} {variant}: loaded in {stats["seconds"]:.3f}s, '
+                  f'+{stats["rss_mib"]:.1f} MiB resident, {stats["size_mib"]:.1f} MiB on disk')
+        model_results['speedup'] = (model_results['directory']['seconds']
+                                    / model_results['bundle']['seconds'])
+
+        texts = corpus.get(models.get(entry.split('@')[0], 'nl'), [])
+        model_results['same_entities'] = (entities(spacy.load(model_dir), texts)
+                                          == entities(load_bundle(bundle), texts))
+        print(f'    {model_results["speedup"]:.1f}x faster, same entities on {len(texts)} '
+              f'texts: {model_results["same_entities"]}')
+        results['models'][entry] = model_results
+
+    path = save_results('loading', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,159 @@
+"""
+AWS Nitro Test
+
+Microbenchmark of the NER pipeline of server/ner_api.py, without any transport or
+encryption. For each model it measures the load time, the throughput of nlp.pipe
+across batch sizes, the cost of get_data with and without the displaCy rendering
+and the cost of each Span extension getter. It runs offline on a synthetic corpus.
+
+Run from the src directory:
+    python -m benchmark.ner --size 500 --batch-size 1,8,32,128
+"""
+import operator
+import os
+import time
+
+from typing import Dict, List
+
+import click
+import spacy
+
+from benchmark.corpus import by_language, generate_corpus, load_corpus, LANGUAGE_MODELS
+from benchmark.report import summarize, save_results, compare_results
+from server import ner_api
+
+# Span extensions set by ner_api
+SPAN_EXTENSIONS = ('person_title', 'company_legal_form', 'is_valid_entity')
+
+
+def time_load(name: str, repeats: int) -> dict:
+    """Measure the time taken by spacy.load for a model"""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        spacy.load(os.path.join(ner_api.__location__, name))
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def time_pipe(nlp: spacy.language.Language, texts: List[str], batch_size: int,
+              repeats: int) -> dict:
+    """Measure the throughput of nlp.pipe for a batch size (best of the repeats)"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        docs = list(nlp.pipe(texts, batch_size=batch_size))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tokens = sum(len(doc) for doc in docs)
+    return {
+        'seconds': best,
+        'docs_per_second': len(docs) / best,
+        'tokens_per_second': tokens / best
+    }
+
+
+def time_get_data(docs: list, render_html: bool, repeats: int) -> dict:
+    """Measure the time taken by get_data over processed documents (best of the repeats)"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for doc in docs:
+            ner_api.get_data(doc, render_html=render_html)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'seconds': best,
+        'docs_per_second': len(docs) / best,
+        'us_per_doc': best / len(docs) * 1e6
+    }
+
+
+def time_getters(docs: list, repeats: int) -> Dict[str, dict]:
+    """Measure the cost of an access to each Span extension (best of the repeats)"""
+    entities = [ent for doc in docs for ent in doc.ents]
+    costs = {}
+    for extension in SPAN_EXTENSIONS:
+        getter = operator.attrgetter(f'_.{extension}')
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for ent in entities:
+                getter(ent)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        costs[extension] = {
+            'calls': len(entities),
+            'ns_per_call': best / len(entities) * 1e9 if entities else 0.0
+        }
+    return costs
+
+
+@click.command()
+@click.option('--corpus', 'corpus_file', type=str, default='',
+              help='JSONL corpus with "lang" (nl or fr) and "content" fields. '
+              'Default generates a synthetic corpus.')
+@click.option('--size', type=int, default=500,
+              help='Number of synthetic texts per language. Default is 500.')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic corpus. Default is 0.')
+@click.option('--batch-size', type=str, default='1,8,32,128',
+              help='Comma separated nlp.pipe batch sizes. Default is 1,8,32,128.')
+@click.option('--repeats', type=int, default=3,
+              help='Number of repetitions of each measurement. Default is 3.')
+@click.option('--load-repeats', type=int, default=3,
+              help='Number of times each model is loaded. Default is 3.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(corpus_file: str, size: int, seed: int, batch_size: str, repeats: int,
+         load_repeats: int, output: str, compare: str):
+    """Run the NER pipeline microbenchmark"""
+    if corpus_file:
+        corpus = by_language(load_corpus(corpus_file))
+    else:
+        corpus = by_language(generate_corpus(size * len(LANGUAGE_MODELS),
+                                             tuple(LANGUAGE_MODELS), seed))
+    batch_sizes = [int(value) for value in batch_size.split(',')]
+
+    results = {'models': {}}
+    for lang, texts in sorted(corpus.items()):
+        name = LANGUAGE_MODELS[lang]
+        nlp = ner_api.MODELS[name]
+        print(f'{name}: {len(texts)} texts')
+
+        model_results = {'texts': len(texts), 'load': time_load(name, load_repeats)}
+        print(f'    spacy.load: p50={model_results["load"]["p50"]:.3f}s')
+
+        model_results['pipe'] = {}
+        for pipe_batch in batch_sizes:
+            pipe = time_pipe(nlp, texts, pipe_batch, repeats)
+            model_results['pipe'][f'b{pipe_batch}'] = pipe
+            print(f'    nlp.pipe batch={pipe_batch}: {pipe["docs_per_second"]:.1f} docs/s, '
+                  f'{pipe["tokens_per_second"]:.0f} tokens/s')
+
+        docs = list(nlp.pipe(texts))
+        model_results['tokens'] = sum(len(doc) for doc in docs)
+        model_results['entities'] = sum(len(doc.ents) for doc in docs)
+        model_results['get_data'] = {
+            'with_displacy': time_get_data(docs, True, repeats),
+            'without_displacy': time_get_data(docs, False, repeats)
+        }
+        for variant, stats in model_results['get_data'].items():
+            print(f'    get_data {variant}: {stats["us_per_doc"]:.1f} us/doc')
+
+        model_results['getters'] = time_getters(docs, repeats)
+        for extension, stats in model_results['getters'].items():
+            print(f'    Span._.{extension}: {stats["ns_per_call"]:.0f} ns/call '
+                  f'({stats["calls"]} entities)')
+
+        results['models'][name] = model_results
+
+    path = save_results('ner', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,178 @@
+"""
+AWS Nitro Test
+
+Recall check of the pre-filter of server/prefilter.py against the full NER pipeline.
+Every text is processed by the full pipeline; the entities returned for the texts
+that the pre-filter would skip are missed. It reports the texts skipped per language
+and the kind of cue that lets the others through, and measures the cost of the
+pre-filter and the throughput of run_pipeline with and without it. The texts are
+the lines of the synthetic documents by default, which mixes boilerplate lines
+without entities with lines full of them. It first checks the cue of sample texts
+with the keywords that are also common words, and exits with an error if one of
+them differs from the expected one.
+
+Run from the src directory:
+    python -m benchmark.prefilter --size 500
+"""
+import sys
+import time
+
+from collections import Counter
+from typing import List
+
+import click
+
+from benchmark.corpus import by_language, generate_corpus, load_corpus, LANGUAGE_MODELS
+from benchmark.report import save_results, compare_results
+from server import ner_api
+from server.prefilter import CAPITALIZED, KEYWORD
+
+
+# Expected cue of sample texts by language: the titles and legal forms that are also
+# common words are cues with dots, whatever their case, and only then
+CUE_CASES = {
+    'fr': [
+        ('nous avons reçu la lettre de m. dupont hier', KEYWORD),
+        ('nous avons reçu la lettre de M. dupont hier', KEYWORD),
+        ('la société dupont sa. a payé la facture', KEYWORD),
+        ('la société dupont SA. a payé la facture', KEYWORD),
+        ('la société dupont s.a. a payé la facture', KEYWORD),
+        ('la société dupont S.A. a payé la facture', KEYWORD),
+        ('la société dupont SA a payé la facture', CAPITALIZED),
+        ('il me semble que sa demande est fondée', ''),
+        ('Il me semble que sa demande est fondée.', '')
+    ],
+    'nl': [
+        ('we ontvingen de brief van m. jansen gisteren', KEYWORD),
+        ('we ontvingen de brief van M. jansen gisteren', KEYWORD),
+        ('het lijkt me dat de aanvraag gegrond is', '')
+    ]
+}
+
+
+def check_cues(lang: str) -> List[str]:
+    """Return the sample texts of a language whose cue is not the expected one"""
+    prefilter = ner_api.PREFILTERS[ner_api.ModelName(LANGUAGE_MODELS[lang])]
+    return [f'{text!r}: {prefilter.cue(text)!r} instead of {expected!r}'
+            for text, expected in CUE_CASES.get(lang, ()) if prefilter.cue(text) != expected]
+
+
+def time_pipeline(model: ner_api.ModelName, texts: List[str], prefilter: bool,
+                  repeats: int) -> dict:
+    """Measure the throughput of run_pipeline without displaCy (best of the repeats)"""
+    ner_api.NER_PREFILTER = prefilter
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        ner_api.run_pipeline(model, texts, render_html=False)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'seconds': best, 'docs_per_second': len(texts) / best}
+
+
+def check_recall(model: ner_api.ModelName, texts: List[str], repeats: int) -> dict:
+    """Compare the pre-filter with the entities of the full pipeline"""
+    prefilter = ner_api.PREFILTERS[model]
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        candidates = [prefilter.has_candidates(text) for text in texts]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    cues = Counter(cue for cue in map(prefilter.cue, texts) if cue)
+
+    ner_api.NER_PREFILTER = False
+    results = ner_api.run_pipeline(model, texts, render_html=False)
+    entities = sum(len(result['entities']) for result in results)
+    missed = Counter()
+    examples = []
+    for text, candidate, result in zip(texts, candidates, results):
+        if not candidate and result['entities']:
+            missed.update(entity['label'] for entity in result['entities'])
+            examples.append(text)
+    skipped = candidates.count(False)
+    return {
+        'texts': len(texts),
+        'skipped': skipped,
+        'skipped_fraction': skipped / len(texts),
+        'cues': dict(cues),
+        'entities': entities,
+        'missed_entities': sum(missed.values()),
+        'recall': 1 - sum(missed.values()) / entities if entities else 1.0,
+        'texts_with_entities': sum(1 for result in results if result['entities']),
+        'missed_texts': len(examples),
+        'missed_labels': dict(missed),
+        'missed_examples': examples[:10],
+        'us_per_text': best / len(texts) * 1e6
+    }
+
+
+@click.command()
+@click.option('--corpus', 'corpus_file', type=str, default='',
+              help='JSONL corpus with "lang" (nl or fr) and "content" fields. '
+              'Default generates a synthetic corpus.')
+@click.option('--size', type=int, default=500,
+              help='Number of synthetic texts per language. Default is 500.')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic corpus. Default is 0.')
+@click.option('--documents', is_flag=True, default=False,
+              help='Check whole documents instead of their lines.')
+@click.option('--repeats', type=int, default=3,
+              help='Number of repetitions of each measurement. Default is 3.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(corpus_file: str, size: int, seed: int, documents: bool, repeats: int, output: str,
+         compare: str):
+    """Check the recall of the NER pre-filter"""
+    if corpus_file:
+        corpus = by_language(load_corpus(corpus_file))
+    else:
+        corpus = by_language(generate_corpus(size * len(LANGUAGE_MODELS),
+                                             tuple(LANGUAGE_MODELS), seed))
+
+    results = {'documents': documents, 'skipped_fraction_by_language': {}, 'models': {},
+               'cue_failures': [failure for lang in sorted(CUE_CASES)
+                                for failure in check_cues(lang)]}
+    for failure in results['cue_failures']:
+        print(f'Unexpected cue of {failure}')
+    for lang, contents in sorted(corpus.items()):
+        model = ner_api.ModelName(LANGUAGE_MODELS[lang])
+        texts = contents if documents else [line for content in contents
+                                            for line in content.splitlines() if line.strip()]
+        print(f'{model.value}: {len(texts)} texts')
+
+        model_results = check_recall(model, texts, repeats)
+        model_results['language'] = lang
+        results['skipped_fraction_by_language'][lang] = model_results['skipped_fraction']
+        print(f'    skipped {model_results["skipped"]} texts '
+              f'({model_results["skipped_fraction"]:.1%}), '
+              f'{model_results["us_per_text"]:.1f} us/text, cues {model_results["cues"]}')
+        print(f'    recall {model_results["recall"]:.4f}: missed '
+              f'{model_results["missed_entities"]} of {model_results["entities"]} entities '
+              f'in {model_results["missed_texts"]} texts {model_results["missed_labels"]}')
+        for example in model_results['missed_examples']:
+            print(f'        {example[:100]!r}')
+
+        model_results['pipeline'] = {
+            'full': time_pipeline(model, texts, False, repeats),
+            'prefilter': time_pipeline(model, texts, True, repeats)
+        }
+        for variant, stats in model_results['pipeline'].items():
+            print(f'    run_pipeline {variant}: {stats["docs_per_second"]:.1f} docs/s')
+
+        results['models'][model.value] = model_results
+
+    print('Skipped texts per language: ' + ', '.join(
+        f'{lang} {fraction:.1%}'
+        for lang, fraction in results['skipped_fraction_by_language'].items()))
+    path = save_results('prefilter', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+    if results['cue_failures']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
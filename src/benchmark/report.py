@@ -0,0 +1,133 @@
+"""
+AWS Nitro Test
+
+Helpers to summarise, save and compare benchmark results
+"""
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+
+from typing import Dict, List
+
+# Directory where benchmark results are saved by default
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def git_commit() -> str:
+    """Get the commit of the working tree, if any.
+
+    Returns:
+        str: Commit hash or '' if not in a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def percentile(sorted_samples: List[float], fraction: float) -> float:
+    """Get a percentile of sorted samples with linear interpolation.
+
+    Args:
+        sorted_samples (List[float]): Samples in increasing order.
+        fraction (float): Percentile as a fraction between 0 and 1.
+
+    Returns:
+        float: Percentile value, NaN if there are no samples.
+    """
+    if not sorted_samples:
+        return math.nan
+    position = (len(sorted_samples) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_samples) - 1)
+    weight = position - lower
+    return sorted_samples[lower] * (1 - weight) + sorted_samples[upper] * weight
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Summarise latency samples.
+
+    Args:
+        samples (List[float]): Samples (e.g., in seconds).
+
+    Returns:
+        Dict[str, float]: Count, mean, p50, p95, p99 and max of the samples.
+    """
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered) if ordered else math.nan,
+        'p50': percentile(ordered, 0.50),
+        'p95': percentile(ordered, 0.95),
+        'p99': percentile(ordered, 0.99),
+        'max': ordered[-1] if ordered else math.nan
+    }
+
+
+def save_results(name: str, results: dict, output: str = '') -> str:
+    """Save benchmark results as JSON together with the commit and platform.
+
+    Args:
+        name (str): Name of the benchmark (e.g., 'e2e').
+        results (dict): Results of the benchmark.
+        output (str, optional): Output file. Defaults to '', in which case the results are
+            saved in RESULTS_DIR in a file named after the benchmark, commit and time.
+
+    Returns:
+        str: Path of the saved file.
+    """
+    commit = git_commit()
+    timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    document = {
+        'benchmark': name,
+        'commit': commit,
+        'timestamp': timestamp,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results
+    }
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'{name}-{commit[:8] or "nocommit"}-{timestamp}.json')
+    with open(output, mode='w', encoding='utf-8') as file:
+        json.dump(document, file, indent=2)
+    return output
+
+
+def _flatten(obj: any, prefix: str = '') -> Dict[str, float]:
+    """Flatten the numeric leaves of nested dictionaries into dotted keys"""
+    leaves = {}
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            leaves.update(_flatten(value, f'{prefix}.{key}' if prefix else str(key)))
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        leaves[prefix] = obj
+    return leaves
+
+
+def compare_results(baseline_file: str, current: dict) -> List[str]:
+    """Compare results with those saved by an earlier run (e.g., of another commit).
+
+    Args:
+        baseline_file (str): JSON file saved by save_results.
+        current (dict): Results of the current run.
+
+    Returns:
+        List[str]: One line per numeric result present in both runs with its relative change.
+    """
+    with open(baseline_file, mode='r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    old = _flatten(baseline['results'])
+    new = _flatten(current)
+    lines = [f'Baseline: {baseline.get("benchmark")} at commit {baseline.get("commit", "")[:8]}']
+    for key in sorted(old.keys() & new.keys()):
+        if old[key] and not math.isnan(old[key]) and not math.isnan(new[key]):
+            change = (new[key] - old[key]) / abs(old[key]) * 100
+            lines.append(f'{key}: {old[key]:.6g} -> {new[key]:.6g} ({change:+.1f}%)')
+    return lines
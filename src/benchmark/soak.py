@@ -0,0 +1,148 @@
+"""
+AWS Nitro Test
+
+Soak test of the vocabulary growth of the NER models. It runs batches of synthetic
+texts full of unique names and KBO/NISS numbers through run_pipeline for a long
+time and samples the resident set size of the process and the size of the
+StringStore of the model. With MODEL_MAX_NEW_STRINGS set (--max-new-strings), the
+model is reloaded in the background whenever its vocabulary has grown too much and
+the memory stays flat. With 0, it grows with every batch.
+
+With MODEL_MAX_NEW_STRINGS set, the test exits with an error if the mean RSS of the
+last quarter of the samples exceeds that of the first quarter by more than
+--max-growth-mib, or if a replaced copy of the model is still in memory once the
+reloads are done.
+
+Run from the src directory:
+    python -m benchmark.soak --batches 2000 --max-new-strings 100000
+    python -m benchmark.soak --batches 2000 --max-new-strings 0
+"""
+import gc
+import os
+import random
+import string
+import sys
+import time
+import weakref
+
+from typing import List
+
+import click
+
+from benchmark.corpus import generate_text, LANGUAGE_MODELS
+from benchmark.e2e import ProcessMonitor
+from benchmark.report import save_results, compare_results
+from server import ner_api
+
+
+def unique_texts(rng: random.Random, lang: str, count: int) -> List[str]:
+    """Generate texts with a unique surname each, on top of their random numbers"""
+    texts = []
+    for _ in range(count):
+        surname = ''.join(rng.choice(string.ascii_lowercase) for _ in range(8)).capitalize()
+        texts.append(f'{generate_text(rng, lang, rng.randint(1, 4))} {surname} {surname}s.')
+    return texts
+
+
+def mean_mib(samples: List[dict]) -> float:
+    """Mean RSS of samples in MiB"""
+    return sum(sample['rss_mib'] for sample in samples) / len(samples) if samples else 0.0
+
+
+@click.command()
+@click.option('--lang', type=click.Choice(sorted(LANGUAGE_MODELS)), default='nl',
+              help='Language of the texts. Default is nl.')
+@click.option('--batches', type=int, default=2000,
+              help='Number of batches processed. Default is 2000.')
+@click.option('--batch-size', type=int, default=16,
+              help='Number of texts per batch. Default is 16.')
+@click.option('--max-new-strings', type=int, default=100000,
+              help='MODEL_MAX_NEW_STRINGS during the test, 0 to never reload the model. '
+              'Default is 100000.')
+@click.option('--interval', type=int, default=100,
+              help='Number of batches between two samples. Default is 100.')
+@click.option('--seed', type=int, default=0, help='Seed of the texts. Default is 0.')
+@click.option('--max-growth-mib', type=float, default=64.0,
+              help='Maximum growth of the RSS between the first and last quarters of the '
+              'samples, with --max-new-strings set. Default is 64.')
+@click.option('--reload-timeout', type=float, default=120.0,
+              help='Seconds to wait for the reloads in progress at the end. Default is 120.')
+@click.option('--output', type=str, default='',
+              help='JSON file where the results are saved. Default is benchmark/results/.')
+@click.option('--compare', type=str, default='',
+              help='JSON results of a previous run to compare with.')
+def main(lang: str, batches: int, batch_size: int, max_new_strings: int, interval: int,
+         seed: int, max_growth_mib: float, reload_timeout: float, output: str, compare: str):
+    """Run the vocabulary soak test"""
+    ner_api.MODEL_MAX_NEW_STRINGS = max_new_strings
+    model = ner_api.ModelName(LANGUAGE_MODELS[lang])
+    rng = random.Random(seed)
+    reloads = ner_api.RELOADS
+    print(f'{model.value}: {batches} batches of {batch_size} texts, '
+          f'MODEL_MAX_NEW_STRINGS={max_new_strings}')
+
+    samples = []
+    # Every copy of the model used during the test, to check that replaced ones are freed
+    copies = weakref.WeakSet()
+    start = time.perf_counter()
+    for batch in range(1, batches + 1):
+        copies.add(ner_api.MODELS[model.value])
+        ner_api.run_pipeline(model, unique_texts(rng, lang, batch_size), render_html=False)
+        if batch % interval == 0 or batch == batches:
+            sample = {
+                'batch': batch,
+                'seconds': time.perf_counter() - start,
+                'rss_mib': ProcessMonitor.rss_bytes(os.getpid()) / 2 ** 20,
+                'strings': len(ner_api.MODELS[model.value].vocab.strings),
+                'reloads': sum(reloads._series.values())  # pylint: disable=protected-access
+            }
+            samples.append(sample)
+            print(f'    batch {batch}: RSS {sample["rss_mib"]:.1f} MiB, '
+                  f'{sample["strings"]} strings, {sample["reloads"]} reloads')
+
+    # Previous copies are freed at the end of their reload
+    deadline = time.monotonic() + reload_timeout
+    while ner_api._RELOADING and time.monotonic() < deadline:  # pylint: disable=protected-access
+        time.sleep(0.1)
+    gc.collect()
+    current = ner_api.MODELS[model.value]
+    leaked = sum(1 for copy in copies if copy is not current)
+
+    # The first quarter includes the allocations of the first batches
+    quarter = max(len(samples) // 4, 1)
+    results = {
+        'model': model.value,
+        'batches': batches,
+        'batch_size': batch_size,
+        'max_new_strings': max_new_strings,
+        'docs_per_second': batches * batch_size / (time.perf_counter() - start),
+        'rss_first_quarter_mib': mean_mib(samples[:quarter]),
+        'rss_last_quarter_mib': mean_mib(samples[-quarter:]),
+        'rss_peak_mib': max(sample['rss_mib'] for sample in samples),
+        'reloads': samples[-1]['reloads'],
+        'leaked_copies': leaked,
+        'samples': samples
+    }
+    print(f'RSS {results["rss_first_quarter_mib"]:.1f} MiB in the first quarter, '
+          f'{results["rss_last_quarter_mib"]:.1f} MiB in the last one, '
+          f'peak {results["rss_peak_mib"]:.1f} MiB, {results["reloads"]} reloads, '
+          f'{leaked} replaced copies still in memory')
+
+    path = save_results('soak', results, output)
+    print(f'Results saved in {path}')
+    if compare:
+        print('\n'.join(compare_results(compare, results)))
+    if max_new_strings:
+        failures = []
+        growth = results['rss_last_quarter_mib'] - results['rss_first_quarter_mib']
+        if growth > max_growth_mib:
+            failures.append(f'RSS grew by {growth:.1f} MiB (limit {max_growth_mib:.1f} MiB)')
+        if leaked:
+            failures.append(f'{leaked} replaced copies of the model still in memory')
+        if failures:
+            print('Memory not bounded: ' + ', '.join(failures))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -6,25 +6,44 @@ Server application that provides the NER API.
 import asyncio
 
 
+from contextlib import contextmanager
 from enum import Enum
 import json
-from typing import List
+from typing import Dict, Iterator, List, Tuple
 import os
+import time
 
+import aiofiles
 import cbor2
 import base64
 import urllib.request
 import click
 from common.messages import send_request_to_enclave
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
 from starlette.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from common.config import CLIENT_HOST, CLIENT_PORT, ENCLAVE_HOST, CONTENT_1, CONTENT_2, CONTENT_3
-from common.helper import pprint, verify_enclave, get_cid
-from common.messages import get_attestation, send_encrypted_message
+from common.authorization import sign_control
+from common.compact import COMPACT_FORMAT, expand_result
+from common.config import CLIENT_HOST, CLIENT_PORT, SIMULATION_PORT, CONTENT_1, CONTENT_2, CONTENT_3, \
+    LOG_LEVEL, DEFAULT_TIMEOUT, MAX_TEXTS, MAX_TEXT_CHARACTERS, MAX_JOB_BYTES
+from common.enclaves import EnclavePool, NoEnclave, describe_enclaves, \
+    describe_simulated_enclaves, enclave_addresses
+from common.helper import pprint, verify_enclave
+from common.jobs import JobManager, Job, FAILED, RECEIVING
+from common.limits import LimitMiddleware, rejected_counter, BULK, DEADLINE, INTERNAL, \
+    INVALID, TOO_LARGE
+from common.log import configure_logging, get_logger, StageTimer, Truncated
+from common.encryption import send_encrypted_message
+from common.messages import get_attestation, new_request_id, EnclaveError
+from common.metrics import export_prometheus, observe_stages, PROMETHEUS_CONTENT_TYPE
+
+logger = get_logger('client')
+
+REJECTED = rejected_counter('client')
 
 
 class ModelName(str, Enum):
@@ -33,9 +52,11 @@ class ModelName(str, Enum):
     """
     ner_french = r"socsec_ner_fr"  # pylint: disable=invalid-name
     ner_dutch = r"socsec_ner_nl"  # pylint: disable=invalid-name
+    # Model of each text chosen from its language by the enclave
+    auto = r"auto"  # pylint: disable=invalid-name
 
 DEFAULT_MODEL = ModelName.ner_dutch
-MODEL_NAMES = [model.value for model in ModelName]
+MODEL_NAMES = [model.value for model in ModelName if model != ModelName.auto]
 
 class RequestModel(BaseModel):
     """Schema for processing requests on enclave
@@ -78,6 +99,9 @@ class ResponseModel(BaseModel):
 # Set up the FastAPI app and define the endpoints
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"])
+# Reject the requests that are too large or beyond the concurrency limit before reading them.
+# The input of the jobs is streamed and its size checked while it is written to disk.
+app.add_middleware(LimitMiddleware, hop='client', exempt_paths=('/jobs/',))
 
 
 @app.get("/")
@@ -86,11 +110,15 @@ async def root():
     """
     return "Hello from Proxy"
 
+@app.get("/metrics", summary="Latency metrics of the client", response_class=PlainTextResponse)
+def metrics():
+    """Export the latency histograms of the client in the Prometheus text format."""
+    return PlainTextResponse(export_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.post("/process/", summary="Forward message to the enclave server")
 def post_message(req: RequestModel) -> List[str]:
     """ Forward the message received to the enclave server."""
-    print("Process request received")
-    pprint(req.json(), 'query')
+    logger.debug('Process request received', size=len(req.payload))
     
     decoded = base64.b64decode(req.payload)
     reqObj = cbor2.loads(decoded)
@@ -98,57 +126,334 @@ def post_message(req: RequestModel) -> List[str]:
     if "payload" in reqObj:
         param = reqObj["payload"]
 
-    api=''
-    cid = get_cid()
-    host = ''
-    
-    print(f'action: {reqObj["action"]}')
-    print(f'parameter: {param}')
+    logger.debug('Forwarding request', action=reqObj["action"], parameter=Truncated(param))
 
-    # Request attestation from the server running in the Nitro enclave
-    res = send_request_to_enclave(action=reqObj["action"], parameter=param,
-                                       cid=cid, host=host, api=api)
+    # Send the request to an attested enclave, as /processtexts/, or to the bastion
+    # or the parent. The parameter is already encrypted, the public key is not needed
+    with enclave_target() as target:
+        target.pop('public_key')
+        res = send_request_to_enclave(action=reqObj["action"], parameter=param, **target)
     response_obj_cbor = cbor2.dumps(res)
     response_b64 = base64.b64encode(response_obj_cbor)
     response = json.dumps({'payload': response_b64.decode()})
     return response
 
 
-@app.post("/processtexts/", summary="Process batches of text", response_model=ResponseModel)
-def process_texts(query: InputModel):
-    """Process a batch of texts and return the entities predicted by the
-    given model. Each record in the data should have a key "text".
+# Enclaves the client sends requests to when it is not behind a parent,
+# discovered when the application starts
+POOL: EnclavePool = None
+
+
+def discover() -> Dict[str, dict]:
+    """Discover the Nitro enclaves (or their simulators) running on this instance.
+
+    Returns:
+        Dict[str, dict]: Keyword arguments identifying each enclave for
+            send_request_to_enclave, by enclave ID.
     """
-    print("Process request received")
-    pprint(query.json(),'query')
+    # Hack
+    if os.getenv('NITRO_SIMULATION') == 'True':
+        ports = range(SIMULATION_PORT, SIMULATION_PORT + int(os.getenv('NITRO_ENCLAVES', '1')))
+        return enclave_addresses(describe_simulated_enclaves(ports))
+    return enclave_addresses(describe_enclaves())
+
+
+@app.on_event('startup')
+def start_pool():
+    """Discover the enclaves and check their health in the background, unless the
+    requests are sent to the bastion or the parent"""
+    global POOL  # pylint: disable=global-statement
+    if not os.getenv('API_URL'):
+        POOL = EnclavePool(discover)
+        POOL.start()
+
+
+def attested_keys() -> Dict[str, bytes]:
+    """Get the public keys of the enclaves attested by main, by enclave ID"""
+    # Hack
+    return {enclave_id: base64.b64decode(key) for enclave_id, key
+            in json.loads(os.getenv('ENCLAVE_PUBLIC_KEYS')).items()}
+
 
-    enclave_public_key = base64.b64decode(str.encode(os.getenv('ENCLAVE_PUBLIC_KEY')))
+def each_enclave() -> Iterator[Tuple[str, dict]]:
+    """Address every attested enclave, e.g., to change its state.
+
+    Through the bastion or the parent, a request encrypted for a single enclave is
+    sent to that enclave.
+
+    Yields:
+        Tuple[str, dict]: Enclave ID, and public_key and address arguments of
+            send_encrypted_message.
+    """
     api_url = os.getenv('API_URL')
-    simulate = True if os.getenv('NITRO_SIMULATION') == 'True' else False
+    addresses = {} if api_url else discover()
+    for enclave_id, public_key in attested_keys().items():
+        if api_url:
+            yield enclave_id, {'public_key': {enclave_id: public_key}, 'api': api_url}
+        elif enclave_id in addresses:
+            yield enclave_id, {'public_key': public_key, **addresses[enclave_id]}
+
 
+@contextmanager
+def enclave_target() -> Iterator[dict]:
+    """Choose the enclave of a request among those attested by main.
+
+    Through the bastion or the parent, the request is encrypted for every attested
+    enclave and the parent chooses one. Otherwise, the client chooses the attested
+    enclave with the least outstanding requests.
+
+    Yields:
+        dict: public_key and address arguments of send_encrypted_message.
+
+    Raises:
+        HTTPException: If there is no enclave to connect to.
+    """
+    public_keys = attested_keys()
+    api_url = os.getenv('API_URL')
     if api_url:
-        host = ''
-        cid = 0
-    elif simulate:
-        host = ENCLAVE_HOST
-        cid = 0
-    else:
-        # Get CID of enclave
-        cid = get_cid()
-        host = ''
-        if cid == 0:
-            error_msg = "Cannot find an enclave to connect to"
-            print(error_msg)
-            return error_msg
+        yield {'public_key': public_keys, 'api': api_url}
+        return
+
+    try:
+        enclave = POOL.acquire(public_keys)
+    except NoEnclave as error:
+        logger.error(str(error))
+        raise HTTPException(status_code=503, detail=str(error)) from error
+    failed = False
+    try:
+        yield {'public_key': public_keys[enclave.id], **enclave.address}
+    except OSError:
+        failed = True
+        raise
+    finally:
+        POOL.release(enclave, failed)
+
+
+def process_batch(texts: List[str], model: str, html: bool = True, request_id: str = '',
+                  timer: StageTimer = None, priority: str = '') -> List[dict]:
+    """Process a batch of texts in the enclave.
+
+    The query is sent as a CBOR map rather than a JSON document. The results are
+    returned in the compact format without the processed texts, which are restored
+    from the query.
+
+    Args:
+        texts (List[str]): Texts to process.
+        model (str): Name of the model.
+        html (bool, optional): If False, the displaCy page of the texts is not rendered.
+            Defaults to True.
+        request_id (str, optional): ID of the request, generated if empty.
+        timer (StageTimer, optional): Timer of the stages of the request.
+        priority (str, optional): Priority class of the request in the enclave.
+
+    Returns:
+        List[dict]: Result of each text, following the schema of ResponseModel.Batch.
+
+    Raises:
+        EnclaveError: If the enclave rejects the request.
+    """
+    timer = timer or StageTimer()
+    with timer.stage('serialize'):
+        parameter = {
+            'texts': [{'content': text} for text in texts],
+            'model': model,
+            'output': COMPACT_FORMAT,
+            'echo_text': False,
+            'html': html
+        }
+    # The HTTP requests to the bastion time out after DEFAULT_TIMEOUT,
+    # a later response would be discarded
+    with enclave_target() as target:
+        response = send_encrypted_message(action='process', parameter=parameter,
+                                          request_id=request_id or new_request_id(), timer=timer,
+                                          priority=priority, deadline=DEFAULT_TIMEOUT, **target)
+    with timer.stage('parse'):
+        return expand_result(response, texts)['result']
+
+
+def enclave_error(error: EnclaveError) -> HTTPException:
+    """Convert an error returned by the enclave to an HTTP error"""
+    status_code = {TOO_LARGE: 413, DEADLINE: 504, INVALID: 400,
+                   INTERNAL: 500}.get(error.code, 503)
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after else None
+    return HTTPException(status_code=status_code, detail=str(error), headers=headers)
+
+
+@app.post("/processtexts/", summary="Process batches of text", response_model=ResponseModel)
+def process_texts(query: InputModel):
+    """Process a batch of texts and return the entities predicted by the
+    given model. Each record in the data should have a key "text".
+    """
+    request_id = new_request_id()
+    logger.debug('Process request received', texts=len(query.texts), model=query.model.value,
+                 request_id=request_id)
+    timer = StageTimer()
+    start = time.perf_counter()
+
+    # Reject the queries beyond the limits of the enclave before encrypting them
+    if len(query.texts) > MAX_TEXTS:
+        REJECTED.inc(limit='texts')
+        raise HTTPException(status_code=413, detail=f'More than {MAX_TEXTS} texts')
+    if any(len(text.content) > MAX_TEXT_CHARACTERS for text in query.texts):
+        REJECTED.inc(limit='characters')
+        raise HTTPException(status_code=413,
+                            detail=f'Text longer than {MAX_TEXT_CHARACTERS} characters')
 
     # Request server to process query content
-    response = send_encrypted_message(public_key=enclave_public_key,
-                                      action='process', parameter=query.json(),
-                                      cid=cid, host=host, api=api_url)
+    try:
+        result = process_batch([text.content for text in query.texts], query.model.value,
+                               request_id=request_id, timer=timer)
+    except EnclaveError as error:
+        logger.warning('Request rejected', request_id=request_id, reason=error, code=error.code)
+        raise enclave_error(error) from error
     with open('result.html', 'w', encoding='utf-8') as file:
-        file.write(json.loads(response)['result'][0]['html'])
-    pprint(response, 'Response')
-    return ResponseModel(**json.loads(response))
+        file.write(result[0]['html'])
+
+    timer.timings['total'] = time.perf_counter() - start
+    observe_stages('client', timer, action='process', model=query.model.value)
+    logger.debug('Request processed', texts=len(query.texts), model=query.model.value,
+                 request_id=request_id, **timer.fields())
+    return ResponseModel(result=result)
+
+
+def process_job_batch(texts: List[str], model: str, html: bool = False) -> List[dict]:
+    """Process a batch of a job, behind the interactive requests"""
+    return process_batch(texts, model, html=html, priority=BULK)
+
+
+JOBS = JobManager(process_job_batch)
+
+
+@app.post("/jobs/", summary="Submit a batch job", status_code=202)
+async def submit_job(request: Request, model: ModelName = DEFAULT_MODEL, html: bool = False):
+    """Submit a batch job. The body is NDJSON, one text per line, either as an
+    object with a "content" field or as a JSON string. It is streamed to disk and
+    may be larger than a /processtexts/ request (up to MAX_JOB_BYTES).
+    The texts are then sent to the enclave in batches, and the results can be
+    polled or streamed with the returned job ID.
+    """
+    job = JOBS.create(model.value, html=html)
+    size = 0
+    error = 'Upload interrupted'
+    try:
+        # Written on a thread pool, so that a large upload does not block the event loop
+        async with aiofiles.open(job.input_path, 'wb') as file:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_JOB_BYTES:
+                    REJECTED.inc(limit='bytes')
+                    error = f'Input larger than {MAX_JOB_BYTES} bytes'
+                    raise HTTPException(status_code=413, detail=error)
+                await file.write(chunk)
+        JOBS.start(job)
+    except Exception as reason:  # pylint: disable=broad-except
+        if not isinstance(reason, HTTPException):
+            error = f'Upload failed: {reason}'
+        raise
+    finally:
+        # Failed, rejected or cancelled (e.g., the client disconnected) before it started
+        if job.state == RECEIVING:
+            logger.warning('Job upload failed', job=job.id, size=size, reason=error)
+            job.finish(FAILED, error)
+            os.remove(job.input_path)
+    logger.info('Job submitted', job=job.id, size=size, model=model.value)
+    return job.status()
+
+
+def get_job(job_id: str) -> Job:
+    """Get a job from its ID, raise HTTP 404 if it does not exist"""
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Unknown job {job_id}')
+    return job
+
+
+@app.get("/jobs/{job_id}", summary="Status of a batch job")
+def job_status(job_id: str):
+    """Return the state of a batch job and its number of documents processed
+    and failed so far."""
+    return get_job(job_id).status()
+
+
+@app.get("/jobs/{job_id}/results", summary="Results of a batch job")
+def job_results(job_id: str, follow: bool = False):
+    """Stream the results of a batch job as NDJSON, one line per input text with
+    its "index" in the input and either its entities or an "error". The lines are
+    in order of completion of the batches. If follow is True, the response ends
+    when the job is finished rather than with the results available so far.
+    """
+    job = get_job(job_id)
+    return StreamingResponse(job.read_results(follow), media_type='application/x-ndjson')
+
+
+def operator_token(action: str, parameter: any = None) -> dict:
+    """Sign a control action with the private key of the operators (--operator-key).
+
+    Raises:
+        HTTPException: If the client has no operator key.
+    """
+    # Hack
+    path = os.getenv('OPERATOR_KEY')
+    if not path:
+        raise HTTPException(status_code=403,
+                            detail='No operator key to sign the control action (--operator-key)')
+    with open(path, 'rb') as file:
+        return sign_control(file.read(), action, parameter)
+
+
+def send_to_each_enclave(action: str, parameter: any = None) -> Dict[str, any]:
+    """Send a control action to every attested enclave and return the response, or
+    the error, of each enclave by enclave ID"""
+    responses = {}
+    for enclave_id, target in each_enclave():
+        try:
+            responses[enclave_id] = send_encrypted_message(action=action, parameter=parameter,
+                                                           **target)
+        except (OSError, ValueError, EnclaveError) as error:
+            logger.warning('Cannot send request to enclave', action=action, enclave=enclave_id,
+                           reason=error)
+            responses[enclave_id] = {'error': str(error)}
+    return responses
+
+
+@app.get("/models/", summary="Versions of the models of each enclave")
+def models_status():
+    """Return, for each enclave and model, the version loaded, the versions shipped
+    in the enclave image and whether the model is being reloaded."""
+    return send_to_each_enclave('model-status')
+
+
+@app.post("/models/{model}/reload", summary="Load a version of a model in each enclave")
+def reload_model(model: ModelName, version: str = ''):
+    """Load a version of a model in the background in every enclave, then swap it in
+    without interrupting the requests in progress. Without version, a fresh copy of
+    the version currently loaded is loaded. The client must be started with the
+    operator key. Follow the reload with GET /models/."""
+    responses = send_to_each_enclave('reload-model', operator_token(
+        'reload-model', {'model': model.value, 'version': version}))
+    logger.info('Model reload requested', model=model.value, version=version,
+                responses=responses)
+    return responses
+
+
+@app.post("/profile/", summary="Profile each enclave")
+def start_profile(seconds: float = 10, memory: bool = False):
+    """Sample the stacks of the threads of every enclave for a number of seconds in
+    the background, and trace their allocations if memory is set. The enclaves must
+    be started with profiling enabled and the client with the operator key, at most
+    CONTROL_BURST times in a row. Follow the profile with GET /profile/."""
+    responses = send_to_each_enclave('profile', operator_token(
+        'profile', {'seconds': seconds, 'memory': memory}))
+    logger.info('Profile requested', seconds=seconds, memory=memory, responses=responses)
+    return responses
+
+
+@app.get("/profile/", summary="Result of the last profile of each enclave")
+def profile_result():
+    """Return, for each enclave, whether a profile is running and the result of the
+    last one: the stacks in the collapsed format of flame graphs and, with memory,
+    the code locations allocating the most."""
+    return send_to_each_enclave('profile-result')
 
 
 @click.command()
@@ -161,7 +466,16 @@ def process_texts(query: InputModel):
               'is running on enclave parent.')
 @click.option('--simulate', type=bool, default=False,
               help='If set to True, assume the server simulates a Nitro enclave. Default is False.')
-def main(desc: str, test: bool, api: str, simulate: bool):
+@click.option('--enclaves', type=int, default=1,
+              help='Number of enclave simulators, listening on consecutive ports from '
+              f'{SIMULATION_PORT}. Only used with --simulate and without --api. Default is 1.')
+@click.option('--log-level', type=str, default=LOG_LEVEL,
+              help=f'Log level. Per-request records are logged at DEBUG. Default is {LOG_LEVEL}.')
+@click.option('--operator-key', type=str, default='',
+              help='PEM file of the RSA private key of the operators, signing the control '
+              'actions (reload-model, profile). Not set by default: the control actions are refused.')
+def main(desc: str, test: bool, api: str, simulate: bool, enclaves: int, log_level: str,
+         operator_key: str):
     """Main function of the client that checks the attestation of the server,
     establishes an encryption key with the server and sends an encrypted message
     to the server.
@@ -170,62 +484,65 @@ def main(desc: str, test: bool, api: str, simulate: bool):
         desc (str): Name of file containing the description of the enclave
         test (bool): Run some basic tests first
         simulate (bool): If True, tells the server to communicate with a simulated Nitro enclave. 
+        enclaves (int): Number of enclave simulators.
+        log_level (str): Minimum level of the log records to print.
+        operator_key (str): PEM file of the private key signing the control actions.
     """
+    configure_logging(log_level)
+
     # Hack to pass argument to routing function
     os.environ['API_URL'] = api
     os.environ['NITRO_SIMULATION'] = 'True' if simulate else 'False'
+    os.environ['NITRO_ENCLAVES'] = str(enclaves)
+    os.environ['OPERATOR_KEY'] = operator_key
 
     if desc:
         desc = os.path.join(os.path.dirname(os.path.abspath(__file__)), desc)
 
-    host=''
-    cid=0
     if api:
-        host = ''
-        cid = 0
-    elif simulate:
-        host = ENCLAVE_HOST
-        cid = 0
+        # The parent lists the enclaves it forwards requests to
+        addresses = {enclave['id']: {'api': api, 'enclave': enclave['id']} for enclave
+                    in send_request_to_enclave(action='enclaves', api=api)['enclaves']
+                    if enclave['healthy']}
     else:
-        # Get CID of enclave
-        cid = get_cid()
-        host = ''
-        if cid == 0:
-            error_msg = "Cannot find an enclave to connect to"
-            print(error_msg)
-            return error_msg
+        addresses = discover()
+    if not addresses:
+        error_msg = "Cannot find an enclave to connect to"
+        print(error_msg)
+        return error_msg
     pprint(simulate, 'Enclave simulation')
-    pprint(host, 'Enclave address')
-    pprint(cid, 'Enclave CID')
     pprint(api, 'Enclave parent address')
-
-    attestation_doc = get_attestation(cid=cid, host=host, api=api)
-    print('Attestation doc: ')
-    print(base64.b64encode(attestation_doc).decode())
-    
-    # Request attestation from the server running in the Nitro enclave
-    enclave_public_key = verify_enclave(desc, attestation_doc)
-    os.environ['ENCLAVE_PUBLIC_KEY'] = base64.b64encode(enclave_public_key).decode()
+    pprint(addresses, 'Enclaves')
+
+    # Request attestation from each server running in a Nitro enclave. Each enclave has
+    # its own key pair, the requests are encrypted with the public key of their enclave.
+    public_keys = {}
+    for enclave_id, address in addresses.items():
+        attestation_doc = get_attestation(**address)
+        print(f'Attestation doc of {enclave_id}: ')
+        print(base64.b64encode(attestation_doc).decode())
+        public_keys[enclave_id] = verify_enclave(desc, attestation_doc)
+    os.environ['ENCLAVE_PUBLIC_KEYS'] = json.dumps(
+        {enclave_id: base64.b64encode(key).decode() for enclave_id, key in public_keys.items()})
 
     if test:
+        # Send the test requests to the first enclave
+        enclave_id, address = next(iter(addresses.items()))
+        target = dict(address, public_key=public_keys[enclave_id])
+
         # Send an encrypted message to the server
         data='Test message'
-        response = send_encrypted_message(public_key=enclave_public_key, action='message',
-                                          parameter=data,
-                                          cid=cid, host=host, api=api)
+        response = send_encrypted_message(action='message', parameter=data, **target)
         pprint(response, 'response')
 
         # Request the list of models
-        model_names = send_encrypted_message(public_key=enclave_public_key, action='models',
-                                             cid=cid, host=host, api=api)
+        model_names = send_encrypted_message(action='models', **target)
         pprint(model_names, 'Available models')
 
         # Request server to process test content
         texts = [{"content": CONTENT_1}, {"content": CONTENT_2}, { "content": CONTENT_3 }]
         data = json.dumps({"texts": texts, "model": model_names[0]})
-        response = send_encrypted_message(public_key=enclave_public_key,
-                                          action='process', parameter=data,
-                                          cid=cid, host=host, api=api)
+        response = send_encrypted_message(action='process', parameter=data, **target)
         with open('result.html', 'w', encoding='utf-8') as file:
             file.write(json.loads(response)['result'][0]['html'])
         pprint(json.loads(response), 'Response')
@@ -239,7 +556,8 @@ def main(desc: str, test: bool, api: str, simulate: bool):
 
 
     # Launch server
-    config = uvicorn.Config("client:app", port=CLIENT_PORT, host=CLIENT_HOST, log_level="debug")
+    config = uvicorn.Config("client:app", port=CLIENT_PORT, host=CLIENT_HOST,
+                            log_level=log_level.lower())
     server = uvicorn.Server(config)
     asyncio.run(server.serve())
 
@@ -0,0 +1,123 @@
+"""
+AWS Nitro Test
+
+Authorization of the control actions of the enclave (reload-model, profile), which change its
+state or slow it down. Anyone who can reach the parent can encrypt a request with the
+public key of the attestation, so the parameter of these actions is a token signed
+with the RSA private key of the operators. The enclave checks it with their public key,
+shipped in the enclave image and thus covered by its measurements. The token names the
+action and its parameter, expires after OPERATOR_TOKEN_SECONDS and is accepted once, so
+that a request captured by the parent cannot be replayed.
+"""
+import math
+import os
+import threading
+import time
+
+from typing import Dict, Iterable
+
+import cbor2
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+from Crypto.Signature import pss
+
+from common.config import OPERATOR_PUBLIC_KEY, OPERATOR_TOKEN_SECONDS, OPERATOR_CLOCK_SKEW, \
+    CONTROL_RATE, CONTROL_BURST
+from common.limits import LimitExceeded, RateLimiter
+from common.log import get_logger
+
+logger = get_logger('authorization')
+
+
+class Unauthorized(ValueError):
+    """A control action is not authorized by the operators"""
+
+
+def sign_control(private_key: bytes, action: str, parameter: any = None) -> dict:
+    """Sign a control action with the private key of the operators.
+
+    Args:
+        private_key (bytes): PEM encoded RSA private key of the operators.
+        action (str): Action of the request.
+        parameter (any, optional): Parameter of the action. Defaults to None.
+
+    Returns:
+        dict: Parameter of the request: the token and its signature.
+    """
+    token = cbor2.dumps({'action': action, 'parameter': parameter,
+                         'expires': time.time() + OPERATOR_TOKEN_SECONDS,
+                         'nonce': get_random_bytes(16)})
+    signature = pss.new(RSA.import_key(private_key)).sign(SHA256.new(token))
+    return {'token': token, 'signature': signature}
+
+
+class Authorizer():
+    """Check the tokens of the control actions and limit their rate, per action.
+    Thread-safe.
+
+    Args:
+        public_key (bytes, optional): PEM encoded RSA public key of the operators. If
+            empty, every control action is refused.
+        actions (Iterable[str], optional): Control actions, each with its own rate limit.
+    """
+    def __init__(self, public_key: bytes = b'', actions: Iterable[str] = ()):
+        self._key = RSA.import_key(public_key) if public_key else None
+        self._limiters = {action: RateLimiter(CONTROL_RATE, CONTROL_BURST)
+                          for action in actions}
+        # Expiry of the tokens already used, by nonce
+        self._used: Dict[bytes, float] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str = OPERATOR_PUBLIC_KEY,
+                  actions: Iterable[str] = ()) -> 'Authorizer':
+        """Create an authorizer with the public key of a PEM file, refusing every
+        control action if the file does not exist"""
+        if not os.path.exists(path):
+            logger.warning('No operator key, control actions are refused', path=path)
+            return cls(b'', actions)
+        with open(path, 'rb') as file:
+            return cls(file.read(), actions)
+
+    def authorize(self, action: str, data: any) -> any:
+        """Check the token of a control action and return its parameter.
+
+        Args:
+            action (str): Action of the request.
+            data (any): Decrypted parameter of the request, signed by sign_control.
+
+        Raises:
+            Unauthorized: If the token is missing, invalid, for another action,
+                expired or already used.
+            LimitExceeded: If the action was authorized too often.
+
+        Returns:
+            any: Parameter of the action.
+        """
+        if self._key is None:
+            raise Unauthorized('Control actions are disabled: no operator key')
+        try:
+            token = data['token']
+            pss.new(self._key).verify(SHA256.new(token), data['signature'])
+            claims = cbor2.loads(token)
+            expires, nonce = float(claims['expires']), bytes(claims['nonce'])
+        except (KeyError, TypeError, ValueError) as error:
+            raise Unauthorized('Invalid operator token') from error
+        if claims.get('action') != action:
+            raise Unauthorized(f'Operator token not valid for {action}')
+        now = time.time()
+        # The clocks of the operators and of the enclave may differ slightly
+        if not now < expires <= now + OPERATOR_TOKEN_SECONDS + OPERATOR_CLOCK_SKEW:
+            raise Unauthorized('Operator token expired')
+        with self._lock:
+            self._used = {used: expiry for used, expiry in self._used.items() if expiry > now}
+            if nonce in self._used:
+                raise Unauthorized('Operator token already used')
+            self._used[nonce] = expires
+        if not self._limiters[action].acquire():
+            raise LimitExceeded('control', f'Too many {action} requests',
+                                math.ceil(1 / CONTROL_RATE))
+        logger.info('Control action authorized', action=action)
+        return claims.get('parameter')
@@ -0,0 +1,84 @@
+"""
+AWS Nitro Test
+
+Compact columnar format of the results of the NER process action. Entities are
+stored as columns of start/end offsets and label IDs with a label dictionary
+shared by the whole batch. The entity text is only kept when it differs from the
+processed text (e.g., the digits of a KBO or NISS number), empty attributes are
+left out and the echo of the processed text is optional.
+"""
+from typing import Any, Dict, List
+
+# Name of the compact output format
+COMPACT_FORMAT = 'compact'
+
+# Optional entity attributes, stored sparsely by entity index
+SPARSE_ATTRIBUTES = ('text', 'person_title', 'company_legal_form')
+
+
+def compact_result(result: List[Dict[str, Any]], echo_text: bool = True) -> Dict[str, Any]:
+    """Convert the results of a batch of processed texts to the compact format.
+
+    Args:
+        result (List[Dict[str, Any]]): Results in the full format of ResponseModel.
+        echo_text (bool, optional): If False, the processed texts are not included.
+            Defaults to True.
+
+    Returns:
+        Dict[str, Any]: Results in the compact format.
+    """
+    label_ids = {}
+    batches = []
+    for batch in result:
+        text = batch['text']
+        compact = {'start': [], 'end': [], 'label': []}
+        sparse = {name: {} for name in SPARSE_ATTRIBUTES}
+        for index, entity in enumerate(batch['entities']):
+            start, end = entity['start'], entity['end']
+            compact['start'].append(start)
+            compact['end'].append(end)
+            compact['label'].append(label_ids.setdefault(entity['label'], len(label_ids)))
+            if entity['text'] != text[start:end]:
+                sparse['text'][index] = entity['text']
+            for name in SPARSE_ATTRIBUTES[1:]:
+                if entity[name]:
+                    sparse[name][index] = entity[name]
+        compact.update((name, values) for name, values in sparse.items() if values)
+        if batch['html']:
+            compact['html'] = batch['html']
+        if echo_text:
+            compact['doc_text'] = text
+        batches.append(compact)
+    return {'format': COMPACT_FORMAT, 'labels': list(label_ids), 'result': batches}
+
+
+def expand_result(response: Dict[str, Any], texts: List[str]) -> Dict[str, Any]:
+    """Convert results in the compact format back to the full format of ResponseModel.
+
+    Args:
+        response (Dict[str, Any]): Results in the compact format.
+        texts (List[str]): Processed texts, used when they are not echoed back.
+
+    Returns:
+        Dict[str, Any]: Results in the full format.
+    """
+    labels = response['labels']
+    result = []
+    for compact, original in zip(response['result'], texts):
+        text = compact.get('doc_text', original)
+        # Keys of the sparse attributes become strings if the response went through JSON
+        sparse = {name: {int(index): value for index, value in compact.get(name, {}).items()}
+                  for name in SPARSE_ATTRIBUTES}
+        entities = []
+        for index, (start, end, label) in enumerate(zip(compact['start'], compact['end'],
+                                                        compact['label'])):
+            entities.append({
+                'text': sparse['text'].get(index, text[start:end]),
+                'label': labels[label],
+                'start': start,
+                'end': end,
+                'person_title': sparse['person_title'].get(index, ''),
+                'company_legal_form': sparse['company_legal_form'].get(index, '')
+            })
+        result.append({'text': text, 'entities': entities, 'html': compact.get('html', '')})
+    return {'result': result}
@@ -0,0 +1,137 @@
+"""
+AWS Nitro Test
+
+Optional compression of the payloads before their encryption. zstd and LZ4 are
+used when their packages are installed, zlib is always available.
+"""
+import zlib
+
+from typing import Callable, Dict, Iterable, Tuple
+
+from common.config import COMPRESSION_THRESHOLD, MAX_REQUEST_BYTES
+from common.limits import LimitExceeded
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Codec name -> (compress, decompress). decompress takes the maximum size of the data
+# and raises LimitExceeded beyond, without decompressing it all.
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes, int], bytes]]] = {}
+
+
+def too_large(max_size: int) -> LimitExceeded:
+    """Error of data decompressed beyond max_size"""
+    return LimitExceeded('bytes', f'Decompressed data larger than {max_size} bytes')
+
+
+def decompress_zstd(data: bytes, max_size: int) -> bytes:
+    """Decompress a zstd frame of at most max_size bytes"""
+    # The output size is only bounded by max_output_size if the frame has no content size
+    size = zstandard.frame_content_size(data)
+    if size > max_size:
+        raise too_large(max_size)
+    if size >= 0:
+        return zstandard.ZstdDecompressor().decompress(data)
+    chunks, size = [], 0
+    with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+        for chunk in iter(lambda: reader.read(65536), b''):
+            size += len(chunk)
+            if size > max_size:
+                raise too_large(max_size)
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def decompress_lz4(data: bytes, max_size: int) -> bytes:
+    """Decompress an LZ4 frame of at most max_size bytes"""
+    # The content size is 0 if the frame does not have it
+    if lz4.frame.get_frame_info(data)['content_size'] > max_size:
+        raise too_large(max_size)
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    decompressed = decompressor.decompress(data, max_length=max_size)
+    if not decompressor.eof:
+        if decompressor.needs_input:
+            raise ValueError('Truncated LZ4 frame')
+        raise too_large(max_size)
+    return decompressed
+
+
+def decompress_zlib(data: bytes, max_size: int) -> bytes:
+    """Decompress a zlib stream of at most max_size bytes"""
+    decompressor = zlib.decompressobj()
+    decompressed = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise too_large(max_size)
+    if not decompressor.eof:
+        raise ValueError('Truncated zlib stream')
+    return decompressed
+
+
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                      decompress_zstd)
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, decompress_lz4)
+CODECS['zlib'] = (lambda data: zlib.compress(data, 6), decompress_zlib)
+
+
+def available_codecs() -> Tuple[str, ...]:
+    """Return the names of the codecs available on this host."""
+    return tuple(CODECS)
+
+
+def compress(data: bytes, accept: Iterable[str],
+             threshold: int = COMPRESSION_THRESHOLD) -> Tuple[bytes, str]:
+    """Compress data with the first codec of the accepted ones that is available.
+    Data smaller than the threshold is left as is.
+
+    Args:
+        data (bytes): Data to compress.
+        accept (Iterable[str]): Codecs accepted by the peer, in order of preference.
+        threshold (int, optional): Minimum size of the data to compress.
+            Defaults to COMPRESSION_THRESHOLD.
+
+    Returns:
+        Tuple[bytes, str]: Data, compressed or not, and name of the codec used
+            ('' if the data is not compressed).
+    """
+    if len(data) < threshold:
+        return data, ''
+    for codec in accept:
+        if codec in CODECS:
+            compressed = CODECS[codec][0](data)
+            # Keep incompressible data as is
+            if len(compressed) < len(data):
+                return compressed, codec
+            break
+    return data, ''
+
+
+def decompress(data: bytes, codec: str, max_size: int = MAX_REQUEST_BYTES) -> bytes:
+    """Decompress data compressed with compress.
+
+    Args:
+        data (bytes): Data, compressed or not.
+        codec (str): Name of the codec used ('' if the data is not compressed).
+        max_size (int, optional): Maximum size of the decompressed data. Defaults to
+            MAX_REQUEST_BYTES.
+
+    Returns:
+        bytes: Decompressed data.
+
+    Raises:
+        LimitExceeded: If the decompressed data is larger than max_size. It is
+            rejected before it is decompressed beyond max_size.
+    """
+    if not codec:
+        return data
+    if codec not in CODECS:
+        raise ValueError(f'Unsupported compression codec: {codec}')
+    return CODECS[codec][1](data, max_size)
@@ -53,6 +53,147 @@ VSOCK_PORT = 8080
 
 # Nitro enclave simulation
 ENCLAVE_HOST =  '127.0.0.1' # Host used for simulation
+# Port of the Nitro enclave simulator. It differs from PARENT_PORT so that
+# the simulator and the parent can run on the same host
+SIMULATION_PORT = 8090
+# Number of threads receiving the requests and handling the control-plane actions
+SERVER_IO_THREADS = 8
+# Requests in progress at once on a multiplexed connection with the enclave (see
+# EnclaveClient in common/messages.py): the enclave stops reading the connection beyond
+ENCLAVE_MAX_STREAMS = 64
+# Number of threads of each NER model running its queued requests, unless set in MODEL_WORKERS
+INFERENCE_WORKERS = 2
+# Number of threads of each NER model running its queued requests, by model name
+MODEL_WORKERS = {}
+# Seconds between two rebalancings of the threads between the models according to
+# their traffic, 0 to keep the numbers of threads set above
+MODEL_REBALANCE_INTERVAL = 30
+# Minimum number of threads of each model after a rebalancing
+MODEL_MIN_WORKERS = 1
+# Number of additional threads of each model only running interactive requests
+INTERACTIVE_WORKERS = 1
+# Maximum size in bytes of the encrypted parameter of a process request that is
+# scheduled as interactive when the client does not set its priority class
+INTERACTIVE_MAX_BYTES = 65536
+# NER model of the texts of each language, when the model of a process request is 'auto'
+LANGUAGE_MODELS = {'nl': 'socsec_ner_nl', 'fr': 'socsec_ner_fr'}
+# Number of characters of a text used to identify its language
+LANGID_MAX_CHARACTERS = 2000
+# If True, texts without any digit, email or URL shape, person title, legal form or
+# capitalized word inside a sentence bypass the NER model (see server/prefilter.py)
+NER_PREFILTER = False
+# Maximum number of tokens of a batch of texts given to nlp.pipe. The texts of a request
+# are sorted by length and grouped under this budget; 0 for a single batch in request order
+NER_BATCH_TOKENS = 10000
+# Average number of characters per token, used to estimate the tokens of a text
+NER_CHARACTERS_PER_TOKEN = 5
+# Maximum number of strings added to the vocabulary of a model by the processed texts,
+# after which a fresh copy of the model is loaded in the background; 0 to never reload
+MODEL_MAX_NEW_STRINGS = 0
+# Version of each model loaded at startup, by model name. The 'default' version is in
+# server/models/<name>, the other versions shipped in the image in server/models/<name>@<version>
+MODEL_VERSIONS = {}
+# If True, a model is loaded from its single-file bundle server/models/<name>[@<version>].bundle
+# when there is one, built with python -m server.bundle (see server/bundle.py)
+MODEL_BUNDLES = True
+# NER inference engine: 'spacy', or 'numpy' for the batched NumPy engine of
+# server/engine.py, which finds the same entities
+NER_ENGINE = 'spacy'
+# If True, the NumPy engine stores its weights as int8, about 4 times smaller; the
+# entities of a few texts may change
+NER_ENGINE_INT8 = False
+# Synthetic encrypted requests processed by each model at startup, before the server
+# listens, to warm up the models, the vector tables and the RSA and AES code; 0 to skip
+WARM_UP_ROUNDS = 3
+# If True, the enclave accepts the profile action, which samples the stacks of its
+# threads and optionally traces its allocations. The setting is covered by the EIF
+# measurements; server.py --profiling overrides it
+PROFILING = False
+# Maximum duration of a profile, in seconds
+PROFILE_MAX_SECONDS = 60
+# Seconds between two samples of the stacks during a profile
+PROFILE_INTERVAL = 0.01
+# Number of code locations allocating the most memory returned by a profile
+PROFILE_TOP_ALLOCATIONS = 50
+# PEM file of the RSA public key of the operators, relative to the working directory
+# of the server and copied in the enclave image with common/. The control actions
+# (reload-model, profile) must carry a token signed with its private key; they are refused if the
+# file does not exist
+OPERATOR_PUBLIC_KEY = 'common/operator-public.pem'
+# Seconds during which an operator token is valid
+OPERATOR_TOKEN_SECONDS = 60
+# Seconds by which the clock of the operators may be ahead of that of the enclave
+OPERATOR_CLOCK_SKEW = 30
+# Authorized control actions per second, per action, and maximum burst, beyond which
+# they are rejected
+CONTROL_RATE = 1 / 60
+CONTROL_BURST = 3
+
+# Command listing the running enclaves as JSON
+ENCLAVE_DESCRIBE_COMMAND = ('nitro-cli', 'describe-enclaves')
+# Seconds between two discoveries and health checks of the enclaves by the parent
+ENCLAVE_HEALTH_INTERVAL = 5
+# Seconds to wait for the response of an enclave to a health check or a metrics scrape.
+# Shorter than ENCLAVE_HEALTH_INTERVAL so that a stuck enclave does not delay the next checks
+ENCLAVE_HEALTH_TIMEOUT = 2
+# Consecutive failed requests or health checks after which an enclave no longer
+# receives requests, until a health check succeeds
+ENCLAVE_MAX_FAILURES = 3
+
+###################################
+#### Limits
+###################################
+
+# Maximum size in bytes of a request received by the client, the bastion, the parent
+# or the enclave
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+# Maximum size in bytes of a decompressed response received by the client. The
+# responses of the process action are larger than its texts (entities and displaCy pages)
+MAX_RESPONSE_BYTES = 4 * MAX_REQUEST_BYTES
+# Maximum number of texts of a process request
+MAX_TEXTS = 10000
+# Maximum number of characters of a text (spaCy rejects texts longer than 1000000)
+MAX_TEXT_CHARACTERS = 1000000
+# Maximum number of requests processed at the same time by the client, the bastion
+# and the parent
+MAX_CONCURRENT_REQUESTS = 64
+# Maximum number of process requests waiting in the enclave
+MAX_QUEUED_REQUESTS = 32
+# Seconds after which a request rejected because of the load may be retried
+RETRY_AFTER = 1
+# Seconds during which the enclave serves the same attestation document to the
+# get-attestation requests without nonce; 0 to get a new document for each request
+ATTESTATION_CACHE_SECONDS = 300
+# Attestation documents with the nonce of the client generated per second, and
+# maximum burst, beyond which get-attestation requests with a nonce are rejected
+ATTESTATION_NONCE_RATE = 2
+ATTESTATION_NONCE_BURST = 10
+# Maximum size of the nonce of an attestation document
+ATTESTATION_MAX_NONCE_BYTES = 512
+
+###################################
+#### Jobs
+###################################
+
+# Directory where the input, the results and the status of the batch jobs are stored
+JOBS_DIR = 'jobs'
+# Maximum size in bytes of the input of a batch job
+MAX_JOB_BYTES = 1024 * 1024 * 1024
+# Maximum number of texts and of characters of a batch sent by a job to the enclave
+JOB_BATCH_TEXTS = 256
+JOB_BATCH_CHARACTERS = 200000
+# Number of batches of a job in flight to the enclave
+JOB_CONCURRENCY = 4
+# Number of retries of a failed batch, and seconds before the first retry (doubled
+# at each retry)
+JOB_RETRIES = 3
+JOB_RETRY_DELAY = 1
+# Seconds between two reads of the results of a job streamed while it runs
+JOB_POLL_INTERVAL = 0.5
+# Seconds during which a finished job and its results are kept, and maximum number of
+# finished jobs kept; beyond, the oldest are deleted when a job is created
+JOB_TTL = 24 * 3600
+JOB_MAX_FINISHED = 1000
 
 ###################################
 #### General
@@ -60,6 +201,17 @@ ENCLAVE_HOST =  '127.0.0.1' # Host used for simulation
 
 # pprint max length
 MAX_LENGTH = 40
+# Default log level (DEBUG, INFO, WARNING, ERROR). Per-request records are logged at DEBUG
+LOG_LEVEL = 'INFO'
+# Upper bounds (in seconds) of the buckets of the latency histograms
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Compression codecs of the encrypted payloads, in order of preference (zstd, lz4, zlib).
+# Codecs whose package is not installed are skipped. Empty to disable the compression
+COMPRESSION_CODECS = ('zstd', 'lz4', 'zlib')
+# Minimum size in bytes of a payload to compress it
+COMPRESSION_THRESHOLD = 1024
 
 # Timeout before dropping HTTP request
 DEFAULT_TIMEOUT = 10
@@ -0,0 +1,246 @@
+"""
+AWS Nitro Test
+
+Discovery of the Nitro enclaves running on the instance and load balancing of the
+requests across them. Requests are routed to the healthy enclave with the least
+outstanding requests. Enclaves failing repeatedly, in requests or in the periodic
+health checks, stop receiving requests until a health check succeeds again.
+"""
+import json
+import subprocess
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+from common.config import ENCLAVE_NAME, ENCLAVE_HOST, ENCLAVE_DESCRIBE_COMMAND, \
+    ENCLAVE_HEALTH_INTERVAL, ENCLAVE_HEALTH_TIMEOUT, ENCLAVE_MAX_FAILURES
+from common.log import get_logger
+from common.messages import send_request_to_enclave
+from common.metrics import counter
+
+logger = get_logger('enclaves')
+
+FAILURES = counter('nitro_enclave_failures_total',
+                   'Failed requests and health checks per enclave', ('enclave', 'reason'))
+
+# Discovers the running enclaves and returns their address by enclave ID
+Discover = Callable[[], Dict[str, dict]]
+
+
+def describe_enclaves(command: Iterable[str] = ENCLAVE_DESCRIBE_COMMAND) -> List[dict]:
+    """List the enclaves running on the instance with nitro-cli.
+
+    Args:
+        command (Iterable[str], optional): Command printing the enclaves as JSON.
+            Defaults to ENCLAVE_DESCRIBE_COMMAND.
+
+    Returns:
+        List[dict]: Description of each enclave (EnclaveID, EnclaveCID, EnclaveName,
+            State...). Empty if the command fails.
+    """
+    try:
+        output = subprocess.run(list(command), check=True, capture_output=True,
+                                timeout=ENCLAVE_HEALTH_INTERVAL).stdout
+        return json.loads(output)
+    except (OSError, subprocess.SubprocessError, ValueError) as error:
+        logger.warning('Cannot describe enclaves', reason=error)
+        return []
+
+
+def describe_simulated_enclaves(ports: Iterable[int]) -> List[dict]:
+    """Stub of describe_enclaves for enclave simulators listening on ports of
+    ENCLAVE_HOST. The simulators have no CID, their address is in Host and Port.
+    """
+    return [{'EnclaveName': ENCLAVE_NAME, 'EnclaveID': f'simulator-{port}', 'EnclaveCID': 0,
+             'State': 'RUNNING', 'Host': ENCLAVE_HOST, 'Port': port} for port in ports]
+
+
+def enclave_addresses(enclaves: List[dict], enclave_name: str = ENCLAVE_NAME) -> Dict[str, dict]:
+    """Get the address of the running enclaves with a given name.
+
+    Args:
+        enclaves (List[dict]): Output of describe_enclaves.
+        enclave_name (str, optional): Name of the enclaves. Defaults to ENCLAVE_NAME.
+
+    Returns:
+        Dict[str, dict]: Keyword arguments of send_request_to_enclave by enclave ID.
+    """
+    addresses = {}
+    for enclave in enclaves:
+        if enclave.get('EnclaveName') != enclave_name or enclave.get('State') != 'RUNNING':
+            continue
+        if enclave.get('Host'):
+            address = {'host': enclave['Host'], 'port': enclave['Port']}
+        else:
+            address = {'cid': enclave['EnclaveCID']}
+        addresses[enclave['EnclaveID']] = address
+    return addresses
+
+
+class NoEnclave(Exception):
+    """No healthy enclave can receive a request"""
+
+
+class Enclave():
+    """Enclave known by the pool"""
+    def __init__(self, enclave_id: str, address: dict):
+        self.id = enclave_id  # pylint: disable=invalid-name
+        self.address = address
+        self.outstanding = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        """Return True if the enclave receives requests"""
+        return self.failures < ENCLAVE_MAX_FAILURES
+
+    def status(self) -> dict:
+        """Return the state of the enclave"""
+        return {'id': self.id, 'healthy': self.healthy, 'outstanding': self.outstanding,
+                'failures': self.failures}
+
+
+class EnclavePool():
+    """Enclaves available to process requests.
+
+    Args:
+        discover (Discover): Function returning the address of the running enclaves
+            by enclave ID.
+        interval (float, optional): Seconds between two discoveries and health checks.
+            Defaults to ENCLAVE_HEALTH_INTERVAL.
+    """
+    def __init__(self, discover: Discover, interval: float = ENCLAVE_HEALTH_INTERVAL):
+        self._discover = discover
+        self._interval = interval
+        self._enclaves: Dict[str, Enclave] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.refresh()
+
+    def refresh(self):
+        """Add the enclaves started and remove those stopped since the last discovery"""
+        addresses = self._discover()
+        with self._lock:
+            for enclave_id in list(self._enclaves):
+                if enclave_id not in addresses:
+                    logger.info('Enclave removed', enclave=enclave_id)
+                    del self._enclaves[enclave_id]
+            for enclave_id, address in addresses.items():
+                if enclave_id not in self._enclaves:
+                    logger.info('Enclave added', enclave=enclave_id, **address)
+                    self._enclaves[enclave_id] = Enclave(enclave_id, address)
+                else:
+                    self._enclaves[enclave_id].address = address
+
+    def status(self) -> List[dict]:
+        """Return the state of each enclave"""
+        with self._lock:
+            return [enclave.status() for enclave in self._enclaves.values()]
+
+    def acquire(self, candidates: Optional[Iterable[str]] = None,
+                exclude: Iterable[str] = ()) -> Enclave:
+        """Choose the healthy enclave with the least outstanding requests and count
+        the request as outstanding until release is called.
+
+        Args:
+            candidates (Iterable[str], optional): IDs of the enclaves that can process
+                the request, any enclave if None.
+            exclude (Iterable[str], optional): IDs of the enclaves not to choose
+                (e.g., already tried).
+
+        Raises:
+            NoEnclave: If none of the candidates is healthy.
+        """
+        with self._lock:
+            enclaves = [enclave for enclave in self._enclaves.values()
+                        if enclave.healthy and enclave.id not in exclude
+                        and (candidates is None or enclave.id in candidates)]
+            if not enclaves:
+                raise NoEnclave('Cannot find an enclave to connect to')
+            enclave = min(enclaves, key=lambda enclave: enclave.outstanding)
+            enclave.outstanding += 1
+            return enclave
+
+    def release(self, enclave: Enclave, failed: bool = False):
+        """End a request sent to an enclave.
+
+        Args:
+            enclave (Enclave): Enclave returned by acquire.
+            failed (bool, optional): True if the enclave could not be reached.
+        """
+        with self._lock:
+            enclave.outstanding -= 1
+        self._record(enclave, failed, 'request')
+
+    def check(self):
+        """Send a health request to each enclave, all at once so that a stuck enclave
+        does not delay the checks of the others"""
+        with self._lock:
+            enclaves = list(self._enclaves.values())
+        if not enclaves:
+            return
+        with ThreadPoolExecutor(max_workers=len(enclaves),
+                                thread_name_prefix='enclave-health') as executor:
+            # Wait for all the checks, and raise their unexpected errors
+            list(executor.map(self._check, enclaves))
+
+    def _check(self, enclave: Enclave):
+        """Send a health request to an enclave, a timeout counts as a failure"""
+        try:
+            send_request_to_enclave(action='health', timeout=ENCLAVE_HEALTH_TIMEOUT,
+                                    **enclave.address)
+            failed = False
+        except (OSError, ValueError) as error:
+            logger.debug('Health check failed', enclave=enclave.id, reason=error)
+            failed = True
+        self._record(enclave, failed, 'health')
+
+    def start(self):
+        """Discover and check the enclaves periodically, in the background"""
+        threading.Thread(target=self._monitor, name='enclave-monitor', daemon=True).start()
+
+    def stop(self):
+        """Stop the background discovery and health checks"""
+        self._stopped.set()
+
+    def _monitor(self):
+        """Discover and check the enclaves until stopped"""
+        while not self._stopped.wait(self._interval):
+            try:
+                self.refresh()
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot monitor enclaves')
+
+    def _record(self, enclave: Enclave, failed: bool, reason: str):
+        """Update the consecutive failures of an enclave"""
+        with self._lock:
+            healthy = enclave.healthy
+            if failed:
+                enclave.failures += 1
+            else:
+                enclave.failures = 0
+        if failed:
+            FAILURES.inc(enclave=enclave.id, reason=reason)
+        if healthy and not enclave.healthy:
+            logger.warning('Enclave unhealthy, no longer receiving requests', enclave=enclave.id)
+        elif not healthy and enclave.healthy:
+            logger.info('Enclave healthy again', enclave=enclave.id)
+
+
+def route_parameter(parameter: any, enclave_id: str) -> any:
+    """Keep only the AES key wrapped for the chosen enclave in an encrypted parameter.
+
+    Args:
+        parameter (any): Parameter of a request, encrypted for one or several enclaves.
+        enclave_id (str): ID of the enclave receiving the request.
+
+    Returns:
+        any: Parameter with the encrypted_key of the enclave.
+    """
+    if isinstance(parameter, dict) and 'encrypted_keys' in parameter:
+        parameter = dict(parameter)
+        parameter['encrypted_key'] = parameter.pop('encrypted_keys')[enclave_id]
+    return parameter
@@ -0,0 +1,165 @@
+"""
+AWS Nitro Test
+
+Encryption of the requests sent to the enclave and decryption of its responses. The
+AES key of each request is wrapped with the RSA public key of the enclave, from its
+attestation document. Kept apart from common/messages.py so that the parent and the
+bastion, which only forward ciphertexts, do not load PyCryptodome and the codecs.
+"""
+from typing import Dict, Tuple, Union
+
+import cbor2
+
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+from common.compression import compress, decompress
+from common.config import COMPRESSION_CODECS, MAX_RESPONSE_BYTES
+from common.log import StageTimer
+from common.messages import send_request_to_enclave, EnclaveError
+
+
+def encrypt(public_key: bytes, plaintext: bytes) -> bytes:
+    """Encrypt message using public key in attestation document
+
+    Args:
+        public_key (bytes): RSA public key
+        plaintext (bytes): Data bytes to be encrypted
+
+    Returns:
+        str: Plaintext data bytes encrypted with the RSA public key
+    """
+    public_key = RSA.import_key(public_key)
+    cipher = PKCS1_OAEP.new(public_key)
+    ciphertext = cipher.encrypt(plaintext)
+
+    return ciphertext
+
+
+def send_encrypted_message(public_key: Union[bytes, Dict[str, bytes]], action: str='',
+                           parameter: any=None, cid: int=0, host: str='', api: str='',
+                           request_id: str='', timer: StageTimer=None,
+                           compression: Tuple[str, ...]=COMPRESSION_CODECS,
+                           priority: str='', deadline: float=0, port: int=0,
+                           enclave: str='') -> any:
+    """Send encrypted message to a URL. It generates a random symmetric encryption
+    key that is encrypted with the provided public key (e.g., of the enclave).
+
+    Args:
+        action (str): Request type string recognised by the server
+        parameter (any): Data object to be sent
+        public_key (Union[bytes, Dict[str, bytes]]): Public key of the server, or public
+            keys of several enclaves by enclave ID. The AES key is then encrypted with
+            each of them and the parent sends the request to one of these enclaves.
+        cid (int): 
+        host (str):
+        url (str): URL of the server API.
+        request_id (str, optional): Identifier of the request. Generated if not set.
+        timer (StageTimer, optional): Timer recording the duration of each stage.
+        compression (Tuple[str, ...], optional): Codecs used to compress the request and
+            accepted for the response, in order of preference. Defaults to COMPRESSION_CODECS.
+        priority (str, optional): Priority class of the request ('interactive' or 'bulk').
+            Chosen by the server if not set.
+        deadline (float, optional): Seconds after which the response is not needed anymore.
+            No deadline if 0.
+        port (int, optional): Port of the enclave simulator. Defaults to SIMULATION_PORT.
+        enclave (str, optional): ID of the enclave the parent must send the request to,
+            e.g., when it is encrypted with the public key of this enclave only. Chosen
+            by the parent if not set.
+
+    Returns:
+        any: Response from the server
+
+    Raises:
+        EnclaveError: If the server returns an error instead of a response.
+    """
+    timer = timer or StageTimer()
+    aes_key, msg_obj = encrypt_parameter(public_key, parameter, compression, timer)
+
+    # Send message to server and wait for response
+    with timer.stage('transport'):
+        resp_obj = send_request_to_enclave(action=action, parameter=msg_obj,
+                                           cid=cid, host=host, api=api, request_id=request_id,
+                                           priority=priority, deadline=deadline, port=port,
+                                           enclave=enclave)
+    if 'error' in resp_obj:
+        raise EnclaveError(resp_obj['error'], resp_obj.get('code', ''),
+                           resp_obj.get('retry_after', 0))
+
+    return decrypt_response(aes_key, resp_obj, timer)
+
+
+def encrypt_parameter(public_key: Union[bytes, Dict[str, bytes]], parameter: any,
+                      compression: Tuple[str, ...] = COMPRESSION_CODECS,
+                      timer: StageTimer = None) -> Tuple[bytes, dict]:
+    """Encrypt the parameter of a request with a random AES key, itself encrypted
+    with the public key of the enclave (or of each enclave).
+
+    Args:
+        public_key (Union[bytes, Dict[str, bytes]]): Public key of the server, or public
+            keys of several enclaves by enclave ID.
+        parameter (any): Data object to be sent.
+        compression (Tuple[str, ...], optional): Codecs used to compress the parameter and
+            accepted for the response, in order of preference. Defaults to COMPRESSION_CODECS.
+        timer (StageTimer, optional): Timer recording the duration of each stage.
+
+    Returns:
+        Tuple[bytes, dict]: AES key, to decrypt the response, and encrypted parameter.
+    """
+    timer = timer or StageTimer()
+
+    # Generate a new random key for AES cipher
+    aes_key = get_random_bytes(32)
+
+    # Encrypt AES key with public key of Enclave
+    with timer.stage('rsa_wrap'):
+        if isinstance(public_key, dict):
+            wrapped_key = {'encrypted_keys': {enclave_id: encrypt(key, aes_key)
+                                              for enclave_id, key in public_key.items()}}
+        else:
+            wrapped_key = {'encrypted_key': encrypt(public_key, aes_key)}
+
+    with timer.stage('compress'):
+        data_cbor, codec = compress(cbor2.dumps(parameter), compression)
+
+    # Encrypt data for the server using the AES key. The codec is authenticated with the data.
+    with timer.stage('aes_encrypt'):
+        cipher = AES.new(aes_key, AES.MODE_EAX)
+        cipher.update(codec.encode())
+        ciphertext, tag = cipher.encrypt_and_digest(data_cbor)
+
+    # Build a message object for the server with element required
+    # for decryption and verification
+    return aes_key, {
+        **wrapped_key,
+        'nonce': cipher.nonce,
+        'tag': tag,
+        'ciphertext': ciphertext,
+        'codec': codec,
+        'accept': list(compression)
+    }
+
+
+def decrypt_response(aes_key: bytes, resp_obj: dict, timer: StageTimer = None) -> any:
+    """Decrypt the response to a request encrypted by encrypt_parameter.
+
+    Args:
+        aes_key (bytes): AES key returned by encrypt_parameter.
+        resp_obj (dict): Response object of the server.
+        timer (StageTimer, optional): Timer recording the duration of each stage.
+
+    Returns:
+        any: Response from the server
+
+    Raises:
+        LimitExceeded: If the decompressed response is larger than MAX_RESPONSE_BYTES.
+    """
+    timer = timer or StageTimer()
+    codec = resp_obj.get('codec', '')
+    with timer.stage('aes_decrypt'):
+        cipher = AES.new(aes_key, AES.MODE_EAX, resp_obj['nonce'])
+        cipher.update(codec.encode())
+        response_obj = cipher.decrypt_and_verify(resp_obj['ciphertext'], resp_obj['tag'])
+    with timer.stage('decompress'):
+        return cbor2.loads(decompress(response_obj, codec, MAX_RESPONSE_BYTES))
@@ -10,11 +10,9 @@ import subprocess
 import cbor2
 
 from click import Option, UsageError
-from cryptography import x509
 
-from common.attestation import check_attestation_document, verify_certificate, verify_pcrs, \
-    verify_signature
 from common.config import ENCLAVE_NAME, MAX_LENGTH
+from common.enclaves import describe_enclaves, enclave_addresses
 
 
 class MutuallyExclusiveOption(Option):
@@ -77,7 +75,9 @@ def get_cid(enclave_name: str = ENCLAVE_NAME) -> int:
     Returns:
         (int): Enclave CID is successful. 0 otherwise.
     """
-    return 16
+    for address in enclave_addresses(describe_enclaves(), enclave_name).values():
+        return address['cid']
+    return 0
 
 
 def verify_enclave(eif_description_file: str, attestation_doc: bytes) -> bytes:
@@ -90,6 +90,13 @@ def verify_enclave(eif_description_file: str, attestation_doc: bytes) -> bytes:
     Returns:
         bytes: RSA public key of the enclave if verification successful
     """
+    # Loaded when an attestation is verified: the server does not need pyOpenSSL, pycose
+    # and cryptography
+    # pylint: disable=import-outside-toplevel
+    from cryptography import x509
+    from common.attestation import check_attestation_document, verify_certificate, \
+        verify_pcrs, verify_signature
+
     # Load COSE Sign1 object
     cose_sign_obj = cbor2.loads(attestation_doc)
 
@@ -0,0 +1,303 @@
+"""
+AWS Nitro Test
+
+Batch jobs processing large corpora through the enclave. The input of a job is
+spooled to disk as NDJSON, split into batches bounded in number of texts and of
+characters, and sent with a fixed number of batches in flight. Failed batches are
+retried and the results are appended to an NDJSON file as batches complete.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from common.config import JOBS_DIR, JOB_BATCH_CHARACTERS, JOB_BATCH_TEXTS, JOB_CONCURRENCY, \
+    JOB_RETRIES, JOB_RETRY_DELAY, JOB_POLL_INTERVAL, JOB_TTL, JOB_MAX_FINISHED
+from common.limits import INVALID, TOO_LARGE
+from common.log import get_logger
+from common.messages import new_request_id, EnclaveError
+
+logger = get_logger('jobs')
+
+# States of a job
+RECEIVING = 'receiving'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Processes a batch of texts with a model and the options of a job, and returns
+# one result per text
+ProcessBatch = Callable[..., List[dict]]
+
+
+def read_texts(path: str) -> Iterator[Tuple[int, Optional[str], str]]:
+    """Read the texts of an NDJSON input. Each line is either an object with a
+    "content" field or a JSON string. A line that is not valid UTF-8 is invalid.
+
+    Yields:
+        Tuple[int, Optional[str], str]: Index of the line, text (None if the line is
+            not valid) and error message.
+    """
+    # Read in binary and decoded line by line, so that a bad byte only fails its line
+    with open(path, 'rb') as file:
+        for index, line in enumerate(file):
+            try:
+                record = json.loads(line.decode('utf-8'))
+                text = record['content'] if isinstance(record, dict) else record
+                if not isinstance(text, str):
+                    raise TypeError('content must be a string')
+                yield index, text, ''
+            except (ValueError, KeyError, TypeError) as error:
+                yield index, None, f'Invalid input line: {error}'
+
+
+def make_batches(texts: Iterator[Tuple[int, Optional[str], str]],
+                 max_texts: int = JOB_BATCH_TEXTS,
+                 max_characters: int = JOB_BATCH_CHARACTERS
+                 ) -> Iterator[Tuple[List[int], List[str], List[Tuple[int, str]]]]:
+    """Group texts into batches of at most max_texts texts and max_characters characters
+    (a longer text is sent alone).
+
+    Yields:
+        Tuple[List[int], List[str], List[Tuple[int, str]]]: Indexes and texts of a batch,
+            and the indexes and errors of the invalid lines read since the last batch.
+    """
+    indexes, batch, errors, characters = [], [], [], 0
+    for index, text, error in texts:
+        if text is None:
+            errors.append((index, error))
+            continue
+        if batch and (len(batch) >= max_texts or characters + len(text) > max_characters):
+            yield indexes, batch, errors
+            indexes, batch, errors, characters = [], [], [], 0
+        indexes.append(index)
+        batch.append(text)
+        characters += len(text)
+    if batch or errors:
+        yield indexes, batch, errors
+
+
+class Job():
+    """Batch job whose input, results and status are stored in its own directory"""
+    def __init__(self, directory: str, model: str, options: dict):
+        self.id = new_request_id()  # pylint: disable=invalid-name
+        self.model = model
+        self.options = options
+        self.directory = os.path.join(directory, self.id)
+        os.makedirs(self.directory)
+        self.input_path = os.path.join(self.directory, 'input.ndjson')
+        self.results_path = os.path.join(self.directory, 'results.ndjson')
+        self.state = RECEIVING
+        self.error = ''
+        self.counts = {'documents': 0, 'processed': 0, 'failed': 0, 'batches': 0, 'retries': 0}
+        self.created = time.time()
+        self.finished = 0.0
+        self._lock = threading.Lock()
+
+    def status(self) -> dict:
+        """Return the status of the job"""
+        with self._lock:
+            return {'id': self.id, 'model': self.model, 'state': self.state,
+                    'error': self.error, 'created': self.created, 'finished': self.finished,
+                    **self.counts}
+
+    def is_finished(self) -> bool:
+        """Return True if the job is done or failed"""
+        return self.state in (DONE, FAILED)
+
+    def write_results(self, records: List[dict], **counts):
+        """Append result records to the results file and update the counts"""
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        with self._lock:
+            with open(self.results_path, 'a', encoding='utf-8') as file:
+                file.write(lines)
+            for name, value in counts.items():
+                self.counts[name] += value
+        self.save_status()
+
+    def finish(self, state: str, error: str = ''):
+        """Set the final state of the job"""
+        with self._lock:
+            self.state = state
+            self.error = error
+            self.finished = time.time()
+        self.save_status()
+
+    def read_results(self, follow: bool = False,
+                     interval: float = JOB_POLL_INTERVAL) -> Iterator[bytes]:
+        """Read the results written so far, as chunks of complete NDJSON lines.
+
+        Args:
+            follow (bool, optional): If True, wait for new results until the job
+                is finished. Defaults to False.
+            interval (float, optional): Seconds between two reads of the results
+                file when following it. Defaults to JOB_POLL_INTERVAL.
+        """
+        while not os.path.exists(self.results_path):
+            if not follow or self.is_finished():
+                return
+            time.sleep(interval)
+        with open(self.results_path, 'rb') as file:
+            pending = b''
+            while True:
+                # Checked before reading so that the last results are not missed
+                finished = self.is_finished()
+                chunk = file.read(65536)
+                if chunk:
+                    pending += chunk
+                    end = pending.rfind(b'\n') + 1
+                    if end:
+                        yield pending[:end]
+                        pending = pending[end:]
+                    continue
+                if not follow or finished:
+                    return
+                time.sleep(interval)
+
+    def save_status(self):
+        """Write the status of the job next to its results"""
+        status = self.status()
+        path = os.path.join(self.directory, 'status.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(status, file)
+        os.replace(path + '.tmp', path)
+
+
+class JobManager():
+    """Create and run batch jobs.
+
+    Args:
+        process_batch (ProcessBatch): Function sending a batch of texts to the enclave.
+            It receives the texts, the model and the options of the job.
+        directory (str, optional): Directory of the jobs. Defaults to JOBS_DIR.
+        concurrency (int, optional): Number of batches in flight per job.
+            Defaults to JOB_CONCURRENCY.
+        retries (int, optional): Number of retries of a failed batch. Defaults to JOB_RETRIES.
+        ttl (float, optional): Seconds during which a finished job is kept. Defaults to
+            JOB_TTL.
+        max_finished (int, optional): Maximum number of finished jobs kept. Defaults to
+            JOB_MAX_FINISHED.
+    """
+    def __init__(self, process_batch: ProcessBatch, directory: str = JOBS_DIR,
+                 concurrency: int = JOB_CONCURRENCY, retries: int = JOB_RETRIES,
+                 ttl: float = JOB_TTL, max_finished: int = JOB_MAX_FINISHED):
+        self._process_batch = process_batch
+        self._directory = directory
+        self._concurrency = concurrency
+        self._retries = retries
+        self._ttl = ttl
+        self._max_finished = max_finished
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def create(self, model: str, **options) -> Job:
+        """Create a job whose input is then written to job.input_path.
+
+        Args:
+            model (str): NER model of the job.
+            options: Options passed to process_batch (e.g., html).
+
+        Returns:
+            Job: New job.
+        """
+        self.evict()
+        job = Job(self._directory, model, options)
+        with self._lock:
+            self._jobs[job.id] = job
+        job.save_status()
+        logger.info('Job created', job=job.id, model=model)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return a job from its ID, None if it does not exist."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def evict(self):
+        """Delete the jobs finished more than ttl seconds ago, the oldest finished jobs
+        beyond max_finished and the jobs still receiving their input ttl seconds after
+        their creation, with their directory"""
+        expiry = time.time() - self._ttl
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values() if job.is_finished()),
+                              key=lambda job: job.finished)
+            evicted = [job for index, job in enumerate(finished) if job.finished < expiry
+                       or index < len(finished) - self._max_finished]
+            # Uploads that never completed nor failed
+            evicted += [job for job in self._jobs.values()
+                        if job.state == RECEIVING and job.created < expiry]
+            for job in evicted:
+                del self._jobs[job.id]
+        for job in evicted:
+            # A result stream still open keeps reading the deleted file
+            shutil.rmtree(job.directory, ignore_errors=True)
+            logger.info('Job deleted', job=job.id, finished=job.finished)
+
+    def start(self, job: Job):
+        """Start processing a job whose input is complete, in the background."""
+        with job._lock:  # pylint: disable=protected-access
+            job.state = RUNNING
+        threading.Thread(target=self._run, args=(job,), name=f'job-{job.id}',
+                         daemon=True).start()
+
+    def _run(self, job: Job):
+        """Send the batches of a job, with at most concurrency batches in flight"""
+        in_flight = threading.BoundedSemaphore(self._concurrency)
+        try:
+            with ThreadPoolExecutor(max_workers=self._concurrency,
+                                    thread_name_prefix=f'job-{job.id[:8]}') as executor:
+                for indexes, texts, errors in make_batches(read_texts(job.input_path)):
+                    if errors:
+                        job.write_results([{'index': index, 'error': error}
+                                           for index, error in errors],
+                                          documents=len(errors), failed=len(errors))
+                    if not texts:
+                        continue
+                    in_flight.acquire()
+                    future = executor.submit(self._send, job, indexes, texts)
+                    future.add_done_callback(lambda _: in_flight.release())
+            job.finish(DONE)
+            logger.info('Job done', **job.status())
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception('Job failed', job=job.id)
+            job.finish(FAILED, str(error))
+
+    def _send(self, job: Job, indexes: List[int], texts: List[str]):
+        """Send a batch, retrying it on failure and splitting it if it is too large"""
+        delay = JOB_RETRY_DELAY
+        for attempt in range(self._retries + 1):
+            try:
+                results = self._process_batch(texts, job.model, **job.options)
+                job.write_results([{'index': index, **result}
+                                   for index, result in zip(indexes, results)],
+                                  documents=len(texts), processed=len(texts), batches=1,
+                                  retries=attempt)
+                return
+            except EnclaveError as error:
+                if error.code == TOO_LARGE and len(texts) > 1:
+                    middle = len(texts) // 2
+                    logger.info('Splitting batch', job=job.id, texts=len(texts))
+                    self._send(job, indexes[:middle], texts[:middle])
+                    self._send(job, indexes[middle:], texts[middle:])
+                    return
+                reason = error
+                if error.code in (TOO_LARGE, INVALID):
+                    # A text too large on its own, or an invalid batch, fails again
+                    logger.warning('Batch rejected', job=job.id, texts=len(texts),
+                                   reason=reason, code=error.code)
+                    break
+                delay = max(delay, error.retry_after)
+            except Exception as error:  # pylint: disable=broad-except
+                reason = error
+            logger.warning('Batch failed', job=job.id, texts=len(texts), attempt=attempt,
+                           reason=reason)
+            if attempt < self._retries:
+                time.sleep(delay)
+                delay *= 2
+        job.write_results([{'index': index, 'error': str(reason)} for index in indexes],
+                          documents=len(texts), failed=len(texts), batches=1,
+                          retries=attempt)
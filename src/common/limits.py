@@ -0,0 +1,158 @@
+"""
+AWS Nitro Test
+
+Limits on the size of the requests and on the number of requests processed at
+the same time. Requests beyond the limits are rejected as early as possible, before
+their body is parsed or decrypted, and the rejections are counted per hop. The codes
+of the errors and the priority classes of the requests are shared by all the tiers.
+"""
+import json
+import threading
+import time
+
+from common.config import MAX_REQUEST_BYTES, MAX_CONCURRENT_REQUESTS, RETRY_AFTER
+from common.metrics import counter, Counter
+
+# Codes of the errors returned by the enclave instead of a response
+BUSY = 'busy'
+DEADLINE = 'deadline'
+TOO_LARGE = 'too_large'
+INVALID = 'invalid'
+INTERNAL = 'internal'
+
+# Priority classes of the requests in the enclave, from the most to the least urgent.
+# Control-plane actions are always CONTROL; clients may ask for INTERACTIVE or BULK
+CONTROL = 'control'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (CONTROL, INTERACTIVE, BULK)
+
+
+class LimitExceeded(Exception):
+    """A request exceeds one of the limits"""
+    def __init__(self, limit: str, message: str, retry_after: int = 0):
+        super().__init__(message)
+        # Name of the limit: bytes, texts, characters, concurrency, attestation or control
+        self.limit = limit
+        # Seconds after which the request may be retried, 0 if it should not
+        self.retry_after = retry_after
+
+
+class RateLimiter():
+    """Token bucket allowing rate events per second on average and bursts of burst
+    events. Thread-safe.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Take a token if one is available and return True, otherwise return False"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def rejected_counter(hop: str) -> Counter:
+    """Get the counter of the requests rejected by a hop, labelled by limit"""
+    return counter(f'nitro_{hop}_rejected_total',
+                   f'Requests rejected by the {hop} because they exceed a limit', ('limit',))
+
+
+class LimitMiddleware():
+    """ASGI middleware rejecting the POST requests larger than max_bytes with HTTP 413
+    and those beyond max_concurrent requests in progress with HTTP 503 and a
+    Retry-After header. A request whose Content-Length is too large is rejected before
+    its body is read. The bytes of the others, e.g., chunked uploads without
+    Content-Length, are counted while the application reads them: beyond max_bytes,
+    the application stops reading as if the client had disconnected and its response
+    is replaced by the 413. Requests whose path starts with one of exempt_paths are
+    streamed without byte limit and only counted against max_concurrent.
+    """
+    def __init__(self, app, hop: str, max_bytes: int = MAX_REQUEST_BYTES,
+                 max_concurrent: int = MAX_CONCURRENT_REQUESTS, exempt_paths: tuple = ()):
+        self.app = app
+        self.exempt_paths = tuple(exempt_paths)
+        self.max_bytes = max_bytes
+        self.max_concurrent = max_concurrent
+        self.rejected = rejected_counter(hop)
+        # Requests in progress. The middleware runs in the event loop, no lock is needed.
+        self.in_flight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        length = headers.get(b'content-length', b'')
+        exempt = scope['path'].startswith(self.exempt_paths)
+        if not exempt and length.isdigit() and int(length) > self.max_bytes:
+            await self._reject(send, 413, 'bytes',
+                               f'Request larger than {self.max_bytes} bytes')
+            return
+        if self.in_flight >= self.max_concurrent:
+            await self._reject(send, 503, 'concurrency', 'Too many requests in progress',
+                               RETRY_AFTER)
+            return
+
+        self.in_flight += 1
+        try:
+            if exempt:
+                await self.app(scope, receive, send)
+            else:
+                await self._call_limited(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    async def _call_limited(self, scope, receive, send):
+        """Run the application, rejecting the request once its body exceeds max_bytes"""
+        received, too_large, started = 0, False, False
+
+        async def receive_limited():
+            nonlocal received, too_large
+            if too_large:
+                return {'type': 'http.disconnect'}
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    too_large = True
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def send_limited(message):
+            nonlocal started
+            # The response of the application to the disconnection is dropped
+            if too_large and not started:
+                return
+            started = started or message['type'] == 'http.response.start'
+            await send(message)
+
+        try:
+            await self.app(scope, receive_limited, send_limited)
+        except Exception:  # pylint: disable=broad-except
+            # Raised by the application because of the disconnection
+            if not too_large or started:
+                raise
+        if too_large and not started:
+            await self._reject(send, 413, 'bytes', f'Request larger than {self.max_bytes} bytes')
+
+    async def _reject(self, send, status: int, limit: str, reason: str, retry_after: int = 0):
+        """Send an error response"""
+        self.rejected.inc(limit=limit)
+        body = json.dumps({'reason': reason}).encode()
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode())]
+        if retry_after:
+            headers.append((b'retry-after', str(retry_after).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
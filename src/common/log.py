@@ -0,0 +1,130 @@
+"""
+AWS Nitro Test
+
+Structured, level-gated logging. Fields are only formatted when a record is
+actually emitted so that disabled levels cost a single level check on hot paths.
+"""
+import logging
+import reprlib
+import sys
+import time
+
+from contextlib import contextmanager
+
+from common.config import LOG_LEVEL, MAX_LENGTH
+
+
+class Truncated():
+    """Lazy wrapper around a value that is rendered with bounded length and depth
+    only when the log record is formatted."""
+    __slots__ = ('value',)
+
+    _repr = reprlib.Repr()
+    _repr.maxstring = MAX_LENGTH
+    _repr.maxother = MAX_LENGTH
+    _repr.maxlevel = 3
+
+    def __init__(self, value: any):
+        self.value = value
+
+    def __str__(self) -> str:
+        return self._repr.repr(self.value)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as a timestamp, level, logger name, event and key=value fields"""
+    def format(self, record: logging.LogRecord) -> str:
+        line = f'{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}'
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class StructuredLogger():
+    """Thin wrapper around a standard logger taking an event name and keyword fields.
+
+    Fields are attached to the record as-is and only converted to strings by the
+    formatter, so wrap expensive values in Truncated rather than formatting them.
+    """
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(name)
+
+    def is_enabled(self, level: int) -> bool:
+        """Return True if records of the given level would be emitted"""
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level: int, event: str, **fields):
+        """Log an event with structured fields if the level is enabled"""
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields})
+
+    def debug(self, event: str, **fields):
+        """Log an event at DEBUG level"""
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, **fields):
+        """Log an event at INFO level"""
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, **fields):
+        """Log an event at WARNING level"""
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, **fields):
+        """Log an event at ERROR level"""
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event: str, **fields):
+        """Log an event at ERROR level with the current exception traceback"""
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(event, exc_info=True, extra={'fields': fields})
+
+
+class StageTimer():
+    """Collect the wall-clock duration of the stages of a single request.
+
+    Durations of a stage entered several times are accumulated.
+    """
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block as stage `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def fields(self) -> dict:
+        """Return the stage durations as log fields in milliseconds"""
+        return {f'{name}_ms': round(duration * 1000, 3) for name, duration in self.timings.items()}
+
+
+def get_logger(name: str) -> StructuredLogger:
+    """Get a structured logger.
+
+    Args:
+        name (str): Name of the logger, usually the component (e.g., 'server').
+
+    Returns:
+        StructuredLogger: Logger wrapper.
+    """
+    return StructuredLogger(name)
+
+
+def configure_logging(level: str = LOG_LEVEL) -> None:
+    """Send log records to the console with the structured format.
+
+    Args:
+        level (str, optional): Minimum level to emit. Defaults to LOG_LEVEL.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(StructuredFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
@@ -3,103 +3,195 @@ AWS Nitro Test
 
 Utility function for exchanging messages ove vsock with AWS Nitro Enclave
 """
+import asyncio
 import base64
+import itertools
 import json
-import pprint
 import socket
+import struct
+import uuid
+
+from typing import Dict, Tuple
 
-import requests
 import cbor2
 
-from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
+from common.config import VSOCK_PORT, SIMULATION_PORT, DEFAULT_TIMEOUT
+from common.limits import LimitExceeded, BUSY, TOO_LARGE
+from common.log import get_logger, Truncated
 
-from common.config import VSOCK_PORT, DEFAULT_TIMEOUT
-from common.helper import pprint
+logger = get_logger('messages')
 
-def encrypt(public_key: bytes, plaintext: bytes) -> bytes:
-    """Encrypt message using public key in attestation document
 
-    Args:
-        public_key (bytes): RSA public key
-        plaintext (bytes): Data bytes to be encrypted
+def new_request_id() -> str:
+    """Generate an identifier carried end to end with a request so that its
+    stages can be lined up across the client, bastion, parent and enclave.
 
     Returns:
-        str: Plaintext data bytes encrypted with the RSA public key
+        str: Random request identifier.
     """
-    public_key = RSA.import_key(public_key)
-    cipher = PKCS1_OAEP.new(public_key)
-    ciphertext = cipher.encrypt(plaintext)
+    return uuid.uuid4().hex
+
+
+class EnclaveError(Exception):
+    """Error returned by the enclave instead of a response (e.g., deadline exceeded)"""
+    def __init__(self, message: str, code: str='', retry_after: int=0):
+        super().__init__(message)
+        # Code of the error (see common/limits.py)
+        self.code = code
+        # Seconds after which the request may be retried, 0 if it should not
+        self.retry_after = retry_after
 
-    return ciphertext
 
-def send_encrypted_message(public_key: bytes, action: str='', parameter: any=None,
-                           cid: int=0, host: str='', api: str='') -> any:
-    """Send encrypted message to a URL. It generates a random symmetric encryption
-    key that is encrypted with the provided public key (e.g., of the enclave).
+# Header of the frames exchanged over vsock: length of the CBOR envelope and of the raw data
+FRAME_HEADER = struct.Struct('!II')
+
+
+def recv_exact(soc: socket.socket, view: memoryview) -> None:
+    """Receive data from a socket until a buffer is full.
 
     Args:
-        action (str): Request type string recognised by the server
-        parameter (any): Data object to be sent
-        public_key (bytes): Public key of the server
-        cid (int): 
-        host (str):
-        url (str): URL of the server API.
+        soc (socket.socket): Connected socket.
+        view (memoryview): Writable buffer to fill.
+
+    Raises:
+        ConnectionError: If the peer closes the connection before the buffer is full.
+    """
+    received = 0
+    while received < len(view):
+        count = soc.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('Connection closed before the end of the frame')
+        received += count
+
+
+def send_frame(soc: socket.socket, envelope: dict, data: bytes=b'') -> int:
+    """Send a frame made of a CBOR encoded envelope followed by raw data. The data,
+    typically a ciphertext, is sent as is without being copied into the envelope.
+
+    Args:
+        soc (socket.socket): Connected socket.
+        envelope (dict): Object encoded with CBOR.
+        data (bytes, optional): Raw data sent after the envelope. Defaults to b''.
 
     Returns:
-        any: Response from the server
+        int: Size of the frame.
     """
-    # Generate a new random key for AES cipher
-    aes_key = get_random_bytes(32)
-
-    # Encrypt AES key with public key of Enclave
-    encrypted_aes_key = encrypt(public_key, aes_key)
-
-    # Encrypt data for the server using the AES key
-    cipher = AES.new(aes_key, AES.MODE_EAX)
-    data_cbor = cbor2.dumps(parameter)
-    ciphertext, tag = cipher.encrypt_and_digest(data_cbor)
-
-    # Build a message object for the server with element required
-    # for decryption and verification
-    msg_obj = {
-        'encrypted_key': encrypted_aes_key,
-        'nonce': cipher.nonce,
-        'tag': tag,
-        'ciphertext': ciphertext
+    envelope_cbor = cbor2.dumps(envelope)
+    buffers = [memoryview(FRAME_HEADER.pack(len(envelope_cbor), len(data))),
+               memoryview(envelope_cbor), memoryview(data).cast('B')]
+    size = sum(len(buffer) for buffer in buffers)
+    while buffers:
+        sent = soc.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+    return size
+
+
+class FrameReceiver():
+    """Receive frames sent with send_frame into a buffer reused from one frame to the
+    next. The data of a frame is returned as a view of the buffer that is only valid
+    until the next frame is received.
+    """
+    def __init__(self, size: int=65536):
+        self._header = bytearray(FRAME_HEADER.size)
+        self._buffer = bytearray(size)
+
+    def receive(self, soc: socket.socket, max_size: int=0) -> Tuple[dict, memoryview]:
+        """Receive a frame.
+
+        Args:
+            soc (socket.socket): Connected socket.
+            max_size (int, optional): Maximum size of the frame, no limit if 0.
+
+        Returns:
+            Tuple[dict, memoryview]: Decoded envelope and writable view of the raw data.
+
+        Raises:
+            LimitExceeded: If the frame is larger than max_size. Its content is not received.
+        """
+        recv_exact(soc, memoryview(self._header))
+        envelope_size, data_size = FRAME_HEADER.unpack(self._header)
+        size = envelope_size + data_size
+        if max_size and size > max_size:
+            raise LimitExceeded('bytes', f'Request larger than {max_size} bytes')
+        if size > len(self._buffer):
+            # Views of the previous buffer may still be alive so it cannot be resized
+            self._buffer = bytearray(size)
+        view = memoryview(self._buffer)[:size]
+        recv_exact(soc, view)
+        return cbor2.loads(view[:envelope_size]), view[envelope_size:]
+
+
+def encode_request(action: str, parameter: any=None, request_id: str='', priority: str='',
+                   deadline: float=0, enclave: str='') -> dict:
+    """Build the envelope of a request (see send_request_to_enclave for the arguments)"""
+    request = {
+        'action': action,
+        'parameter': parameter,
+        'request_id': request_id or new_request_id()
     }
+    if priority:
+        request['priority'] = priority
+    if deadline:
+        request['deadline'] = deadline
+    if enclave:
+        request['enclave'] = enclave
+    return request
+
 
-    # Send message to server and wait for response
-    resp_obj = send_request_to_enclave(action=action, parameter=msg_obj,
-                                       cid=cid, host=host, api=api)
+def split_ciphertext(request: dict) -> Tuple[dict, bytes]:
+    """Take the ciphertext of an encrypted request out of its envelope, to be sent
+    after it as raw data.
 
-    # Decrypt the response
-    cipher = AES.new(aes_key, AES.MODE_EAX, resp_obj['nonce'])
-    response_obj = cipher.decrypt_and_verify(resp_obj['ciphertext'], resp_obj['tag'])
+    Args:
+        request (dict): Request built by encode_request.
 
-    return cbor2.loads(response_obj)
+    Returns:
+        Tuple[dict, bytes]: Envelope and ciphertext, b'' if the request is not encrypted.
+    """
+    parameter = request['parameter']
+    if not (isinstance(parameter, dict) and 'ciphertext' in parameter):
+        return request, b''
+    parameter = dict(parameter)
+    ciphertext = parameter.pop('ciphertext')
+    return dict(request, parameter=parameter), ciphertext
 
 
-def get_attestation(cid: int=0, host: str='', api: str='') -> bytes:
+def get_attestation(cid: int=0, host: str='', api: str='', port: int=0,
+                    enclave: str='', nonce: bytes=b'') -> bytes:
     """Request attestation from the server running in the Nitro enclave.
 
     Args:
         cid (int, optional): Context identifier of the Nitro enclave. Default to 0.
         host (str, optional): Host address of the enclave simulator. Default to ''.
         url (str, optional): URL of the server API. Default to ''.
+        port (int, optional): Port of the enclave simulator. Defaults to SIMULATION_PORT.
+        enclave (str, optional): ID of the enclave behind the parent. Any if not set.
+        nonce (bytes, optional): Fresh nonce to include in the attestation document. The
+            enclave returns a cached document if not set and rate limits the documents
+            with a nonce.
+
+    Raises:
+        EnclaveError: If the enclave rejects the request.
 
     Returns:
         bytes: Attestation document.
     """
-    response = send_request_to_enclave(action='get-attestation', parameter='',
-                                       cid=cid, host=host, api=api)
+    response = send_request_to_enclave(action='get-attestation',
+                                       parameter={'nonce': nonce} if nonce else '',
+                                       cid=cid, host=host, api=api, port=port, enclave=enclave)
+    if response and 'error' in response:
+        raise EnclaveError(response['error'], response.get('code', ''),
+                           response.get('retry_after', 0))
 
     if not response:
         print('Unable to get attestation. Cannot continue.')
         exit(0)
-    attestation_doc = response['data']
-    pprint(base64.b64encode(attestation_doc).decode(), 'Base64 encoded attestation')
+    attestation_doc = response['attestation']
+    logger.debug('Base64 encoded attestation',
+                 attestation=Truncated(base64.b64encode(attestation_doc).decode()))
 
     if 'private_key' in response:
         # Displays the private key
@@ -109,7 +201,9 @@ def get_attestation(cid: int=0, host: str='', api: str='') -> bytes:
 
 
 def send_request_to_enclave(action: str, parameter: any=None, cid:int=0,
-                            host:str='', api: str='') -> any:
+                            host:str='', api: str='', request_id: str='',
+                            priority: str='', deadline: float=0, port: int=0,
+                            enclave: str='', timeout: float=DEFAULT_TIMEOUT) -> any:
     """Send a request and optional parameter to a Nitro enclave specified
     by its context identifier (CID), the IP address of the enclave simulator
     or the API URL of a server.
@@ -120,6 +214,18 @@ def send_request_to_enclave(action: str, parameter: any=None, cid:int=0,
         cid (int, optional): context identifier of the Nitro enclave. Default to 0.
         host (str, optional): Host address of the enclave simulator. Default to ''.
         url (str, optional): URL of the server API. Default to ''.
+        request_id (str, optional): Identifier of the request. Generated if not set.
+        priority (str, optional): Priority class of the request. Chosen by the server if not set.
+        deadline (float, optional): Seconds after which the response is not needed anymore.
+            No deadline if 0.
+        port (int, optional): Port of the enclave simulator. Defaults to SIMULATION_PORT.
+        enclave (str, optional): ID of the enclave the parent must send the request to.
+            Chosen by the parent if not set.
+        timeout (float, optional): Seconds to wait for the connection and for each read
+            or write of the socket, or for the HTTP response. Defaults to DEFAULT_TIMEOUT.
+
+    Raises:
+        socket.timeout: If the enclave does not answer within the timeout (an OSError).
 
     Returns:
         any: response from the Nitro enclave.
@@ -127,33 +233,184 @@ def send_request_to_enclave(action: str, parameter: any=None, cid:int=0,
     assert(cid or host or api)
 
     # Encode the request and parameter
-    payload_cbor = cbor2.dumps({
-        'action': action,
-        'parameter': parameter
-    })
-
-    # Send them to the server
-    # Create a vsock socket object
-    soc = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
-
-    # Connect to the server running in the Nitro enclave
-    soc.connect((cid, VSOCK_PORT))
-
-    pprint(payload_cbor, 'Payload')
-    soc.send(base64.b64encode(payload_cbor))
-    pprint(f'Sent request to {cid if cid else host}')
-    # Receive the response from the server
-    payload_b64 = soc.recv(65536)
+    request = encode_request(action, parameter, request_id, priority, deadline, enclave)
+
+    if api:
+        # Only the client and the benchmarks send requests through an HTTP API: the parent
+        # does not load requests
+        import requests  # pylint: disable=import-outside-toplevel
+
+        payload_cbor = cbor2.dumps(request)
+        logger.debug('Payload', payload=Truncated(payload_cbor))
+        payload_b64 = base64.b64encode(payload_cbor)
+
+        # Send them to the bastion or the parent through their HTTP API
+        response = requests.post(api, json={'payload': payload_b64.decode()},
+                                 headers={'X-Request-ID': request['request_id']},
+                                 timeout=timeout)
+        if response.status_code in (413, 503):
+            # Rejected by the bastion or the parent because of a limit
+            raise EnclaveError(response.json().get('reason', response.reason),
+                               TOO_LARGE if response.status_code == 413 else BUSY,
+                               int(response.headers.get('Retry-After', 0)))
+        response.raise_for_status()
+        body = response.json()
+        # The parent returns its JSON response as a string
+        if isinstance(body, str):
+            body = json.loads(body)
+        logger.debug('Base64 encoded payload', payload=Truncated(body['payload']))
+
+        # Decode the response from the server
+        response = cbor2.loads(base64.b64decode(body['payload']))
+    else:
+        if cid:
+            # Create a vsock socket object to connect to the server running in the Nitro enclave
+            soc = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)  # pylint: disable=no-member
+            address = (cid, VSOCK_PORT)
+        else:
+            # Connect to the enclave simulator
+            soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (host, port or SIMULATION_PORT)
+        # A stuck enclave must not block the caller (e.g., the health checks) forever
+        soc.settimeout(timeout)
+        try:
+            soc.connect(address)
+            size = send_frame(soc, *split_ciphertext(request))
+            logger.debug('Sent request', action=action, to=cid if cid else host, size=size)
+
+            # Receive the response from the server
+            response, data = FrameReceiver(0).receive(soc)
+            if data:
+                response['ciphertext'] = bytes(data)
+        finally:
+            # Close the connection with the server
+            soc.close()
+
+    logger.debug('Response', response=Truncated(response))
 
-    # Close the connection with the server
-    soc.close()
-
-    pprint(payload_b64, 'Base64 encoded payload')
+    return response
 
-    response_obj_cbor = base64.b64decode(payload_b64)
 
-    # Decode the response from the server
-    response = cbor2.loads(response_obj_cbor)
-    pprint(response, 'Response')
+class EnclaveClient():
+    """Asynchronous client sending concurrent requests to an enclave over a single
+    connection. Each request is sent in a frame carrying the ID of its stream, and the
+    enclave runs the streams of the connection concurrently: a slow request does not
+    hold back the next ones, and the responses come back in the order they are ready.
+    They are matched with their request by the stream ID. The connection is opened
+    by the first request, and again by the next one when it is lost.
 
-    return response
+    Args:
+        cid (int, optional): Context identifier of the Nitro enclave. Default to 0.
+        host (str, optional): Host address of the enclave simulator. Default to ''.
+        port (int, optional): Port of the enclave simulator. Defaults to SIMULATION_PORT.
+        timeout (float, optional): Seconds to wait for a response. Defaults to DEFAULT_TIMEOUT.
+    """
+    def __init__(self, cid: int=0, host: str='', port: int=0, timeout: float=DEFAULT_TIMEOUT):
+        assert(cid or host)
+        self.cid = cid
+        self.host = host
+        self.port = port or SIMULATION_PORT
+        self.timeout = timeout
+        self._writer = None
+        # Task receiving the responses, referenced until the connection is closed
+        self._receiving = None
+        # Futures of the requests waiting for their response, by stream ID, for each
+        # connection (by writer): a lost connection only fails the requests sent on it
+        self._pending: Dict[asyncio.StreamWriter, Dict[int, asyncio.Future]] = {}
+        self._streams = itertools.count(1)
+        # Created in the event loop of the requests
+        self._connect_lock = None
+
+    async def request(self, action: str, parameter: any=None, request_id: str='',
+                      priority: str='', deadline: float=0) -> any:
+        """Send a request and wait for its response (see send_request_to_enclave for
+        the arguments).
+
+        Raises:
+            ConnectionError: If the connection is lost or rejected before the response
+                is received.
+            asyncio.TimeoutError: If the response is not received within the timeout.
+
+        Returns:
+            any: Response from the Nitro enclave.
+        """
+        writer = await self._connect()
+        stream = next(self._streams)
+        envelope, ciphertext = split_ciphertext(
+            encode_request(action, parameter, request_id, priority, deadline))
+        envelope['stream'] = stream
+        envelope_cbor = cbor2.dumps(envelope)
+        pending = self._pending.get(writer)
+        if pending is None or writer.is_closing():
+            raise ConnectionError('Connection with the enclave closed')
+        future = asyncio.get_event_loop().create_future()
+        pending[stream] = future
+        try:
+            # The frame is written at once, it is never interleaved with another one
+            writer.writelines([FRAME_HEADER.pack(len(envelope_cbor), len(ciphertext)),
+                               envelope_cbor, ciphertext])
+            await writer.drain()
+            logger.debug('Sent request', action=action, to=self.cid or self.host, stream=stream,
+                         size=FRAME_HEADER.size + len(envelope_cbor) + len(ciphertext))
+            response = await asyncio.wait_for(future, self.timeout)
+        finally:
+            pending.pop(stream, None)
+        logger.debug('Response', response=Truncated(response))
+        return response
+
+    async def close(self):
+        """Close the connection, failing the requests waiting for their response"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        """Open the connection if it is not open"""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None:
+                if self.cid:
+                    soc = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)  # pylint: disable=no-member
+                    soc.setblocking(False)
+                    await asyncio.get_event_loop().sock_connect(soc, (self.cid, VSOCK_PORT))
+                    reader, self._writer = await asyncio.open_connection(sock=soc)
+                else:
+                    reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                self._pending[self._writer] = {}
+                self._receiving = asyncio.ensure_future(self._receive(reader, self._writer))
+                logger.debug('Connected to enclave', to=self.cid or self.host)
+        return self._writer
+
+    async def _receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Receive the responses of a connection until it is closed"""
+        error = ConnectionError('Connection with the enclave closed')
+        pending = self._pending[writer]
+        try:
+            while True:
+                envelope_size, data_size = FRAME_HEADER.unpack(
+                    await reader.readexactly(FRAME_HEADER.size))
+                response = cbor2.loads(await reader.readexactly(envelope_size))
+                if data_size:
+                    response['ciphertext'] = await reader.readexactly(data_size)
+                if 'stream' not in response:
+                    # Error about the whole connection, e.g., a frame too large: the
+                    # enclave stops reading it
+                    error = ConnectionError(f'Connection rejected by the enclave: '
+                                            f'{response.get("error", "")}')
+                    break
+                future = pending.get(response.pop('stream'))
+                # The request may have timed out
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, OSError) as reason:
+            logger.debug('Connection with enclave lost', to=self.cid or self.host, reason=reason)
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            del self._pending[writer]
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            pending.clear()
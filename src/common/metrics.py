@@ -0,0 +1,181 @@
+"""
+AWS Nitro Test
+
+Latency histograms, counters and gauges shared by all applications and exported in the
+Prometheus text exposition format
+"""
+import bisect
+import threading
+
+from typing import List
+
+from common.config import METRICS_BUCKETS
+from common.log import StageTimer
+
+# Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+class Histogram():
+    """Cumulative histogram with a fixed list of label names"""
+    def __init__(self, name: str, documentation: str, labelnames: tuple,
+                 buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> counts per bucket (last one is +Inf) followed by the sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """Record one observation for the given label values"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def collect(self) -> List[str]:
+        """Return the histogram in the Prometheus text format"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for key, series in items:
+            labels = ''.join(f'{name}="{value}",' for name, value in zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            labels = labels.rstrip(',')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class Counter():
+    """Monotonic counter with a fixed list of label names"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Label values -> count
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """Increment the counter for the given label values"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def collect(self) -> List[str]:
+        """Return the counter in the Prometheus text format"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._series.items())
+        for key, count in items:
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.labelnames, key))
+            lines.append(f'{self.name}{{{labels}}} {count}')
+        return lines
+
+
+class Gauge(Counter):
+    """Value that can go up and down, with a fixed list of label names"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        """Set the value for the given label values"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._series[key] = value
+
+
+def _register(name: str, factory) -> object:
+    """Get a metric from the registry, creating it with factory on first use"""
+    with _REGISTRY_LOCK:
+        metric = _REGISTRY.get(name)
+        if metric is None:
+            metric = _REGISTRY[name] = factory()
+    return metric
+
+
+def histogram(name: str, documentation: str, labelnames: tuple) -> Histogram:
+    """Get a histogram from the registry, creating it on first use.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text of the metric.
+        labelnames (tuple): Names of the labels of the metric.
+
+    Returns:
+        Histogram: Registered histogram.
+    """
+    return _register(name, lambda: Histogram(name, documentation, labelnames))
+
+
+def counter(name: str, documentation: str, labelnames: tuple) -> Counter:
+    """Get a counter from the registry, creating it on first use.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text of the metric.
+        labelnames (tuple): Names of the labels of the metric.
+
+    Returns:
+        Counter: Registered counter.
+    """
+    return _register(name, lambda: Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: tuple) -> Gauge:
+    """Get a gauge from the registry, creating it on first use.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text of the metric.
+        labelnames (tuple): Names of the labels of the metric.
+
+    Returns:
+        Gauge: Registered gauge.
+    """
+    return _register(name, lambda: Gauge(name, documentation, labelnames))
+
+
+def observe_stages(hop: str, timer: StageTimer, action: str = '', model: str = '') -> None:
+    """Record the stage durations of one request in the stage histogram of a hop.
+
+    Args:
+        hop (str): Name of the application (e.g., 'enclave', 'parent').
+        timer (StageTimer): Timer holding the stage durations of the request.
+        action (str, optional): Action of the request. Defaults to ''.
+        model (str, optional): NER model used by the request. Defaults to ''.
+    """
+    stage_histogram = histogram(f'nitro_{hop}_stage_seconds',
+                                f'Duration of the request processing stages in the {hop}',
+                                ('stage', 'action', 'model'))
+    for stage, duration in timer.timings.items():
+        stage_histogram.observe(duration, stage=stage, action=action, model=model)
+
+
+def export_prometheus() -> str:
+    """Export all registered metrics in the Prometheus text format.
+
+    Returns:
+        str: Metrics exposition.
+    """
+    with _REGISTRY_LOCK:
+        metrics = list(_REGISTRY.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -2,25 +2,35 @@
 AWS Nitro Test
 
 Parent server that forwards requests it receives from the bastion
-to the Nitro enclave via vsock
+to the Nitro enclaves via vsock, balancing the requests across them
 """
 import asyncio
 import base64
 import json
 import os
+import time
+
+from typing import Dict, Tuple
 
-import pprint
 import click
 import cbor2
 import uvicorn
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from starlette.middleware.cors import CORSMiddleware
 
-from common.helper import get_cid
-from common.messages import send_request_to_enclave
-from common.config import ENCLAVE_HOST, PARENT_HOST, PARENT_PORT
+from common.config import PARENT_HOST, PARENT_PORT, SIMULATION_PORT, LOG_LEVEL, \
+    ENCLAVE_HEALTH_TIMEOUT
+from common.enclaves import Enclave, EnclavePool, NoEnclave, describe_enclaves, \
+    describe_simulated_enclaves, enclave_addresses, route_parameter
+from common.limits import LimitMiddleware, BUSY
+from common.messages import EnclaveClient, send_request_to_enclave
+from common.log import configure_logging, get_logger, StageTimer
+from common.metrics import export_prometheus, observe_stages, PROMETHEUS_CONTENT_TYPE
+
+logger = get_logger('parent')
 
 class Message(BaseModel):
     """Basic API message
@@ -30,6 +40,8 @@ class Message(BaseModel):
 # Set up the FastAPI app and define the endpoints
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"])
+# Reject the requests that are too large or beyond the concurrency limit before reading them
+app.add_middleware(LimitMiddleware, hop='parent')
 
 @app.get("/")
 async def root():
@@ -37,8 +49,123 @@ async def root():
     """
     return "Hello from Parent"
 
+
+# Enclaves the requests are forwarded to, discovered when the application starts
+POOL: EnclavePool = None
+# Address and client of each enclave, multiplexing the forwarded requests over one connection
+CLIENTS: Dict[str, Tuple[dict, EnclaveClient]] = {}
+
+
+def discover() -> Dict[str, dict]:
+    """Discover the running Nitro enclaves (or their simulators).
+
+    Returns:
+        Dict[str, dict]: Keyword arguments identifying each enclave for
+            send_request_to_enclave, by enclave ID.
+    """
+    # Hack
+    if os.getenv('NITRO_SIMULATION') == 'True':
+        ports = range(SIMULATION_PORT, SIMULATION_PORT + int(os.getenv('NITRO_ENCLAVES', '1')))
+        return enclave_addresses(describe_simulated_enclaves(ports))
+    return enclave_addresses(describe_enclaves())
+
+
+@app.on_event('startup')
+def start_pool():
+    """Discover the enclaves and check their health in the background"""
+    global POOL  # pylint: disable=global-statement
+    POOL = EnclavePool(discover)
+    POOL.start()
+    logger.info('Enclaves discovered', enclaves=[enclave['id'] for enclave in POOL.status()])
+
+
+@app.get("/metrics", summary="Latency metrics of the parent and of a Nitro enclave",
+         response_class=PlainTextResponse)
+def metrics(enclave: str = ''):
+    """Export the latency histograms of the parent followed by those of an enclave
+    (the least loaded one if not set) in the Prometheus text format.
+    """
+    exposition = export_prometheus()
+    try:
+        target = POOL.acquire([enclave] if enclave else None)
+    except NoEnclave as error:
+        logger.warning('Cannot get enclave metrics', reason=error)
+        return PlainTextResponse(exposition, media_type=PROMETHEUS_CONTENT_TYPE)
+    try:
+        exposition += send_request_to_enclave(action='metrics', timeout=ENCLAVE_HEALTH_TIMEOUT,
+                                              **target.address)['metrics']
+        POOL.release(target)
+    except (OSError, KeyError, ValueError) as error:
+        POOL.release(target, failed=isinstance(error, OSError))
+        logger.warning('Cannot get enclave metrics', enclave=target.id, reason=error)
+    return PlainTextResponse(exposition, media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def enclave_client(enclave: Enclave) -> EnclaveClient:
+    """Return the client of an enclave, created by its first request or when its
+    address changed"""
+    address, client = CLIENTS.get(enclave.id, (None, None))
+    if address != enclave.address:
+        client = EnclaveClient(**enclave.address)
+        CLIENTS[enclave.id] = (dict(enclave.address), client)
+    return client
+
+
+async def send_to_enclave(payload: dict, request_id: str, deadline: float,
+                          start: float) -> dict:
+    """Send a request to the enclave with the least outstanding requests among those
+    it is encrypted for (or the one it names). Another enclave is tried if the chosen
+    one cannot be reached or is busy.
+
+    Args:
+        payload (dict): Decoded request.
+        request_id (str): ID of the request.
+        deadline (float): Seconds left to answer the request when it was received, 0 if none.
+        start (float): Time at which the request was received (time.perf_counter).
+
+    Returns:
+        dict: Response of the enclave.
+
+    Raises:
+        NoEnclave: If no enclave can process the request.
+    """
+    parameter = payload['parameter']
+    if isinstance(parameter, dict) and 'encrypted_keys' in parameter:
+        candidates = set(parameter['encrypted_keys'])
+    elif payload.get('enclave'):
+        candidates = {payload['enclave']}
+    else:
+        candidates = None
+
+    tried, response = [], None
+    while True:
+        try:
+            enclave = POOL.acquire(candidates, tried)
+        except NoEnclave:
+            if response is not None:
+                # Every enclave is busy
+                return response
+            raise
+        tried.append(enclave.id)
+        # Forward what is left of the time budget of the request
+        budget = max(deadline - (time.perf_counter() - start), 1e-3) if deadline else 0
+        try:
+            response = await enclave_client(enclave).request(
+                action=payload['action'], parameter=route_parameter(parameter, enclave.id),
+                request_id=request_id, priority=payload.get('priority', ''), deadline=budget)
+        except (OSError, asyncio.TimeoutError) as error:
+            POOL.release(enclave, failed=True)
+            logger.warning('Cannot reach enclave', enclave=enclave.id, request_id=request_id,
+                           reason=error)
+            continue
+        POOL.release(enclave)
+        if not (isinstance(response, dict) and response.get('code') == BUSY):
+            return response
+        logger.debug('Enclave busy', enclave=enclave.id, request_id=request_id)
+
+
 @app.post("/post/", summary="Forward message to Nitro enclave", response_model=str)
-def forward(message: Message):
+async def forward(message: Message):
     """Decode message and forward to the Nitro enclave for processing
 
     Args:
@@ -47,51 +174,64 @@ def forward(message: Message):
     Returns:
         str: Response from the Nitro enclave
     """
-    # Hack
-    simulate = True if os.getenv('NITRO_SIMULATION') == 'True' else False
-
-    print('Message received:')
-    pprint.PrettyPrinter(indent=4).pprint(message)
-
-    payload_cbor = base64.b64decode(str.encode(message.payload))
-    payload = cbor2.loads(payload_cbor)
-
-    if simulate:
-        print(f'Connecting to {ENCLAVE_HOST}. Sending: {message.payload}')
-        response_obj = send_request_to_enclave(action = payload['action'],
-                                    parameter = payload['parameter'], host=ENCLAVE_HOST)
+    timer = StageTimer()
+    start = time.perf_counter()
+
+    with timer.stage('decode'):
+        payload_cbor = base64.b64decode(str.encode(message.payload))
+        payload = cbor2.loads(payload_cbor)
+    request_id = payload.get('request_id', '')
+
+    logger.debug('Forwarding request', action=payload['action'], request_id=request_id,
+                 size=len(message.payload))
+    if payload['action'] == 'enclaves':
+        # Answered by the parent: the enclaves that the client can attest and encrypt for
+        response_obj = {'enclaves': POOL.status()}
     else:
-        # Get CID of enclave
-        cid = 16
-        if cid == 0:
-            error_msg = "Cannot find an enclave to connect to"
-            print(error_msg)
-            return error_msg
-
-        print(f'Connecting to CID {cid}. Sending: {message.payload}')
-        response_obj = send_request_to_enclave(action = payload['action'],
-                                    parameter = payload['parameter'], cid=cid)
-    print(response_obj)
-    response_obj_cbor = cbor2.dumps(response_obj)
-    response_b64 = base64.b64encode(response_obj_cbor)
-    response = json.dumps({'payload': response_b64.decode()})
+        with timer.stage('enclave'):
+            try:
+                response_obj = await send_to_enclave(payload, request_id,
+                                                     payload.get('deadline', 0), start)
+            except NoEnclave as error:
+                logger.error(str(error), request_id=request_id)
+                raise HTTPException(status_code=503, detail=str(error)) from error
+    with timer.stage('encode'):
+        response_obj_cbor = cbor2.dumps(response_obj)
+        response_b64 = base64.b64encode(response_obj_cbor)
+        response = json.dumps({'payload': response_b64.decode()})
+
+    timer.timings['total'] = time.perf_counter() - start
+    observe_stages('parent', timer, action=payload['action'])
+    logger.debug('Request forwarded', action=payload['action'], request_id=request_id,
+                 size=len(response), **timer.fields())
     return response
 
 
 @click.command()
 @click.option('--simulate', type=bool, default=False,
               help='If set to True, assume the server simulates a Nitro enclave. Default is False.')
-def parent(simulate: bool):
+@click.option('--enclaves', type=int, default=1,
+              help='Number of enclave simulators, listening on consecutive ports from '
+              f'{SIMULATION_PORT}. Only used with --simulate. Default is 1.')
+@click.option('--log-level', type=str, default=LOG_LEVEL,
+              help=f'Log level. Per-request records are logged at DEBUG. Default is {LOG_LEVEL}.')
+def parent(simulate: bool, enclaves: int, log_level: str):
     """Launch parent API server after updating global parameter.
 
     Args:
         simulate (bool): If True, tells the server to communicate with a simulated Nitro enclave.
+        enclaves (int): Number of enclave simulators.
+        log_level (str): Minimum level of the log records to print.
     """
+    configure_logging(log_level)
+
     # Hack to pass argument to routing function
     os.environ['NITRO_SIMULATION'] = 'True' if simulate else 'False'
+    os.environ['NITRO_ENCLAVES'] = str(enclaves)
 
     # Lunch server
-    config = uvicorn.Config("parent:app", port=PARENT_PORT, host=PARENT_HOST, log_level="debug")
+    config = uvicorn.Config("parent:app", port=PARENT_PORT, host=PARENT_HOST,
+                            log_level=log_level.lower())
     server = uvicorn.Server(config)
     asyncio.run(server.serve())
 
@@ -3,20 +3,732 @@ AWS Nitro Test
 
 Server application that runs in a Nitro enclave
 """
-import base64
 import json
+import queue
 import socket
-import pprint
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Callable, Dict, Iterable, List, Tuple
 
 import cbor2
 import click
 
 from Crypto.Cipher import AES
 
-from common.config import BASTION_HOST, VSOCK_PORT
-from common.helper import pprint, MutuallyExclusiveOption
-from server.ner_api import MODELS, MODEL_NAMES, get_data, InputModel, ResponseModel
+from common.authorization import Authorizer
+from common.compact import compact_result
+from common.compression import compress, decompress
+from common.config import BASTION_HOST, VSOCK_PORT, SIMULATION_PORT, LOG_LEVEL, \
+    SERVER_IO_THREADS, ENCLAVE_MAX_STREAMS, MAX_REQUEST_BYTES, \
+    MAX_QUEUED_REQUESTS, RETRY_AFTER, WARM_UP_ROUNDS, PROFILING, OPERATOR_PUBLIC_KEY
+from common.helper import MutuallyExclusiveOption
+from common.limits import LimitExceeded, rejected_counter, BUSY, CONTROL, DEADLINE, INTERNAL, \
+    INVALID, TOO_LARGE
+from common.log import configure_logging, get_logger, StageTimer, Truncated
+from common.encryption import decrypt_response, encrypt_parameter
+from common.messages import FrameReceiver, send_frame
+from common.metrics import counter, export_prometheus, observe_stages
+from server.ner_api import MODEL_NAMES, ModelName, OutputFormat, Query, parse_query, \
+    detect_models, model_status, process_query, reload_model, run_pipeline, warm_up, \
+    MODELS, WARM_UP_TEXTS
 from server.nsmutil import NSMUtil
+from server import profiler
+from server.scheduler import ModelPools, request_deadline, request_priority
+
+logger = get_logger('server')
+
+DROPPED = counter('nitro_enclave_dropped_total', 'Requests dropped by the enclave',
+                  ('reason', 'priority'))
+REJECTED = rejected_counter('enclave')
+# Set once the first process request is answered, which is logged with its stages
+FIRST_REQUEST = threading.Event()
+# Actions whose parameter must be signed by the operators
+OPERATOR_ACTIONS = ('reload-model', 'profile')
+# Checks the operator tokens, with the public key loaded by main. Refuses them until then
+AUTHORIZER = Authorizer(actions=OPERATOR_ACTIONS)
+
+
+class InvalidRequest(ValueError):
+    """A request cannot be decrypted or decoded"""
+
+
+def open_request(request: dict, nsm_util: NSMUtil, timer: StageTimer) -> Tuple[bytes, any]:
+    """Decrypt the parameter of an encrypted request.
+
+    Args:
+        request (dict): Request with the action and its encrypted parameter.
+        nsm_util (NSMUtil): Interface with the Nitro Secure Module.
+        timer (StageTimer): Timer recording the duration of each stage.
+
+    Returns:
+        Tuple[bytes, any]: AES key of the request, used to encrypt the response, and
+            decoded parameter.
+
+    Raises:
+        InvalidRequest: If the parameter cannot be decrypted or decoded.
+    """
+    try:
+        return _open_request(request, nsm_util, timer)
+    except (KeyError, TypeError, ValueError) as error:
+        raise InvalidRequest(f'Cannot open request: {type(error).__name__}') from error
+
+
+def _open_request(request: dict, nsm_util: NSMUtil, timer: StageTimer) -> Tuple[bytes, any]:
+    """Decrypt the parameter of an encrypted request (see open_request)"""
+    # Extract the content of the message
+    msg_obj = request['parameter']
+
+    # Decrypt the encrypted AES key using the private of the server
+    encrypted_aes_key = msg_obj['encrypted_key']
+    with timer.stage('rsa_unwrap'):
+        aes_key = nsm_util.decrypt(encrypted_aes_key)
+
+    # The codec of the request is authenticated with its content
+    codec = msg_obj.get('codec', '')
+    with timer.stage('aes_decrypt'):
+        cipher = AES.new(aes_key, AES.MODE_EAX, msg_obj['nonce'])
+        cipher.update(codec.encode())
+        data_cbor = msg_obj['ciphertext']
+        if isinstance(data_cbor, memoryview):
+            # Decrypt in place in the receive buffer
+            cipher.decrypt(data_cbor, output=data_cbor)
+            cipher.verify(msg_obj['tag'])
+        else:
+            data_cbor = cipher.decrypt_and_verify(data_cbor, msg_obj['tag'])
+    with timer.stage('decompress'):
+        data = cbor2.loads(decompress(data_cbor, codec, MAX_REQUEST_BYTES))
+    return aes_key, data
+
+
+def handle_request(request: dict, nsm_util: NSMUtil, export: bool,
+                   timer: StageTimer, opened: Tuple[bytes, any] = None) -> Tuple[dict, str]:
+    """Process a decoded request and build the response object to send back.
+
+    Args:
+        request (dict): Request with the action and its parameter.
+        nsm_util (NSMUtil): Interface with the Nitro Secure Module.
+        export (bool): If True, the RSA private key is returned with the attestation.
+        timer (StageTimer): Timer recording the duration of each stage.
+        opened (Tuple[bytes, any], optional): AES key and parameter of the request if
+            it is already decrypted. The parameter of a process action may then be
+            a parsed Query.
+
+    Returns:
+        Tuple[dict, str]: Response object and name of the NER model used, if any.
+    """
+    model = ''
+    if request['action'] == 'health':
+        # Answer the health checks of the parent
+        response_obj = {'health': 'ok'}
+
+    elif request['action'] == 'metrics':
+        # Export the latency histograms. They do not contain any data of the requests.
+        response_obj = {'metrics': export_prometheus()}
+
+    elif request['action'] == 'get-attestation':
+        # Generate attestation document
+        # Documents without nonce are cached, those with a nonce are rate limited
+        parameter = request.get('parameter')
+        nonce = parameter.get('nonce', b'') if isinstance(parameter, dict) else b''
+        with timer.stage('attestation'):
+            response_obj = {'attestation': nsm_util.get_attestation_doc(nonce)}
+        if export:
+            response_obj['private_key'] = nsm_util._rsa_key.export_key()  # pylint: disable=protected-access
+
+    else:
+        msg_obj = request['parameter']
+        aes_key, data = opened or open_request(request, nsm_util, timer)
+
+        # Prepare response depending on required action
+        if request['action'] == 'message':
+            # Add some message to the received message
+            response = data + ' - Added by server'
+
+
+        elif request['action'] == 'models':
+            # Provide the list of available NER models
+            response = MODEL_NAMES
+
+        elif request['action'] == 'model-status':
+            # Provide the loaded and available versions of the NER models
+            response = model_status()
+
+        elif request['action'] == 'reload-model':
+            # Load a version of a NER model in the background and swap it in
+            try:
+                data = AUTHORIZER.authorize('reload-model', data)
+                started = reload_model(data['model'], 'request', data.get('version', ''))
+                response = {'started': started, **model_status()[data['model']]}
+            except (KeyError, TypeError, ValueError) as error:
+                response = {'started': False, 'error': str(error)}
+
+        elif request['action'] == 'profile':
+            # Sample the stacks of the server threads in the background
+            try:
+                data = AUTHORIZER.authorize('profile', data)
+                started = profiler.start_profile(float(data['seconds']),
+                                                 bool(data.get('memory', False)))
+                response = {'started': started, **profiler.profile_status()}
+            except (KeyError, TypeError, ValueError) as error:
+                response = {'started': False, 'error': str(error)}
+
+        elif request['action'] == 'profile-result':
+            # Provide the collapsed stacks and allocations of the last profile
+            response = profiler.profile_status()
+
+        elif request['action'] == 'process':
+            if isinstance(data, Query):
+                query = data
+            else:
+                with timer.stage('parse'):
+                    query = parse_query(data)
+            model = query.model.value
+            response = serialize_result(query, process_query(query, timer), timer)
+
+        else:
+            response = 'Unknown action request.'
+
+        response_obj = encrypt_response(response, aes_key, msg_obj.get('accept', ()), timer)
+
+    return response_obj, model
+
+
+def serialize_result(query: Query, results: List[dict], timer: StageTimer) -> any:
+    """Build the response of a process action in the output format of its query"""
+    with timer.stage('serialize'):
+        if query.output == OutputFormat.compact:
+            # Sent as is with CBOR, without the JSON encoding
+            return compact_result(results, query.echo_text)
+        # get_data follows the schema of ResponseModel
+        return json.dumps({"result": results})
+
+
+def encrypt_response(response: any, aes_key: bytes, accept: Iterable[str],
+                     timer: StageTimer) -> dict:
+    """Encrypt the response to a request with the AES key of the request.
+
+    Args:
+        response (any): Response.
+        aes_key (bytes): AES key of the request.
+        accept (Iterable[str]): Compression codecs accepted by the client.
+        timer (StageTimer): Timer recording the duration of each stage.
+
+    Returns:
+        dict: Response object with the nonce, tag, ciphertext and codec.
+    """
+    with timer.stage('compress'):
+        # Encode response with CBOR and compress it with a codec accepted by the client
+        response_cbor, codec = compress(cbor2.dumps(response), accept)
+
+    with timer.stage('aes_encrypt'):
+        # Encrypt the CBOR encoded response
+        cipher = AES.new(aes_key, AES.MODE_EAX)
+        cipher.update(codec.encode())
+        ciphertext, tag = cipher.encrypt_and_digest(response_cbor)
+
+    # Build a message object for the server
+    return {
+        'nonce': cipher.nonce,
+        'tag': tag,
+        'ciphertext': ciphertext,
+        'codec': codec
+    }
+
+
+def receive_request(client_connection: socket.socket, receiver: FrameReceiver,
+                    timer: StageTimer, max_size: int = MAX_REQUEST_BYTES) -> dict:
+    """Receive a request on a connection.
+
+    Args:
+        client_connection (socket.socket): Connection with the client.
+        receiver (FrameReceiver): Receiver of the request, whose buffer is reused.
+        timer (StageTimer): Timer recording the duration of each stage.
+        max_size (int, optional): Maximum size of the request. Defaults to MAX_REQUEST_BYTES.
+
+    Returns:
+        dict: Request. The ciphertext of an encrypted request is a view of the
+            buffer of the receiver.
+
+    Raises:
+        LimitExceeded: If the request is larger than max_size.
+    """
+    # Get command from client. The ciphertext of an encrypted request is
+    # received after the envelope, as a view of the receive buffer.
+    with timer.stage('recv'):
+        request, data = receiver.receive(client_connection, max_size)
+    if data:
+        request['parameter']['ciphertext'] = data
+
+    logger.debug('Received request', action=request['action'],
+                 request_id=request.get('request_id', ''), size=len(data),
+                 priority=request.get('priority', ''), deadline=request.get('deadline', 0))
+    return request
+
+
+class StreamConnection():
+    """Connection multiplexing the requests of the client: each frame carries the ID of
+    its stream, and the response to a request is sent on its stream as soon as it is
+    ready, whatever the order of the requests. At most max_streams requests are in
+    progress at once: beyond, the connection is not read until one of them is answered.
+    The connection is closed once the client closed it and every response is sent.
+
+    Args:
+        connection (socket.socket): Connection with the client.
+        max_streams (int, optional): Maximum number of requests in progress. Defaults
+            to ENCLAVE_MAX_STREAMS.
+    """
+    def __init__(self, connection: socket.socket, max_streams: int = ENCLAVE_MAX_STREAMS):
+        self.connection = connection
+        self._streams = threading.Semaphore(max_streams)
+        # Frames are sent one at a time
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # Users of the connection: its reader and the requests in progress
+        self._users = 1
+
+    def acquire(self):
+        """Wait until a request can be received"""
+        self._streams.acquire()
+        with self._lock:
+            self._users += 1
+
+    def release(self):
+        """End a request received after acquire"""
+        self._streams.release()
+        self.close()
+
+    def send(self, envelope: dict, data: bytes = b'') -> int:
+        """Send a frame (see send_frame)"""
+        with self._send_lock:
+            return send_frame(self.connection, envelope, data)
+
+    def close(self):
+        """Stop using the connection, closed when it is no longer used"""
+        with self._lock:
+            self._users -= 1
+            unused = self._users == 0
+        if unused:
+            self.connection.close()
+
+
+class Reply():
+    """Where the response to a request is sent: its connection, closed once the response
+    is sent, or its stream on a multiplexed connection.
+
+    Args:
+        connection (socket.socket): Connection with the client.
+        streams (StreamConnection, optional): Multiplexed connection of the request, if any.
+        stream (int, optional): ID of the stream of the request on streams. An error
+            without stream ID is about the whole connection.
+    """
+    def __init__(self, connection: socket.socket, streams: StreamConnection = None,
+                 stream: int = None):
+        self.connection = connection
+        self.streams = streams
+        self.stream = stream
+
+    def send(self, envelope: dict, data: bytes = b'') -> int:
+        """Send the response, or an error (see send_frame)"""
+        if self.streams is None:
+            return send_frame(self.connection, envelope, data)
+        if self.stream is not None:
+            envelope = dict(envelope, stream=self.stream)
+        return self.streams.send(envelope, data)
+
+    def close(self):
+        """End the request"""
+        if self.streams is None:
+            self.connection.close()
+        else:
+            self.streams.release()
+
+
+def send_response(reply: Reply, request: dict, response_obj: dict,
+                  model: str, timer: StageTimer, start: float):
+    """Send the response to a request and record its metrics.
+
+    Args:
+        reply (Reply): Where the response is sent.
+        request (dict): Request.
+        response_obj (dict): Response object built by handle_request.
+        model (str): Name of the NER model used, if any.
+        timer (StageTimer): Timer recording the duration of each stage.
+        start (float): Time at which the request was accepted (time.perf_counter).
+    """
+    logger.debug('Response', response=Truncated(response_obj))
+
+    with timer.stage('send'):
+        # Send the CBOR encoded response followed by its ciphertext, if any
+        ciphertext = response_obj.pop('ciphertext', b'')
+        size = reply.send(response_obj, ciphertext)
+
+    timer.timings['total'] = time.perf_counter() - start
+    observe_stages('enclave', timer, action=request['action'], model=model)
+    logger.debug('Request processed', action=request['action'], model=model,
+                 request_id=request.get('request_id', ''), size=size, **timer.fields())
+    if request['action'] == 'process' and not FIRST_REQUEST.is_set():
+        FIRST_REQUEST.set()
+        logger.info('First request processed', model=model, **timer.fields())
+
+
+def send_error(reply: Reply, message: str, code: str, retry_after: int = 0):
+    """Send an error instead of a response. Errors are not encrypted and must not
+    contain any data of the request.
+
+    Args:
+        reply (Reply): Where the response is sent.
+        message (str): Error message.
+        code (str): Error code (see common/limits.py).
+        retry_after (int, optional): Seconds after which the request may be retried.
+            Defaults to 0.
+    """
+    error = {'error': message, 'code': code}
+    if retry_after:
+        error['retry_after'] = retry_after
+    try:
+        reply.send(error)
+    except OSError as reason:
+        logger.warning('Cannot send error', error=message, reason=reason)
+
+
+class Dispatcher():
+    """Receive the requests of accepted connections and schedule them. The control-plane
+    actions are handled on the receiving thread, the other ones are queued in the
+    scheduler of their model. Each connection is closed once its response is sent,
+    unless its requests carry a stream ID: the next requests of such a multiplexed
+    connection are then received on a thread of their own and handled concurrently
+    (see StreamConnection).
+    """
+    def __init__(self, nsm_util: NSMUtil, export: bool, pools: ModelPools):
+        self._nsm_util = nsm_util
+        self._export = export
+        self._pools = pools
+        self._pool = ThreadPoolExecutor(max_workers=SERVER_IO_THREADS,
+                                        thread_name_prefix='receiver')
+        # Receivers not in use, whose buffers are reused by the next requests
+        self._receivers = queue.LifoQueue()
+
+    def dispatch(self, client_connection: socket.socket, addr: tuple):
+        """Receive and schedule the request of an accepted connection.
+
+        Args:
+            client_connection (socket.socket): Connection with the client.
+            addr (tuple): Address of the client.
+        """
+        self._pool.submit(self._receive, client_connection, addr)
+
+    def _receive_streams(self, streams: StreamConnection, addr: tuple):
+        """Receive the requests of a multiplexed connection until it is closed"""
+        try:
+            while True:
+                streams.acquire()
+                if not self._receive(streams.connection, addr, streams):
+                    return
+        finally:
+            streams.close()
+
+    def _receive(self, client_connection: socket.socket, addr: tuple,
+                 streams: StreamConnection = None) -> bool:
+        """Receive a request and handle or queue it. On a multiplexed connection, it
+        is handled on another receiving thread, so that the next request can be received.
+
+        Args:
+            client_connection (socket.socket): Connection with the client.
+            addr (tuple): Address of the client.
+            streams (StreamConnection, optional): The connection, if it is multiplexed.
+
+        Returns:
+            bool: False if the connection cannot be read anymore.
+        """
+        timer = StageTimer()
+        start = time.perf_counter()
+        received = time.monotonic()
+        try:
+            receiver = self._receivers.get_nowait()
+        except queue.Empty:
+            receiver = FrameReceiver()
+        # Until the request is received, an error is about the whole connection
+        reply = Reply(client_connection, streams)
+
+        def close():
+            self._receivers.put(receiver)
+            reply.close()
+
+        try:
+            request = receive_request(client_connection, receiver, timer)
+        except LimitExceeded as error:
+            # Rejected from the header of the frame, before receiving its content
+            REJECTED.inc(limit=error.limit)
+            logger.warning('Request rejected', addr=addr, reason=error)
+            send_error(reply, str(error), TOO_LARGE)
+            close()
+            return False
+        except ConnectionError as error:
+            if streams is None:
+                logger.exception('Cannot receive request', addr=addr)
+            else:
+                logger.debug('Connection closed', addr=addr, reason=error)
+            close()
+            return False
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Cannot receive request', addr=addr)
+            send_error(reply, 'Invalid request', INVALID)
+            close()
+            return False
+
+        if 'stream' in request:
+            if streams is None:
+                # First request of a multiplexed connection
+                streams = reply.streams = StreamConnection(client_connection)
+                streams.acquire()
+                threading.Thread(target=self._receive_streams, args=(streams, addr),
+                                 name='stream-receiver', daemon=True).start()
+            reply.stream = request['stream']
+        if streams is None:
+            self._schedule(request, reply, close, addr, timer, start, received)
+        else:
+            self._pool.submit(self._schedule, request, reply, close, addr, timer, start,
+                              received)
+        return True
+
+    def _schedule(self, request: dict, reply: Reply, close: Callable[[], None], addr: tuple,
+                  timer: StageTimer, start: float, received: float):
+        """Handle a received request, or queue it in the scheduler of its model"""
+        try:
+            ciphertext = request['parameter'].get('ciphertext', b'') \
+                if isinstance(request['parameter'], dict) else b''
+            priority = request_priority(request['action'], request.get('priority', ''),
+                                        len(ciphertext))
+            deadline = request_deadline(request.get('deadline', 0), received)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Cannot receive request', addr=addr)
+            send_error(reply, 'Invalid request', INVALID)
+            close()
+            return
+
+        if priority != CONTROL and self._pools.queued() >= MAX_QUEUED_REQUESTS:
+            # Rejected before decryption
+            REJECTED.inc(limit='concurrency')
+            logger.warning('Request rejected', action=request['action'], priority=priority,
+                           request_id=request.get('request_id', ''), reason='queue full')
+            send_error(reply, 'Too many requests in progress', BUSY, RETRY_AFTER)
+            close()
+            return
+
+        def reject(error: LimitExceeded):
+            # Rejected after decryption, before the NER, or because of a rate limit
+            REJECTED.inc(limit=error.limit)
+            logger.warning('Request rejected', action=request['action'],
+                           request_id=request.get('request_id', ''), reason=error)
+            if error.retry_after:
+                send_error(reply, str(error), BUSY, error.retry_after)
+            else:
+                send_error(reply, str(error), TOO_LARGE)
+
+        # Process requests are decrypted and parsed on the receiving thread to be
+        # queued in the scheduler of their model
+        opened, model = None, ''
+        if request['action'] == 'process':
+            try:
+                aes_key, data = open_request(request, self._nsm_util, timer)
+                with timer.stage('parse'):
+                    query = parse_query(data)
+                if query.model == ModelName.auto:
+                    with timer.stage('langid'):
+                        groups = detect_models(query.texts)
+                    if len(groups) == 1:
+                        # All the texts go to the same model
+                        query = query._replace(model=next(iter(groups)))
+                opened, model = (aes_key, query), query.model.value
+            except LimitExceeded as error:
+                reject(error)
+                close()
+                return
+            except ValueError:
+                # Not decrypted, or not a valid query
+                logger.exception('Cannot decrypt request', addr=addr,
+                                 request_id=request.get('request_id', ''))
+                send_error(reply, 'Invalid request', INVALID)
+                close()
+                return
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot decrypt request', addr=addr,
+                                 request_id=request.get('request_id', ''))
+                send_error(reply, 'Cannot process request', INTERNAL)
+                close()
+                return
+            if query.model == ModelName.auto:
+                self._submit_groups(reply, request, query, aes_key, groups,
+                                    priority, deadline, timer, start, close)
+                return
+
+        def run():
+            try:
+                timer.timings['queue'] = time.monotonic() - queued
+                response_obj, model = handle_request(request, self._nsm_util, self._export,
+                                                     timer, opened)
+                send_response(reply, request, response_obj, model, timer, start)
+            except LimitExceeded as error:
+                reject(error)
+            except InvalidRequest:
+                logger.exception('Cannot decrypt request', addr=addr,
+                                 request_id=request.get('request_id', ''))
+                send_error(reply, 'Invalid request', INVALID)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot process request', addr=addr,
+                                 request_id=request.get('request_id', ''))
+                send_error(reply, 'Cannot process request', INTERNAL)
+            finally:
+                close()
+
+        def expire():
+            try:
+                DROPPED.inc(reason='deadline', priority=priority)
+                logger.warning('Deadline exceeded', action=request['action'], priority=priority,
+                               request_id=request.get('request_id', ''))
+                send_error(reply, 'Deadline exceeded', DEADLINE)
+            finally:
+                close()
+
+        queued = time.monotonic()
+        if priority == CONTROL:
+            run()
+        else:
+            self._pools.submit(model, priority, deadline, run, expire)
+
+    def _submit_groups(self, reply: Reply, request: dict, query: Query,
+                       aes_key: bytes, groups: Dict[ModelName, List[int]], priority: str,
+                       deadline: float, timer: StageTimer, start: float,
+                       close: Callable[[], None]):
+        """Queue the texts of each model of a request in the scheduler of the model, so
+        that they run in parallel. The thread finishing the last group merges the
+        results in the order of the texts and sends the response."""
+        gather = Gather(len(query.texts), len(groups))
+        timers = []
+
+        def finish():
+            try:
+                if gather.error == DEADLINE:
+                    DROPPED.inc(reason='deadline', priority=priority)
+                    logger.warning('Deadline exceeded', action=request['action'],
+                                   priority=priority, request_id=request.get('request_id', ''))
+                    send_error(reply, 'Deadline exceeded', DEADLINE)
+                    return
+                if gather.error:
+                    send_error(reply, 'Cannot process request', INTERNAL)
+                    return
+                # The groups run in parallel: the duration of a stage is its longest one
+                for name in set().union(*(part.timings for part in timers)):
+                    timer.timings[name] = timer.timings.get(name, 0.0) + max(
+                        part.timings.get(name, 0.0) for part in timers)
+                response = serialize_result(query, gather.results, timer)
+                response_obj = encrypt_response(response, aes_key,
+                                                request['parameter'].get('accept', ()), timer)
+                send_response(reply, request, response_obj, ModelName.auto.value,
+                              timer, start)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot send response', request_id=request.get('request_id', ''))
+                send_error(reply, 'Cannot process request', INTERNAL)
+            finally:
+                close()
+
+        queued = time.monotonic()
+        for model, indexes in groups.items():
+            part_timer = StageTimer()
+            timers.append(part_timer)
+
+            def run(model=model, indexes=indexes, part_timer=part_timer):
+                part_timer.timings['queue'] = time.monotonic() - queued
+                try:
+                    results = run_pipeline(model, [query.texts[index] for index in indexes],
+                                           part_timer, query.html)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Cannot process request', model=model.value,
+                                     request_id=request.get('request_id', ''))
+                    results = None
+                if gather.add(indexes, results, '' if results is not None else 'failed'):
+                    finish()
+
+            def expire(indexes=indexes):
+                if gather.add(indexes, None, DEADLINE):
+                    finish()
+
+            self._pools.submit(model.value, priority, deadline, run, expire)
+
+
+class Gather():
+    """Results of the groups of texts of a request, processed in parallel.
+
+    Args:
+        size (int): Number of texts of the request.
+        groups (int): Number of groups.
+    """
+    def __init__(self, size: int, groups: int):
+        self.results = [None] * size
+        # First error of a group, if any
+        self.error = ''
+        self._pending = groups
+        self._lock = threading.Lock()
+
+    def add(self, indexes: List[int], results: List[dict] = None, error: str = '') -> bool:
+        """Record the results of a group, or its error.
+
+        Args:
+            indexes (List[int]): Indexes of the texts of the group.
+            results (List[dict], optional): Result of each text of the group.
+            error (str, optional): Error code if the group failed.
+
+        Returns:
+            bool: True if this was the last group.
+        """
+        with self._lock:
+            if error:
+                self.error = self.error or error
+            else:
+                for index, result in zip(indexes, results):
+                    self.results[index] = result
+            self._pending -= 1
+            return self._pending == 0
+
+
+def warm_up_server(nsm_util: NSMUtil, rounds: int = WARM_UP_ROUNDS):
+    """Warm up the server before it accepts requests. The vector table of each model is
+    read and sample texts run through its pipeline, then synthetic requests encrypted
+    like the ones of the client go through handle_request: RSA unwrapping, AES, CBOR,
+    parsing, NER and serialization in each output format.
+
+    Args:
+        nsm_util (NSMUtil): Interface with the Nitro Secure Module.
+        rounds (int, optional): Number of synthetic requests per model and output
+            format, 0 to skip the warm-up. Defaults to WARM_UP_ROUNDS.
+    """
+    if rounds <= 0:
+        return
+    start = time.perf_counter()
+    for name in MODEL_NAMES:
+        model_start = time.perf_counter()
+        nlp = MODELS[name]
+        warm_up(nlp)
+        texts = WARM_UP_TEXTS.get(nlp.lang, WARM_UP_TEXTS['nl'])
+        latencies = []
+        for _ in range(rounds):
+            for output in OutputFormat:
+                round_start = time.perf_counter()
+                parameter = {'model': name, 'output': output.value,
+                             'texts': [{'content': text} for text in texts]}
+                aes_key, msg_obj = encrypt_parameter(nsm_util.public_key, parameter)
+                request = {'action': 'process', 'parameter': msg_obj}
+                response_obj, _ = handle_request(request, nsm_util, False, StageTimer())
+                decrypt_response(aes_key, response_obj)
+                latencies.append(time.perf_counter() - round_start)
+        logger.info('Model warmed up', model=name, requests=len(latencies),
+                    first_ms=round(latencies[0] * 1000, 3),
+                    last_ms=round(latencies[-1] * 1000, 3),
+                    seconds=round(time.perf_counter() - model_start, 3))
+    logger.info('Warm-up done', seconds=round(time.perf_counter() - start, 3))
 
 
 @click.command()
@@ -27,16 +739,37 @@ from server.nsmutil import NSMUtil
                help="If set to True, returns RSA private key with attestation. "
                "For debugging only. Default is False.",
                mutually_exclusive_with=['simulate'])
-def main(simulate: bool, export: bool):
+@click.option('--port', type=int, default=SIMULATION_PORT,
+              help='Port of the enclave simulator, to run several of them. '
+              f'Default is {SIMULATION_PORT}.')
+@click.option('--log-level', type=str, default=LOG_LEVEL,
+              help=f'Log level. Per-request records are logged at DEBUG. Default is {LOG_LEVEL}.')
+@click.option('--profiling', type=bool, default=PROFILING,
+              help='If set to True, accept the profile action. For debugging only. '
+              f'Default is {PROFILING}.')
+@click.option('--operator-key', type=str, default=OPERATOR_PUBLIC_KEY,
+              help='PEM file of the RSA public key checking the signature of the control '
+              f'actions. Default is {OPERATOR_PUBLIC_KEY}.')
+@click.option('--warm-up-rounds', type=int, default=WARM_UP_ROUNDS,
+              help='Synthetic requests per model and output format processed before the '
+              f'server listens, 0 to skip the warm-up. Default is {WARM_UP_ROUNDS}.')
+def main(simulate: bool, export: bool, port: int, log_level: str, profiling: bool,
+         operator_key: str, warm_up_rounds: int):
     """Main server application meant to run in AWS Nitro enclave"""
-    print("Starting server...")
+    global AUTHORIZER  # pylint: disable=global-statement
+    configure_logging(log_level)
+    logger.info('Starting server...')
+    profiler.PROFILING = profiling
+    AUTHORIZER = Authorizer.from_file(operator_key, OPERATOR_ACTIONS)
 
     # Initialise NSMUtil
     nsm_util = NSMUtil(simulate)
     if simulate:
-        print('Simulating presence of Nitro enclave.')
+        logger.info('Simulating presence of Nitro enclave.')
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.bind((BASTION_HOST, VSOCK_PORT))
+        # Allow restarting the simulator while connections are in TIME_WAIT
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        client_socket.bind((BASTION_HOST, port))
     else:
         # Create a vsock socket object
         client_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)  # pylint: disable=no-member
@@ -47,92 +780,21 @@ def main(simulate: bool, export: bool):
         # Bind the socket to CID and port
         client_socket.bind((cid, VSOCK_PORT))
 
+    # Warm up before listening: the parent only sends requests once the server is healthy
+    warm_up_server(nsm_util, warm_up_rounds)
+
     # Listen for connection from the client
     client_socket.listen()
 
-    print("Server started...")
+    logger.info("Server started...")
 
+    dispatcher = Dispatcher(nsm_util, export, ModelPools(MODEL_NAMES))
     while True:
         client_connection, addr = client_socket.accept()
-        print('New connection accepted from %s', addr)
-
-        # Get command from client and decode it
-        payload_cbor = client_connection.recv(4096)
-        request = cbor2.loads(payload_cbor)
-
-        print('Received request: %s', request)
-
-        if request['action'] == 'get-attestation':
-            # Generate attestation document
-            response_obj = {'attestation': nsm_util.get_attestation_doc()}  # pylint: disable=used-before-assignment
-            if export:
-                response_obj['private_key'] = nsm_util._rsa_key.export_key()  # pylint: disable=protected-access
-
-        else:
-            # Extract the content of the message
-            msg_obj = request['parameter']
-
-            # Decrypt the encrypted AES key using the private of the server
-            encrypted_aes_key = msg_obj['encrypted_key']
-            aes_key = nsm_util.decrypt(encrypted_aes_key)
-
-            cipher = AES.new(aes_key, AES.MODE_EAX, msg_obj['nonce'])
-            data_cbor = cipher.decrypt_and_verify(msg_obj['ciphertext'], msg_obj['tag'])
-            data = cbor2.loads(data_cbor)
-            pprint(data, 'Data received')
-
-            # Prepare response depending on required action
-            if request['action'] == 'message':
-                # Add some message to the received message
-                response = data + ' - Added by server'
-
-
-            elif request['action'] == 'models':
-                # Provide the list of available NER models
-                response = MODEL_NAMES
-
-            elif request['action'] == 'process':
-                data_obj = json.loads(data)
-                query = InputModel(**data_obj)
-                nlp = MODELS[query.model]
-                response_body = []
-                texts = (text.content for text in query.texts)
-                for doc in nlp.pipe(texts):
-                    response_body.append(get_data(doc))
-                response_obj = {"result": response_body}
-                response = ResponseModel(**response_obj).json()
-
-            else:
-                response = 'Unknown action request.'
-
-            # Encode response with CBOR
-            response_cbor = cbor2.dumps(response)
-
-            # Encrypt the CBOR encoded response
-            cipher = AES.new(aes_key, AES.MODE_EAX)
-            ciphertext, tag = cipher.encrypt_and_digest(response_cbor)
-
-            # Build a message object for the server
-            response_obj = {
-                'nonce': cipher.nonce,
-                'tag': tag,
-                'ciphertext': ciphertext
-            }
-
-        pprint(response_obj, 'Response')
-
-        # Encode the response object with CBOR
-        response_obj_cbor = cbor2.dumps(response_obj)
-        pprint(response_obj_cbor, 'CBOR encoded response')
-
-        response_b64 = base64.b64encode(response_obj_cbor)
-        pprint(response_b64, 'Base64 encoded response')
-
-        # Send CBOR encoded response to client
-        client_connection.sendall(response_b64)
-
-        # Close the connection with client
-        client_connection.close()
+        logger.debug('New connection accepted', addr=addr)
+        # The connection is closed once the request is processed, or once the client
+        # closes it if it is multiplexed
+        dispatcher.dispatch(client_connection, addr)
 
 if __name__ == '__main__':
     main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,158 @@
+"""
+AWS Nitro Test
+
+Single-file bundles of the NER models. spacy.load reads the directory tree of a
+model (meta.json, tokenizer, vocab, entity_ruler/patterns.jsonl, ner) file by file
+and parses the JSON patterns. A bundle holds the fully built pipeline serialized by
+spaCy (tokenizer, vocabulary, entity ruler patterns in MessagePack, NER weights) and
+the raw vector table, aligned so that it is memory-mapped rather than read: the
+table is shared with the page cache and only paged in when used.
+
+Layout of a bundle: MAGIC, size of the CBOR header, header (format, spaCy version,
+meta.json and offset and size of each section), then the sections. spaCy cannot
+serialize the compiled Matcher: the entity ruler still adds its patterns on load.
+
+Build the bundles of the models shipped in server/models (run from the src directory):
+    python -m server.bundle
+"""
+import mmap
+import os
+import struct
+import time
+
+import cbor2
+import click
+import numpy
+import spacy
+import srsly
+
+from spacy.language import Language
+from spacy.util import get_lang_class
+
+# Suffix of the bundle of the model directory server/models/<name>[@<version>]
+BUNDLE_SUFFIX = '.bundle'
+# Version of the layout of the bundles
+BUNDLE_FORMAT = 1
+# Start of the file and size of the CBOR header
+MAGIC = b'NERBNDL\n'
+HEADER = struct.Struct('!8sI')
+# Alignment of the sections, for the memory-mapped vector table
+ALIGNMENT = 64
+
+
+def build_bundle(model_dir: str, output: str = '') -> dict:
+    """Load a model directory and write its bundle.
+
+    Args:
+        model_dir (str): Directory of the model, as saved by nlp.to_disk.
+        output (str, optional): Bundle file. Defaults to the directory with BUNDLE_SUFFIX.
+
+    Returns:
+        dict: Header of the bundle.
+    """
+    nlp = spacy.load(model_dir)
+    vectors = nlp.vocab.vectors
+    sections = {
+        'vocab': nlp.vocab.to_bytes(exclude=['vectors']),
+        'key2row': srsly.msgpack_dumps(vectors.key2row),
+        'pipeline': nlp.to_bytes(exclude=['vocab']),
+        'vectors': numpy.ascontiguousarray(vectors.data, dtype=numpy.float32).tobytes()
+    }
+
+    # The offsets depend on the size of the header, which contains them: reserve room
+    # for the largest offsets
+    header = {
+        'format': BUNDLE_FORMAT,
+        'spacy_version': spacy.__version__,
+        'meta': nlp.meta,
+        'vectors_shape': list(vectors.data.shape),
+        'sections': {name: [2 ** 62, len(data)] for name, data in sections.items()}
+    }
+    offset = _align(HEADER.size + len(cbor2.dumps(header)))
+    for name, data in sections.items():
+        header['sections'][name] = [offset, len(data)]
+        offset = _align(offset + len(data))
+    header_cbor = cbor2.dumps(header)
+
+    with open(output or model_dir.rstrip(os.sep) + BUNDLE_SUFFIX, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(header_cbor)))
+        file.write(header_cbor)
+        for name, data in sections.items():
+            file.seek(header['sections'][name][0])
+            file.write(data)
+        # Every section, even empty, starts within the file
+        file.truncate(offset)
+    return header
+
+
+def load_bundle(path: str) -> Language:
+    """Load a model from its bundle. The vector table stays in the memory-mapped file.
+
+    Args:
+        path (str): Bundle file.
+
+    Raises:
+        ValueError: If the file is not a bundle of this format and spaCy version.
+
+    Returns:
+        Language: Model.
+    """
+    with open(path, 'rb') as file:
+        # The mapping is kept open by the vector table
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_size = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a model bundle')
+    header = cbor2.loads(buffer[HEADER.size:HEADER.size + header_size])
+    if header['format'] != BUNDLE_FORMAT or header['spacy_version'] != spacy.__version__:
+        raise ValueError(f'{path} was built with format {header["format"]} and spaCy '
+                         f'{header["spacy_version"]}, rebuild it with python -m server.bundle')
+
+    def section(name: str) -> bytes:
+        offset, size = header['sections'][name]
+        return buffer[offset:offset + size]
+
+    # Create the pipeline as spacy.load does, before loading its state
+    meta = header['meta']
+    nlp = get_lang_class(meta['lang'])(meta=meta)
+    for name in meta.get('pipeline', []):
+        factory = meta.get('factories', {}).get(name, name)
+        config = meta.get('pipeline_args', {}).get(name, {})
+        nlp.add_pipe(nlp.create_pipe(factory, config=config), name=name)
+
+    # The vectors are set before the components, which link them to their models
+    nlp.vocab.from_bytes(section('vocab'), exclude=['vectors'])
+    vectors = nlp.vocab.vectors
+    vectors.key2row.update(srsly.msgpack_loads(section('key2row')))
+    rows, width = header['vectors_shape']
+    vectors.data = numpy.frombuffer(buffer, dtype=numpy.float32, count=rows * width,
+                                    offset=header['sections']['vectors'][0]
+                                    ).reshape(rows, width)
+    vectors._sync_unset()  # pylint: disable=protected-access
+    return nlp.from_bytes(section('pipeline'), exclude=['vocab'])
+
+
+def _align(offset: int) -> int:
+    """Round an offset up to ALIGNMENT"""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+@click.command()
+@click.option('--models-dir', type=str,
+              default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'),
+              help='Directory of the models. Default is server/models.')
+def main(models_dir: str):
+    """Build the bundle of every model directory"""
+    for entry in sorted(os.listdir(models_dir)):
+        model_dir = os.path.join(models_dir, entry)
+        if not os.path.isfile(os.path.join(model_dir, 'meta.json')):
+            continue
+        start = time.perf_counter()
+        build_bundle(model_dir)
+        size = os.path.getsize(model_dir + BUNDLE_SUFFIX)
+        print(f'{entry}{BUNDLE_SUFFIX}: {size / 2 ** 20:.1f} MiB in '
+              f'{time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
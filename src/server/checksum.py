@@ -0,0 +1,73 @@
+"""
+AWS Nitro Test
+
+Vectorised mod-97 checksum validation of Belgian enterprise numbers (KBO/BCE)
+and national numbers (NISS/INSZ)
+"""
+from typing import List
+
+import numpy as np
+
+# Maximum number of digits of a number handled with 64-bit integers
+MAX_DIGITS = 18
+_POWERS = 10 ** np.arange(MAX_DIGITS - 1, -1, -1, dtype=np.int64)
+
+
+def mod97_valid_scalar(number: str, niss: bool) -> bool:
+    """Check the mod-97 checksum of a single number.
+
+    Args:
+        number (str): Digits of the number, the last two being the check digits.
+        niss (bool): If True, also accept the checksum of persons born after 2000.
+
+    Returns:
+        bool: True if the checksum is valid.
+    """
+    if len(number) < 3:
+        return False
+    check_digits = int(number[-2:])
+    if 97 - int(number[:-2]) % 97 == check_digits:
+        return True
+    return niss and 97 - int('2' + number[:-2]) % 97 == check_digits
+
+
+def mod97_valid(numbers: List[str], niss: List[bool]) -> np.ndarray:
+    """Check the mod-97 checksums of many numbers at once.
+
+    The body of a number (all digits but the last two) must satisfy
+    97 - body % 97 == check digits. For national numbers of persons born after
+    2000, the body is prefixed with a 2.
+
+    Args:
+        numbers (List[str]): Digits of the numbers.
+        niss (List[bool]): For each number, True if it is a national number.
+
+    Returns:
+        np.ndarray: Boolean array, True where the checksum is valid.
+    """
+    valid = np.zeros(len(numbers), dtype=bool)
+    fast = []
+    for index, number in enumerate(numbers):
+        if 3 <= len(number) <= MAX_DIGITS and number.isascii():
+            fast.append(index)
+        else:
+            # Too long for 64-bit integers or non-ASCII digits
+            valid[index] = mod97_valid_scalar(number, niss[index])
+    if not fast:
+        return valid
+
+    # Convert the right-aligned digits to a matrix and then to 64-bit integers
+    padded = ''.join(numbers[index].rjust(MAX_DIGITS, '0') for index in fast).encode('ascii')
+    matrix = np.frombuffer(padded, dtype=np.uint8).reshape(len(fast), MAX_DIGITS) - ord('0')
+    values = matrix.astype(np.int64) @ _POWERS
+    body, check_digits = np.divmod(values, 100)
+    body_mod = body % 97
+
+    lengths = np.fromiter((len(numbers[index]) for index in fast), dtype=np.int64, count=len(fast))
+    is_niss = np.fromiter((niss[index] for index in fast), dtype=bool, count=len(fast))
+    # (2 * 10^len(body) + body) % 97 for the national numbers of persons born after 2000
+    prefix_mod = (2 * 10 ** (lengths - 2)) % 97
+
+    valid[fast] = (97 - body_mod == check_digits) | \
+        (is_niss & (97 - (prefix_mod + body_mod) % 97 == check_digits))
+    return valid
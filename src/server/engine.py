@@ -0,0 +1,514 @@
+"""
+AWS Nitro Test
+
+Inference-only NumPy engine of the NER component of the models, the greedy
+transition-based entity recognizer of spaCy 2.3 (beam_width 1). Its weights are
+exported once from the loaded pipeline. The hash embeddings, the maxout CNN and the
+precomputed hidden layer then run as batched NumPy matrix products (the BLAS of
+NumPy rather than the blis kernels of thinc), and the greedy BILUO transitions of
+all the texts of a batch advance together, one token per step, with the validity of
+the moves computed for all of them at once. The engine follows the feature
+extraction, padding and transition rules of spaCy, including the entities preset by
+the entity ruler, so that it finds the same entities.
+
+With quantize, the embedding tables and weight matrices are stored as int8 with a
+scale per row, about 4 times smaller. NumPy has no int8 matrix product: they are
+dequantized when used and the computations stay in float32. The output layer, which
+grows with the labels, stays in float32.
+
+An engine is shared by the worker threads of its model. The moves and the output
+layer are replaced at once when labels are added, and each batch reads them once.
+"""
+import threading
+
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+import numpy
+
+from spacy.attrs import ID, NORM, PREFIX, SUFFIX, SHAPE, ORTH, ENT_IOB, ENT_TYPE, \
+    SENT_START, IS_SPACE
+from spacy.language import Language
+from spacy.tokens import Doc
+from spacy.util import minibatch
+from thinc.i2v import HashEmbed, StaticVectors
+from thinc.misc import LayerNorm
+from thinc.t2t import ExtractWindow
+
+# Columns of the token features, in the order of the tok2vec of spaCy
+FEATURES = [ID, NORM, PREFIX, SUFFIX, SHAPE, ORTH]
+# Preset entities and constraints of the transitions
+STATE_ATTRS = [ENT_IOB, ENT_TYPE, SENT_START, IS_SPACE]
+# Moves of the BILUO transition system, numbered as in spacy/syntax/ner.pyx
+BEGIN, IN, LAST, UNIT, OUT = 1, 2, 3, 4, 5
+MOVES = {'B': BEGIN, 'I': IN, 'L': LAST, 'U': UNIT, 'O': OUT}
+# Weights stored as int8 by quantize: embedding tables and weight matrices, except the
+# output layer
+QUANTIZED = ('embed.', '.W')
+
+_C1 = numpy.uint64(0x87c37b91114253d5)
+_C2 = numpy.uint64(0x4cf5ad432745937f)
+
+
+class Classes(NamedTuple):
+    """Moves of the transition system, with the output layer scoring them"""
+    # Move type and label of each class
+    types: numpy.ndarray
+    labels: numpy.ndarray
+    # False for the classes never seen in training, always scored lowest
+    seen: numpy.ndarray
+    W: numpy.ndarray
+    b: numpy.ndarray
+
+
+def murmurhash(keys: numpy.ndarray, seed: int) -> numpy.ndarray:
+    """MurmurHash3_x64_128 of 64-bit keys, as the HashEmbed layers of thinc.
+
+    Args:
+        keys (numpy.ndarray): uint64 keys.
+        seed (int): Seed of the hash.
+
+    Returns:
+        numpy.ndarray: Four uint32 hashes per key.
+    """
+    def rotate(value, bits):
+        return (value << numpy.uint64(bits)) | (value >> numpy.uint64(64 - bits))
+
+    def mix(value):
+        value = value ^ (value >> numpy.uint64(33))
+        value = value * numpy.uint64(0xff51afd7ed558ccd)
+        value = value ^ (value >> numpy.uint64(33))
+        value = value * numpy.uint64(0xc4ceb9fe1a85ec53)
+        return value ^ (value >> numpy.uint64(33))
+
+    # A single 8 bytes tail block, then the finalization with the length
+    h1 = numpy.uint64(seed) ^ (rotate(keys * _C1, 31) * _C2) ^ numpy.uint64(8)
+    h2 = numpy.full_like(keys, seed) ^ numpy.uint64(8)
+    h1 = h1 + h2
+    h2 = h2 + h1
+    h1 = mix(h1)
+    h2 = mix(h2)
+    h1 = h1 + h2
+    h2 = h2 + h1
+    return numpy.stack([h1, h2], axis=1).view(numpy.uint32)
+
+
+def layer_norm(X: numpy.ndarray, G: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    """Normalize each row of X, then scale and shift it (thinc LayerNorm)"""
+    mu = X.mean(axis=1, keepdims=True)
+    var = X.var(axis=1, keepdims=True) + 1e-08
+    return (X - mu) * var ** (-1.0 / 2.0) * G + b
+
+
+def maxout(Y: numpy.ndarray, pieces: int) -> numpy.ndarray:
+    """Maximum of the pieces of Y, its blocks of columns"""
+    width = Y.shape[1] // pieces
+    best = Y[:, :width]
+    for piece in range(1, pieces):
+        best = numpy.maximum(best, Y[:, piece * width:(piece + 1) * width])
+    return best
+
+
+def seq2col(X: numpy.ndarray) -> numpy.ndarray:
+    """Concatenate each row of X with the previous and next rows, zeros at the ends"""
+    cols = numpy.zeros((X.shape[0], 3, X.shape[1]), dtype=numpy.float32)
+    cols[1:, 0] = X[:-1]
+    cols[:, 1] = X
+    cols[:-1, 2] = X[1:]
+    return cols.reshape((X.shape[0], 3 * X.shape[1]))
+
+
+def export_weights(ner) -> Tuple[Dict[str, numpy.ndarray], dict]:
+    """Export the weights of a spaCy 2.3 NER component.
+
+    Args:
+        ner (spacy.pipeline.EntityRecognizer): Component of a loaded model.
+
+    Raises:
+        ValueError: If the architecture of the component is not supported.
+
+    Returns:
+        Tuple[Dict[str, numpy.ndarray], dict]: Weights by name and dimensions.
+    """
+    cfg = ner.cfg
+    unsupported = {key: cfg.get(key) for key, supported in (
+        ('beam_width', 1), ('hidden_depth', 1), ('bilstm_depth', 0), ('self_attn_depth', 0),
+        ('conv_window', 1), ('subword_features', True), ('char_embed', False))
+                   if cfg.get(key, supported) != supported}
+    if unsupported or cfg.get('cnn_maxout_pieces', 3) < 2 \
+            or cfg.get('nr_feature_tokens', 3) not in (3, 6):
+        raise ValueError(f'Unsupported NER architecture: {cfg}')
+
+    layers = {StaticVectors: [], HashEmbed: [], LayerNorm: [], ExtractWindow: []}
+
+    def walk(layer):
+        if type(layer) in layers:  # pylint: disable=unidiomatic-typecheck
+            layers[type(layer)].append(layer)
+        for child in layer._layers:  # pylint: disable=protected-access
+            walk(child)
+
+    model = ner.model
+    walk(model.tok2vec)
+    lower, upper = model.lower, model.upper
+    # The pieces of the maxout layers are stored first, so that their outputs are
+    # blocks of columns: the maximum of a small last axis is slow in NumPy
+    weights = {'lower.W': lower.W.transpose((0, 2, 1, 3)).reshape((-1, lower.nI)),
+               'lower.b': lower.b.T.ravel(),
+               'lower.pad': lower.pad[0].transpose((0, 2, 1)).reshape((lower.nF, -1)),
+               'upper.W': upper.W, 'upper.b': upper.b}
+    for static in layers[StaticVectors]:
+        weights['static.W'] = static.W
+    for embed in layers[HashEmbed]:
+        weights[f'embed.{embed.column}'] = embed.vectors
+    # The layer normalized maxout of the embeddings, then one per convolution
+    for index, norm in enumerate(layers[LayerNorm]):
+        prefix = 'mix' if index == 0 else f'conv{index}'
+        weights.update({f'{prefix}.W': norm.child.W.transpose((1, 0, 2)).reshape(
+            (-1, norm.child.nI)), f'{prefix}.b': norm.child.b.T.ravel(), f'{prefix}.G': norm.G,
+                        f'{prefix}.beta': norm.b})
+    dims = {'width': model.tok2vec.nO, 'mix_pieces': layers[LayerNorm][0].child.nP,
+            'pieces': layers[LayerNorm][-1].child.nP,
+            'conv_depth': len(layers[ExtractWindow]),
+            'embeds': [(embed.column, embed.seed) for embed in layers[HashEmbed]],
+            'static_vectors': bool(layers[StaticVectors]),
+            'features': lower.nF, 'hidden': lower.nO, 'hidden_pieces': lower.nP}
+    return {name: numpy.array(value, dtype=numpy.float32) for name, value in weights.items()}, dims
+
+
+class NumpyNER:
+    """Pipeline component replacing the 'ner' component of a model"""
+
+    name = 'ner'
+
+    def __init__(self, vocab, weights: Dict[str, numpy.ndarray], dims: dict,
+                 moves: List[str], unseen: Iterable[int] = (), quantize: bool = False,
+                 labels: Iterable[str] = ()):
+        """Create the engine from exported weights.
+
+        Args:
+            vocab (spacy.vocab.Vocab): Vocabulary of the model, with its vectors.
+            weights (Dict[str, numpy.ndarray]): Weights, see export_weights.
+            dims (dict): Dimensions, see export_weights.
+            moves (List[str]): Names of the moves, e.g., 'B-PERSON', in the order of
+                the classes of the model.
+            unseen (Iterable[int], optional): Classes never seen in training, always
+                scored lowest. Defaults to ().
+            quantize (bool, optional): If True, store the embedding tables and weight
+                matrices as int8. Defaults to False.
+            labels (Iterable[str], optional): Labels of the entities preset before the
+                NER, e.g., by the entity ruler. Their moves are added up front rather than
+                by the first batch with such an entity. Defaults to ().
+        """
+        self.vocab = vocab
+        self.dims = dims
+        self.quantize = quantize
+        self.weights = {}
+        for name, value in weights.items():
+            if quantize and name != 'upper.W' \
+                    and (name.startswith(QUANTIZED[0]) or name.endswith(QUANTIZED[1])):
+                scale = numpy.abs(value).max(axis=1) / 127
+                scale[scale == 0] = 1
+                self.weights[name] = numpy.round(value / scale[:, None]).astype(numpy.int8)
+                self.weights[f'{name}.scale'] = scale.astype(numpy.float32)
+            else:
+                self.weights[name] = value
+        types = numpy.zeros(len(moves), dtype=numpy.int8)
+        move_labels = numpy.zeros(len(moves), dtype=numpy.uint64)
+        for clas, move in enumerate(moves):
+            move_type, _, label = move.partition('-')
+            types[clas] = MOVES[move_type]
+            move_labels[clas] = vocab.strings.add(label) if label else 0
+        seen = numpy.ones(len(moves), dtype=bool)
+        seen[list(unseen)] = False
+        self.classes = Classes(types, move_labels, seen, self.weights.pop('upper.W'),
+                               self.weights.pop('upper.b'))
+        # Serializes the addition of labels
+        self._lock = threading.Lock()
+        self._add_labels(numpy.array([vocab.strings.add(label) for label in labels],
+                                     dtype=numpy.uint64))
+
+    @classmethod
+    def from_spacy(cls, ner, quantize: bool = False, labels: Iterable[str] = ()) -> 'NumpyNER':
+        """Create the engine of a spaCy NER component (see __init__ for the arguments)"""
+        weights, dims = export_weights(ner)
+        moves = [ner.moves.get_class_name(clas) for clas in range(ner.moves.n_moves)]
+        return cls(ner.vocab, weights, dims, moves, ner.model.unseen_classes, quantize, labels)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the weights of the engine, without the vectors of the vocabulary"""
+        return sum(value.nbytes for value in self.weights.values()) \
+            + self.classes.W.nbytes + self.classes.b.nbytes
+
+    def __call__(self, doc: Doc) -> Doc:
+        self.predict([doc])
+        return doc
+
+    def pipe(self, docs: Iterable[Doc], batch_size: int = 256) -> Iterator[Doc]:
+        """Find the entities of docs by batches. spaCy splits its batches in 4 to
+        limit the transitions spent on finished states; here, they cost nothing."""
+        for batch in minibatch(docs, size=batch_size):
+            batch = list(batch)
+            self.predict(batch)
+            yield from batch
+
+    def predict(self, docs: List[Doc]) -> None:
+        """Find the entities of a batch of docs and set them on the docs"""
+        docs = [doc for doc in docs if len(doc)]
+        if not docs:
+            return
+        states = [doc.to_array(STATE_ATTRS) for doc in docs]
+        classes = self._add_labels(numpy.concatenate([state[:, 1] for state in states]))
+        tokvecs = self._tok2vec(docs)
+        for doc, state in zip(docs, self._decode(states, tokvecs, classes)):
+            doc.from_array([ENT_IOB, ENT_TYPE], state)
+
+    def _matrix(self, name: str) -> numpy.ndarray:
+        """Weight matrix, dequantized"""
+        value = self.weights[name]
+        if value.dtype == numpy.int8:
+            return value.astype(numpy.float32) * self.weights[f'{name}.scale'][:, None]
+        return value
+
+    def _rows(self, name: str, index: numpy.ndarray) -> numpy.ndarray:
+        """Rows of an embedding table, dequantized"""
+        value = self.weights[name][index]
+        if value.dtype == numpy.int8:
+            return value.astype(numpy.float32) * self.weights[f'{name}.scale'][index][..., None]
+        return value
+
+    def _maxout(self, name: str, X: numpy.ndarray, pieces: int) -> numpy.ndarray:
+        """Affine layer followed by the maximum of each group of pieces"""
+        Y = X @ self._matrix(f'{name}.W').T
+        Y += self.weights[f'{name}.b']
+        return maxout(Y, pieces)
+
+    def _embed(self, features: numpy.ndarray) -> numpy.ndarray:
+        """Embeddings of the unique ORTH of the token features"""
+        _, index, inverse = numpy.unique(features[:, FEATURES.index(ORTH)], return_index=True,
+                                         return_inverse=True)
+        features = features[index]
+        columns = []
+        if self.dims['static_vectors']:
+            ids = features[:, FEATURES.index(ID)]
+            table = self.vocab.vectors.data
+            in_table = ids < table.shape[0]
+            columns.append(table[ids * in_table] @ self._matrix('static.W').T * in_table[:, None])
+        for column, seed in self.dims['embeds']:
+            name = f'embed.{column}'
+            keys = murmurhash(numpy.ascontiguousarray(features[:, column]), seed)
+            columns.append(self._rows(name, keys % self.weights[name].shape[0]).sum(axis=1))
+        X = self._maxout('mix', numpy.concatenate(columns, axis=1), self.dims['mix_pieces'])
+        return layer_norm(X, self.weights['mix.G'], self.weights['mix.beta'])[inverse]
+
+    def _tok2vec(self, docs: List[Doc]) -> numpy.ndarray:
+        """Token vectors of docs, concatenated"""
+        # Each doc is padded with conv_depth rows of zero features on each side, as
+        # in spaCy: the convolutions of a doc never reach the next one
+        depth = self.dims['conv_depth']
+        padding = numpy.zeros((depth, len(FEATURES)), dtype=numpy.uint64)
+        parts = [padding]
+        for doc in docs:
+            parts.extend((doc.to_array(FEATURES), padding))
+        X = self._embed(numpy.concatenate(parts))
+        for index in range(1, depth + 1):
+            name = f'conv{index}'
+            Y = self._maxout(name, seq2col(X), self.dims['pieces'])
+            X = X + layer_norm(Y, self.weights[f'{name}.G'], self.weights[f'{name}.beta'])
+        rows = []
+        start = depth
+        for doc in docs:
+            rows.append(X[start:start + len(doc)])
+            start += len(doc) + depth
+        return numpy.concatenate(rows)
+
+    def _add_labels(self, types: numpy.ndarray) -> Classes:
+        """Add the moves of the unknown labels of preset entities, as spaCy does,
+        scored lowest. The classes are replaced at once, never modified.
+
+        Args:
+            types (numpy.ndarray): Labels of the preset entities of a batch.
+
+        Returns:
+            Classes: Classes including the labels.
+        """
+        classes = self.classes
+        if not self._unknown(classes, types):
+            return classes
+        with self._lock:
+            classes = self.classes
+            unknown = self._unknown(classes, types)
+            if not unknown:
+                return classes
+            extra = len(unknown) * 4
+            self.classes = classes = Classes(
+                numpy.concatenate((classes.types, numpy.tile(
+                    numpy.array((BEGIN, IN, UNIT, LAST), dtype=numpy.int8), len(unknown)))),
+                numpy.concatenate((classes.labels,
+                                   numpy.repeat(numpy.array(unknown, dtype=numpy.uint64), 4))),
+                numpy.concatenate((classes.seen, numpy.zeros(extra, dtype=bool))),
+                numpy.vstack((classes.W, numpy.zeros((extra, classes.W.shape[1]),
+                                                     dtype=numpy.float32))),
+                numpy.concatenate((classes.b, numpy.zeros(extra, dtype=numpy.float32))))
+        return classes
+
+    @staticmethod
+    def _unknown(classes: Classes, types: numpy.ndarray) -> List[int]:
+        """Labels of types without moves, in order of first appearance"""
+        known = set(classes.labels.tolist()) | {0}
+        return [label for label in dict.fromkeys(types.tolist()) if label not in known]
+
+    @staticmethod
+    def _valid_moves(tokens: numpy.ndarray, last: numpy.ndarray,
+                     classes: Classes) -> Tuple[numpy.ndarray, ...]:
+        """Valid moves at each token of a batch, as the is_valid of the moves of spaCy.
+        Only whether an entity is open and its label change during the transitions:
+        the rest of the constraints are computed once for all the tokens.
+
+        Args:
+            tokens (numpy.ndarray): ENT_IOB, ENT_TYPE, SENT_START and IS_SPACE of
+                the tokens of the batch.
+            last (numpy.ndarray): Whether each token is the last of its doc.
+            classes (Classes): Moves.
+
+        Returns:
+            Tuple[numpy.ndarray, ...]: Moves valid at each token without open entity,
+            with an open entity, and with an open entity of the label of the move.
+        """
+        iob, types, _, space = (column[:, None] for column in tokens.T)
+        space = space == 1
+        following = numpy.append(tokens[1:], numpy.zeros((1, tokens.shape[1]), tokens.dtype),
+                                 axis=0)
+        next_iob = numpy.where(last, 0, following[:, 0])[:, None]
+        next_start = (~last & (following[:, 2] == 1))[:, None]
+        last = last[:, None]
+        label, move = classes.labels[None, :], classes.types[None, :]
+        begin = ((move == BEGIN) & ~last & (label != 0) & (iob != 1)
+                 & numpy.where(iob == 3, (label == types) & (next_iob == 1),
+                               (next_iob != 3) & ~next_start & ~space))
+        unit = (move == UNIT) & numpy.where(
+            label == 0, (types == 0) & (iob == 3),
+            (next_iob != 1) & numpy.where(iob == 3, label == types, ~space))
+        out = (move == OUT) & (iob != 3) & (iob != 1)
+        # Last token of a preset entity
+        preset_last = (iob == 1) & (next_iob != 1)
+        blocked = (move == UNIT) & (label == 0) & (types == 0) & (iob == 3)
+        inside = ((move == IN) & (label != 0) & ~last & (iob != 3) & (next_iob != 3)
+                  & numpy.where(iob == 1, (next_iob != 0) & (next_iob != 2) & (label == types),
+                                ~next_start))
+        end = (move == LAST) & (label != 0)
+        return (begin | unit | out, blocked | (end & preset_last & (label == types)),
+                inside | (end & ~preset_last & (next_iob != 1)))
+
+    def _decode(self, states: List[numpy.ndarray], tokvecs: numpy.ndarray,
+                classes: Classes) -> List[numpy.ndarray]:
+        """Greedy transitions of a batch, all states advancing one token per step.
+
+        Args:
+            states (List[numpy.ndarray]): ENT_IOB, ENT_TYPE, SENT_START and IS_SPACE
+                of the tokens of each doc.
+            tokvecs (numpy.ndarray): Token vectors of the docs, concatenated.
+            classes (Classes): Moves and output layer, including the labels of the docs.
+
+        Returns:
+            List[numpy.ndarray]: ENT_IOB and ENT_TYPE of the tokens of each doc.
+        """
+        lengths = numpy.array([len(state) for state in states])
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        tokens = numpy.concatenate(states)
+        tags = tokens[:, :2].copy()
+        position = numpy.arange(len(tokens)) - numpy.repeat(offsets, lengths)
+        last = position == numpy.repeat(lengths, lengths) - 1
+        closed_valid, open_valid, label_valid = self._valid_moves(tokens, last, classes)
+
+        # Hidden layer of each feature of each token, the padding first
+        hidden, pieces = self.dims['hidden'], self.dims['hidden_pieces']
+        features = self.dims['features']
+        cached = (tokvecs @ self._matrix('lower.W').T).reshape((-1, features, hidden * pieces))
+        cached = numpy.concatenate((self.weights['lower.pad'][None], cached))
+        # The features of the token and its neighbours are summed once, in the order of
+        # spaCy, before those of the entity
+        index = numpy.arange(len(tokens)) + 1
+        summed = cached[index, 0]
+        if features == 6:
+            summed += cached[numpy.where(position > 0, index - 1, 0), 1]
+            summed += cached[numpy.where(last, 0, index + 1), 2]
+        all_seen = classes.seen.all()
+
+        # The states by decreasing length: the states left at a step are the first ones
+        order = numpy.argsort(-lengths, kind='stable')
+        lengths, offsets = lengths[order], offsets[order]
+        counts = (lengths[:, None] > numpy.arange(lengths[0])).sum(axis=0)
+        is_open = numpy.zeros(len(states), dtype=bool)
+        entities = numpy.zeros(len(states), dtype=numpy.int64)
+        # Start and label of the last entity of each state, -1 and 0 if none or if
+        # there are as many entities as tokens (E(0) of spaCy)
+        start = numpy.full(len(states), -1)
+        entity_label = numpy.zeros(len(states), dtype=numpy.uint64)
+        done = numpy.zeros(len(states), dtype=bool)
+        for step, count in enumerate(counts):
+            token = offsets[:count] + step
+            vector = summed[token]
+            for feature, ids in self._entity_features(step, start[:count], is_open[:count],
+                                                      lengths[:count]):
+                vector += cached[numpy.where(ids >= 0, ids + offsets[:count] + 1, 0), feature]
+            vector += self.weights['lower.b']
+            scores = maxout(vector, pieces) @ classes.W.T
+            scores += classes.b
+            if not all_seen:
+                scores[:, ~classes.seen] = scores.min()
+
+            valid = numpy.where(is_open[:count, None],
+                                open_valid[token] | label_valid[token]
+                                & (classes.labels[None, :] == entity_label[:count, None]),
+                                closed_valid[token])
+            guess = numpy.where(valid, scores, -numpy.inf).argmax(axis=1)
+            # A state without valid move is final, as in spaCy
+            done[:count] |= ~valid.any(axis=1)
+            rows = numpy.flatnonzero(~done[:count])
+            move, label = classes.types[guess[rows]], classes.labels[guess[rows]]
+            tags[token[rows], 0] = numpy.select(
+                [move == BEGIN, move == UNIT, move == OUT], [3, 3, 2], 1)
+            tags[token[rows], 1] = numpy.where(move == OUT, 0, label)
+            opens = (move == BEGIN) | (move == UNIT)
+            if opens.any():
+                rows_opened = rows[opens]
+                entities[rows_opened] += 1
+                counted = entities[rows_opened] < lengths[rows_opened]
+                start[rows_opened] = numpy.where(counted, step, -1)
+                entity_label[rows_opened] = numpy.where(counted, label[opens], 0)
+            is_open[rows[move == BEGIN]] = True
+            # A blocked token (U-) opens and closes an entity even if one is open
+            is_open[rows[(move == LAST) | (move == UNIT)]] = False
+        return numpy.split(tags, numpy.cumsum([len(state) for state in states])[:-1])
+
+    def _entity_features(self, step: int, start: numpy.ndarray, is_open: numpy.ndarray,
+                         lengths: numpy.ndarray) -> Iterator[Tuple[int, numpy.ndarray]]:
+        """Features of the states at a step that depend on their last entity, as
+        set_context_tokens of spaCy: the feature and the token in each doc, -1 for none"""
+        if self.dims['features'] == 6:
+            yield 3, start
+            yield 4, numpy.where(start >= 1, start - 1, -1)
+            yield 5, numpy.where(start + 1 < lengths, start + 1, -1)
+        else:
+            ids = numpy.where(is_open, start, -1)
+            yield 1, ids
+            yield 2, numpy.where(ids == -1, -1, step - 1)
+
+
+def replace_ner(nlp: Language, quantize: bool = False) -> Language:
+    """Replace the NER component of a model with its NumPy engine.
+
+    Args:
+        nlp (Language): Model with a 'ner' component.
+        quantize (bool, optional): If True, store the weights of the engine as int8.
+            Defaults to False.
+
+    Raises:
+        ValueError: If the architecture of the component is not supported.
+
+    Returns:
+        Language: The model.
+    """
+    labels = nlp.get_pipe('entity_ruler').labels if 'entity_ruler' in nlp.pipe_names else ()
+    nlp.replace_pipe('ner', NumpyNER.from_spacy(nlp.get_pipe('ner'), quantize, labels))
+    return nlp
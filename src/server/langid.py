@@ -0,0 +1,137 @@
+"""
+AWS Nitro Test
+
+Language identification of the texts to process, to choose their NER model. A naive
+Bayes classifier over character trigrams, trained at import on the short sample texts
+below. It only tells Dutch from French, runs offline and takes well under a
+millisecond per text.
+"""
+import math
+import re
+
+from collections import Counter
+from typing import Dict, Iterator
+
+from common.config import LANGID_MAX_CHARACTERS
+
+# cSpell:disable #
+LANGUAGE_SAMPLES = {
+    'nl': """
+        De rechtbank van eerste aanleg heeft het volgende vonnis uitgesproken in de zaak
+        tussen de eisende partij en de verwerende partij. Gelet op het verzoekschrift dat
+        werd neergelegd ter griffie en op de conclusies van de partijen, verklaart de
+        rechtbank de vordering ontvankelijk maar ongegrond. Het beroep wordt afgewezen en
+        de kosten worden ten laste gelegd van de eisende partij. De werkgever moet de
+        sociale bijdragen betalen aan de Rijksdienst voor Sociale Zekerheid binnen de
+        wettelijke termijn. Het rijksregisternummer van de werknemer staat vermeld op de
+        aangifte. De vennootschap is ingeschreven in de Kruispuntbank van Ondernemingen
+        onder het ondernemingsnummer en heeft haar maatschappelijke zetel in het
+        arrondissement. Dit doet inderdaad vermoeden dat de vennootschap werd gebruikt om
+        kosten door te sluizen van de andere firma's van de overleden echtgenoot van
+        mevrouw. Meester advocaat verschijnt voor de heer en voor de naamloze
+        vennootschap. De zaak werd behandeld op de openbare terechtzitting en in beraad
+        genomen. Uit de stukken van het dossier blijkt dat de betrokkene gedurende het
+        hele jaar werkloos was en een uitkering ontving van de uitbetalingsinstelling.
+        Wij hebben een brief gestuurd naar het adres van de onderneming, maar wij hebben
+        nog geen antwoord ontvangen. Gelieve ons de ontbrekende documenten zo snel mogelijk
+        te bezorgen. Met vriendelijke groeten. Het bedrag van de schuld wordt vermeerderd
+        met de verwijlintresten tegen de wettelijke rentevoet vanaf de dag van de
+        dagvaarding tot de dag van de volledige betaling. Zij woont sinds twee jaar in de
+        gemeente en werkt als zelfstandige in bijberoep. Hij is niet verschenen en werd
+        ook niet vertegenwoordigd, zodat het vonnis bij verstek wordt uitgesproken.
+        Gedaan te Hasselt op maandag, dinsdag, woensdag, donderdag en vrijdag in januari,
+        februari, maart, april, mei, juni, juli, augustus, september, oktober, november en
+        december. Telefoon, gsm en e-mail van het kantoor in de Kerkstraat, de
+        Stationsstraat, de Koning Boudewijnlaan, de Molenweg en op het Dorpsplein.
+        """,
+    'fr': """
+        Le tribunal de première instance a rendu le jugement suivant dans la cause entre
+        la partie demanderesse et la partie défenderesse. Vu la requête déposée au greffe
+        et les conclusions des parties, le tribunal déclare la demande recevable mais non
+        fondée. Le recours est rejeté et les dépens sont mis à charge de la partie
+        demanderesse. L'employeur doit payer les cotisations sociales à l'Office national
+        de sécurité sociale dans le délai légal. Le numéro de registre national du
+        travailleur figure sur la déclaration. La société est inscrite à la Banque-Carrefour
+        des Entreprises sous le numéro d'entreprise et son siège social est situé dans
+        l'arrondissement. Ceci laisse en effet supposer que la société a été utilisée pour
+        faire transiter des frais des autres sociétés de l'époux décédé de madame.
+        Maître, avocat, comparaît pour monsieur et pour la société anonyme. La cause a été
+        entendue en audience publique et prise en délibéré. Il ressort des pièces du dossier
+        que l'intéressé était au chômage pendant toute l'année et qu'il percevait des
+        allocations de l'organisme de paiement. Nous avons envoyé une lettre à l'adresse de
+        l'entreprise, mais nous n'avons pas encore reçu de réponse. Veuillez nous faire
+        parvenir les documents manquants dans les plus brefs délais. Veuillez agréer nos
+        salutations distinguées. Le montant de la dette est majoré des intérêts de retard
+        au taux légal à partir du jour de la citation jusqu'au jour du paiement complet.
+        Elle habite depuis deux ans dans la commune et travaille comme indépendante à titre
+        complémentaire. Il n'a pas comparu et n'était pas représenté, de sorte que le
+        jugement est rendu par défaut. Fait à Liège le lundi, mardi, mercredi, jeudi et
+        vendredi en janvier, février, mars, avril, mai, juin, juillet, août, septembre,
+        octobre, novembre et décembre. Téléphone, tél., gsm et courriel du bureau à la rue
+        de la Station, avenue Louise, chemin de la Terre et place du Marché.
+        """
+}
+# cSpell:enable #
+
+WORD = re.compile(r'[^\W\d_]+')
+
+
+def trigrams(text: str, max_characters: int = 0) -> Iterator[str]:
+    """Character trigrams of the words of a text, lowercased and padded with spaces.
+
+    Args:
+        text (str): Text.
+        max_characters (int, optional): Only the first characters of the text are used,
+            all of them if 0.
+    """
+    if max_characters:
+        text = text[:max_characters]
+    for word in WORD.findall(text.lower()):
+        padded = f' {word} '
+        for index in range(len(padded) - 2):
+            yield padded[index:index + 3]
+
+
+class LanguageIdentifier():
+    """Naive Bayes classifier over character trigrams.
+
+    Args:
+        samples (Dict[str, str], optional): Sample text of each language.
+            Defaults to LANGUAGE_SAMPLES.
+        smoothing (float, optional): Additive smoothing of the trigram counts.
+            Defaults to 0.5.
+    """
+    def __init__(self, samples: Dict[str, str] = None, smoothing: float = 0.5):
+        counts = {language: Counter(trigrams(text))
+                  for language, text in (samples or LANGUAGE_SAMPLES).items()}
+        vocabulary = set().union(*counts.values())
+        self.languages = list(counts)
+        self._log_probabilities = {}
+        self._unseen = {}
+        for language, language_counts in counts.items():
+            total = sum(language_counts.values()) + smoothing * (len(vocabulary) + 1)
+            self._log_probabilities[language] = {
+                trigram: math.log((count + smoothing) / total)
+                for trigram, count in language_counts.items()}
+            self._unseen[language] = math.log(smoothing / total)
+
+    def scores(self, text: str, max_characters: int = LANGID_MAX_CHARACTERS) -> Dict[str, float]:
+        """Log-likelihood of a text in each language, from its first max_characters."""
+        counts = Counter(trigrams(text, max_characters))
+        scores = {}
+        for language in self.languages:
+            log_probabilities = self._log_probabilities[language]
+            unseen = self._unseen[language]
+            scores[language] = sum(count * log_probabilities.get(trigram, unseen)
+                                   for trigram, count in counts.items())
+        return scores
+
+    def detect(self, text: str, default: str = '') -> str:
+        """Return the most likely language of a text, or default if it has no words."""
+        scores = self.scores(text)
+        if not any(scores.values()):
+            return default
+        return max(scores, key=scores.get)
+
+
+IDENTIFIER = LanguageIdentifier()
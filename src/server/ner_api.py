@@ -4,19 +4,40 @@ Created on Fri May 13 13:17:30 2022
 
 @author: kaf
 """
+import ctypes
+import gc
+import json
 import re
 import os
+import threading
+import time
 
-from typing import List, Dict, Any
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import List, Dict, Any, Iterator, NamedTuple
 from enum import Enum
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 import spacy
+from spacy.language import Language
 from spacy.tokens import Doc, Span
 from spacy import displacy
 
+from common.config import MAX_TEXTS, MAX_TEXT_CHARACTERS, LANGUAGE_MODELS, NER_PREFILTER, \
+    NER_BATCH_TOKENS, NER_CHARACTERS_PER_TOKEN, MODEL_MAX_NEW_STRINGS, MODEL_VERSIONS, \
+    MODEL_BUNDLES, NER_ENGINE, NER_ENGINE_INT8, CONTENT_1, CONTENT_2, CONTENT_3
+from common.limits import LimitExceeded
+from common.log import get_logger, StageTimer
+from common.metrics import counter, gauge
+from server.bundle import BUNDLE_SUFFIX, load_bundle
+from server.checksum import mod97_valid, mod97_valid_scalar
+from server.engine import replace_ner
+from server.langid import IDENTIFIER
+from server.prefilter import PreFilter
+
+logger = get_logger('ner_api')
 
 class ModelName(str, Enum):
     """Enum of the available models. This allows the API to raise a more specific
@@ -24,27 +45,109 @@ class ModelName(str, Enum):
     """
     ner_french = r"socsec_ner_fr"  # pylint: disable=invalid-name
     ner_dutch = r"socsec_ner_nl"  # pylint: disable=invalid-name
+    # Model of each text chosen from its language (see server/langid.py)
+    auto = r"auto"  # pylint: disable=invalid-name
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__), 'models'))
 
 # TODO: Move following in __init__ of ModelName
-print(__location__)
+logger.info('Loading models', location=__location__)
 DEFAULT_MODEL = ModelName.ner_dutch
-MODEL_NAMES = [model.value for model in ModelName]
-MODELS = {name: spacy.load(os.path.join(__location__, name)) for name in MODEL_NAMES}
+MODEL_NAMES = [model.value for model in ModelName if model != ModelName.auto]
+
+# Version of the model in server/models/<name>. The other versions shipped in the
+# image are in server/models/<name>@<version>.
+DEFAULT_VERSION = 'default'
+
+def model_path(name: str, version: str = DEFAULT_VERSION) -> str:
+    """Get the directory of a version of a model"""
+    return os.path.join(__location__, name if version == DEFAULT_VERSION else f'{name}@{version}')
+
+def model_versions(name: str) -> List[str]:
+    """List the versions of a model shipped in the models directory, as directory or bundle"""
+    prefix = f'{name}@'
+    entries = (entry[:-len(BUNDLE_SUFFIX)] if entry.endswith(BUNDLE_SUFFIX) else entry
+               for entry in os.listdir(__location__))
+    return [DEFAULT_VERSION] + sorted({entry[len(prefix):] for entry in entries
+                                       if entry.startswith(prefix)})
+
+def load_model(name: str, version: str = DEFAULT_VERSION) -> Language:
+    """Load a version of a model from the models directory, from its bundle if it has one
+    and MODEL_BUNDLES is set (see server/bundle.py), with the NER engine of NER_ENGINE"""
+    path = model_path(name, version)
+    if MODEL_BUNDLES and os.path.isfile(path + BUNDLE_SUFFIX):
+        nlp = load_bundle(path + BUNDLE_SUFFIX)
+    else:
+        nlp = spacy.load(path)
+    if NER_ENGINE == 'numpy':
+        replace_ner(nlp, NER_ENGINE_INT8)
+    return nlp
+
+# Version of each model in MODELS
+LOADED_VERSIONS = {name: MODEL_VERSIONS.get(name, DEFAULT_VERSION) for name in MODEL_NAMES}
+MODELS = {name: load_model(name, LOADED_VERSIONS[name]) for name in MODEL_NAMES}
+# Size of the StringStore of each model when it was loaded
+LOADED_STRINGS = {name: len(nlp.vocab.strings) for name, nlp in MODELS.items()}
 
-print(f"Loaded {len(MODEL_NAMES)} models: {MODEL_NAMES}")
+logger.info('Loaded models', count=len(MODEL_NAMES), models=MODEL_NAMES)
 
 class Text(BaseModel):
     """Schema for a single text in a batch of texts to process
     """
     content: str
 
+class OutputFormat(str, Enum):
+    """Enum of the formats of the response. The compact format is described
+    in common/compact.py.
+    """
+    full = 'full'  # pylint: disable=invalid-name
+    compact = 'compact'  # pylint: disable=invalid-name
+
 class InputModel(BaseModel):
     """Schema for the text to process
     """
     texts: List[Text]
     model: ModelName = DEFAULT_MODEL
+    output: OutputFormat = OutputFormat.full
+    # If False, the processed texts are not echoed back in the compact format
+    echo_text: bool = True
+    # If False, the displaCy page of the texts is not rendered and html is empty
+    html: bool = True
+
+class Query(NamedTuple):
+    """Query of the process action, decoded without building the pydantic models"""
+    texts: List[str]
+    model: ModelName
+    output: OutputFormat
+    echo_text: bool
+    html: bool
+
+def parse_query(data: Any, max_texts: int = MAX_TEXTS,
+                max_characters: int = MAX_TEXT_CHARACTERS) -> Query:
+    """Decode the parameter of a process action, either a JSON document or the
+    equivalent CBOR map, into the list of texts given to nlp.pipe and the options
+    of InputModel.
+
+    Raises:
+        ValueError: If the query is not valid.
+        LimitExceeded: If the query has more than max_texts texts or a text
+            longer than max_characters.
+    """
+    if isinstance(data, (str, bytes)):
+        data = json.loads(data)
+    try:
+        if len(data['texts']) > max_texts:
+            raise LimitExceeded('texts', f'More than {max_texts} texts')
+        texts = [text['content'] for text in data['texts']]
+    except (KeyError, TypeError) as error:
+        raise ValueError(f'Invalid texts: {error}') from error
+    if not all(isinstance(text, str) for text in texts):
+        raise ValueError('Invalid texts: content must be a string')
+    if any(len(text) > max_characters for text in texts):
+        raise LimitExceeded('characters', f'Text longer than {max_characters} characters')
+    return Query(texts, ModelName(data.get('model', DEFAULT_MODEL)),
+                 OutputFormat(data.get('output', OutputFormat.full)),
+                 bool(data.get('echo_text', True)), bool(data.get('html', True)))
 
 class Entity(BaseModel):
     """Schema for a single entity
@@ -70,14 +173,20 @@ class ResponseModel(BaseModel):
 
 # Disambiguate entity "PERSON": actual person or company?
 # Check for person title and company legal form abbreviation
+# cSpell:disable #
+PERSON_TITLES = ["mr", "mr.", "monsieur", "messieurs", "m", "m.",
+                 "madame", "mme", "mmes", "mesdames", "me", "maître", "meester"
+                 "mevrouw", "meneer", "mevr.", "mw.", "heer", "heren", "dhr.", "dr." ]
+LEGAL_FORMS = ["bvba", "b.v.b.a.", "sprl", "s.p.r.l.", "sa", "s.a.",
+               "nv", "n.v.", "asbl", "a.s.b.l.", "vzw", "v.z.w.", 
+               "srl", "s.r.l.", "sprlu", "s.p.r.l.u.", "bv", "b.v."]
+# cSpell:enable #
+
 def get_person_title(span: Span) -> Any:
     """Check for a person title in the extracted entity 
     or in the previous token.
     """
-    # cSpell:disable #
-    title_list = ["mr", "mr.", "monsieur", "messieurs", "m", "m.",
-                  "madame", "mme", "mmes", "mesdames", "me", "maître", "meester"
-                  "mevrouw", "meneer", "mevr.", "mw.", "heer", "heren", "dhr.", "dr." ]
+    title_list = PERSON_TITLES
     person_title = ""
     if span.label_ == "PERSON":
         # Check if the person title is in the entity span
@@ -96,9 +205,7 @@ def get_legal_form(span: Span) -> Any:
     """Check for a company legal form abbreviation in the extracted entity
     or in the vicinity of the entity.
     """
-    legal_form_list = ["bvba", "b.v.b.a.", "sprl", "s.p.r.l.", "sa", "s.a.",
-                       "nv", "n.v.", "asbl", "a.s.b.l.", "vzw", "v.z.w.", 
-                       "srl", "s.r.l.", "sprlu", "s.p.r.l.u.", "bv", "b.v."]
+    legal_form_list = LEGAL_FORMS
     company_legal_form = ""
     if span.label_ == "PERSON":
         # Check if the legal form is in the entity span
@@ -117,16 +224,51 @@ def get_legal_form(span: Span) -> Any:
 
 Span.set_extension("company_legal_form", getter=get_legal_form, force=True)
 
+# Pre-screening of the texts of each model (see server/prefilter.py)
+PREFILTERS = {ModelName(name): PreFilter(PERSON_TITLES + LEGAL_FORMS, nlp.Defaults.stop_words)
+              for name, nlp in MODELS.items()}
+SKIPPED = counter('nitro_enclave_prefiltered_texts_total',
+                  'Texts without candidate entities, not given to the NER model', ('model',))
+
 # Format the entities
 def extract_digits(string: str):
     """Extract digits from a string (KBO, NISS, ...)"""
     num = re.sub(r'\D', '', string)
     return str(num)
 
+# Entities whose digits are validated with a checksum
+CHECKSUM_LABELS = ('KBO', 'NISS')
+
+# Digits and checksum validity of the KBO and NISS entities of a document,
+# keyed by (start, end) token offsets. Set by validate_checksums.
+Doc.set_extension("entity_checksums", default=None, force=True)
+
+def validate_checksums(docs: List[Doc]) -> None:
+    """Batch validation stage: extract the digits of every KBO and NISS entity of a
+    batch of documents once, check all their checksums at once and cache the results
+    in the documents for the is_valid_entity getter and format_entity."""
+    candidates = []
+    for doc in docs:
+        doc._.entity_checksums = {}
+        candidates.extend(ent for ent in doc.ents if ent.label_ in CHECKSUM_LABELS)
+    if not candidates:
+        return
+    numbers = [extract_digits(ent.text) for ent in candidates]
+    valid = mod97_valid(numbers, [ent.label_ == 'NISS' for ent in candidates])
+    for ent, number, is_valid in zip(candidates, numbers, valid.tolist()):
+        ent.doc._.entity_checksums[(ent.start, ent.end)] = (number, is_valid)
+
+def cached_checksum(span: Span):
+    """Return the (digits, validity) of a KBO or NISS entity computed by
+    validate_checksums or None if the stage did not run on its document."""
+    checksums = span.doc._.entity_checksums
+    return checksums.get((span.start, span.end)) if checksums is not None else None
+
 def format_entity(span: Span):
     """Format entities"""
-    if span.label_ in ['KBO', 'NISS']:
-        return extract_digits(span.text)
+    if span.label_ in CHECKSUM_LABELS:
+        cached = cached_checksum(span)
+        return cached[0] if cached else extract_digits(span.text)
     else:
         return span.text
 
@@ -146,35 +288,22 @@ def validate_zipcode(span: Span):
 
 def valide_kbo(span: Span):
     """KBO and NISS validation, verify the checksum."""
-    num = re.sub(r'[^\d]', '', span.text)
-    check_digits = int(num[-2:])
-    checksum = 97 - int(num[:-2])%97
-    if checksum == check_digits:
-        return True
-    else:
-        return False
+    return mod97_valid_scalar(extract_digits(span.text), niss=False)
 
 def valide_niss(span: Span):
-    """NISS validation, verify the checksum."""
-    num = re.sub(r'\D', '', span.text)
-    check_digits = int(num[-2:])
-    # checksum for people before the year 2000
-    checksum = 97 - int(num[:-2])%97
-    if checksum == check_digits:
-        return True
-    else:
-        #checksum for people born after the year 2000
-        checksum = 97 - int("2" + num[:-2])%97
-        return checksum == check_digits
+    """NISS validation, verify the checksum for people born before
+    and after the year 2000."""
+    return mod97_valid_scalar(extract_digits(span.text), niss=True)
 
 def validate_entity(span: Span):
     """Validate entities."""
     if span.label_ == "ZIP_CODE":
         return validate_zipcode(span)
-    elif span.label_ in ['KBO']:
-        return valide_kbo(span)
-    elif span.label_ in ['NISS']:
-        return valide_niss(span)
+    elif span.label_ in CHECKSUM_LABELS:
+        cached = cached_checksum(span)
+        if cached:
+            return cached[1]
+        return valide_kbo(span) if span.label_ == 'KBO' else valide_niss(span)
     elif span.label_ == "REF":
         # Not used
         return False
@@ -184,8 +313,10 @@ def validate_entity(span: Span):
 Span.set_extension("is_valid_entity", getter=validate_entity, force=True)
 
 # Get data
-def get_data(doc: Doc) -> Dict[str, Any]:
-    """Extract the data to return from the REST API given a Doc object."""
+def get_data(doc: Doc, timer: StageTimer = None, render_html: bool = True) -> Dict[str, Any]:
+    """Extract the data to return from the REST API given a Doc object.
+    If a timer is given, the displaCy rendering is timed as its own stage.
+    If render_html is False, the displaCy rendering is skipped and html is empty."""
     entities = [
         {
             "text": format_entity(ent),
@@ -198,13 +329,247 @@ def get_data(doc: Doc) -> Dict[str, Any]:
         for ent in doc.ents if ent._.is_valid_entity
     ]
     # Generate a html file for entities visualisation
-    if len(entities) > 0:
-        html = displacy.render(doc, style="ent", jupyter=False, page=True)
+    if len(entities) > 0 and render_html:
+        with timer.stage('displacy') if timer else nullcontext():
+            html = displacy.render(doc, style="ent", jupyter=False, page=True)
     else:
-        print("No entities extracted")
+        if not entities:
+            logger.debug('No entities extracted')
         html = ""
     return {"text": doc.text, "entities": entities, "html": html}
 
+def detect_models(texts: List[str]) -> Dict[ModelName, List[int]]:
+    """Choose the model of each text from its language.
+
+    Args:
+        texts (List[str]): Texts to process.
+
+    Returns:
+        Dict[ModelName, List[int]]: Indexes of the texts of each model, in order.
+            Texts without words go to DEFAULT_MODEL.
+    """
+    groups = {}
+    default = next(language for language, model in LANGUAGE_MODELS.items()
+                   if model == DEFAULT_MODEL.value)
+    for index, text in enumerate(texts):
+        model = ModelName(LANGUAGE_MODELS[IDENTIFIER.detect(text, default)])
+        groups.setdefault(model, []).append(index)
+    return groups
+
+try:
+    LIBC = ctypes.CDLL('libc.so.6')
+except OSError:
+    LIBC = None
+
+# Sample texts run through a model before it replaces the current one, by language
+WARM_UP_TEXTS = {'nl': [CONTENT_1, CONTENT_2], 'fr': [CONTENT_3]}
+
+# Number of requests in progress by id of model copy
+_IN_USE = Counter()
+_IN_USE_CONDITION = threading.Condition()
+
+@contextmanager
+def using_model(name: str) -> Iterator[Language]:
+    """Get the current copy of a model and count the request as using it until
+    the end of the block"""
+    with _IN_USE_CONDITION:
+        nlp = MODELS[name]
+        _IN_USE[id(nlp)] += 1
+    try:
+        yield nlp
+    finally:
+        with _IN_USE_CONDITION:
+            _IN_USE[id(nlp)] -= 1
+            if not _IN_USE[id(nlp)]:
+                del _IN_USE[id(nlp)]
+                _IN_USE_CONDITION.notify_all()
+
+# Models being reloaded in the background
+_RELOADING = set()
+_RELOADING_LOCK = threading.Lock()
+VOCABULARY = gauge('nitro_enclave_vocabulary_size',
+                   'Entries of the vocabulary of each model (strings and lexemes)',
+                   ('model', 'table'))
+RELOADS = counter('nitro_enclave_model_reloads_total', 'Models replaced by a fresh copy',
+                  ('model', 'reason'))
+
+def check_vocabulary(name: str) -> None:
+    """Record the size of the vocabulary of a model and reload a fresh copy of the
+    model if its StringStore has grown by more than MODEL_MAX_NEW_STRINGS strings
+    since it was loaded. Every unseen token of the processed texts (names, KBO and
+    NISS numbers...) is added to the vocabulary, which never shrinks.
+
+    Args:
+        name (str): Name of the model.
+    """
+    nlp = MODELS[name]
+    strings = len(nlp.vocab.strings)
+    VOCABULARY.set(strings, model=name, table='strings')
+    VOCABULARY.set(len(nlp.vocab), model=name, table='lexemes')
+    if MODEL_MAX_NEW_STRINGS and strings - LOADED_STRINGS[name] > MODEL_MAX_NEW_STRINGS:
+        reload_model(name, 'vocabulary')
+
+def reload_model(name: str, reason: str, version: str = '') -> bool:
+    """Load a fresh copy of a model in the background, warm it up and swap it into
+    MODELS. Requests in progress finish with the previous copy, which is freed once
+    they are done. The model keeps serving requests during the reload.
+
+    Args:
+        name (str): Name of the model.
+        reason (str): Reason of the reload, for the logs and metrics.
+        version (str, optional): Version of the model to load. Defaults to '', the
+            version currently loaded.
+
+    Returns:
+        bool: False if the model is already being reloaded.
+
+    Raises:
+        ValueError: If the model or its version does not exist.
+    """
+    if name not in MODELS:
+        raise ValueError(f'Unknown model {name}')
+    if version and version not in model_versions(name):
+        raise ValueError(f'Unknown version {version} of model {name}')
+    with _RELOADING_LOCK:
+        if name in _RELOADING:
+            return False
+        _RELOADING.add(name)
+    threading.Thread(target=_reload_model, args=(name, reason, version or LOADED_VERSIONS[name]),
+                     name=f'reload-{name}', daemon=True).start()
+    return True
+
+def _reload_model(name: str, reason: str, version: str) -> None:
+    """Load a model, warm it up, swap it into MODELS and free the previous copy once
+    the requests using it are done"""
+    try:
+        start = time.perf_counter()
+        nlp = load_model(name, version)
+        warm_up(nlp)
+        with _IN_USE_CONDITION:
+            # Each request uses the copy it found when it started
+            previous, MODELS[name] = MODELS[name], nlp
+            previous_version, LOADED_VERSIONS[name] = LOADED_VERSIONS[name], version
+            strings = len(previous.vocab.strings)
+            LOADED_STRINGS[name] = len(nlp.vocab.strings)
+        RELOADS.inc(model=name, reason=reason)
+        logger.info('Model reloaded', model=name, reason=reason, version=version,
+                    previous_version=previous_version, strings=strings,
+                    seconds=round(time.perf_counter() - start, 3))
+        with _IN_USE_CONDITION:
+            _IN_USE_CONDITION.wait_for(lambda: not _IN_USE[id(previous)])
+        # The pipeline components of a model reference each other: the copy is only
+        # freed by the cyclic garbage collector
+        del previous
+        gc.collect()
+        if LIBC is not None:
+            # Give the freed heap back to the system
+            LIBC.malloc_trim(0)
+        logger.info('Previous model freed', model=name, version=previous_version)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Cannot reload model', model=name, version=version)
+    finally:
+        with _RELOADING_LOCK:
+            _RELOADING.discard(name)
+
+def warm_up(nlp: Language) -> None:
+    """Touch the vector table of a model and run sample texts through it before it
+    serves requests, so that the first requests do not pay for its page faults and
+    lazy initialisations"""
+    vectors = nlp.vocab.vectors.data
+    if vectors.size:
+        # Read every page of the table
+        float(vectors.sum())
+    docs = list(nlp.pipe(WARM_UP_TEXTS.get(nlp.lang, WARM_UP_TEXTS['nl'])))
+    validate_checksums(docs)
+    for doc in docs:
+        get_data(doc)
+
+def model_status() -> Dict[str, dict]:
+    """Return the loaded and available versions of each model"""
+    with _RELOADING_LOCK:
+        reloading = set(_RELOADING)
+    return {name: {'version': LOADED_VERSIONS[name], 'versions': model_versions(name),
+                   'reloading': name in reloading,
+                   'strings': len(MODELS[name].vocab.strings)} for name in MODEL_NAMES}
+
+def token_batches(texts: List[str], budget: int = NER_BATCH_TOKENS,
+                  characters_per_token: float = NER_CHARACTERS_PER_TOKEN) -> List[List[int]]:
+    """Group texts into batches for nlp.pipe by increasing length, each of at most
+    budget estimated tokens. A text longer than the budget is a batch on its own.
+
+    Args:
+        texts (List[str]): Texts to process.
+        budget (int, optional): Maximum number of tokens per batch, 0 for a single batch
+            in the original order. Defaults to NER_BATCH_TOKENS.
+        characters_per_token (float, optional): Average number of characters per token,
+            used to estimate the tokens of a text. Defaults to NER_CHARACTERS_PER_TOKEN.
+
+    Returns:
+        List[List[int]]: Indexes of the texts of each batch.
+    """
+    if not budget:
+        return [list(range(len(texts)))] if texts else []
+    batches, batch, tokens = [], [], 0
+    for index in sorted(range(len(texts)), key=lambda index: len(texts[index])):
+        estimate = int(len(texts[index]) / characters_per_token) + 1
+        if batch and tokens + estimate > budget:
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(index)
+        tokens += estimate
+    if batch:
+        batches.append(batch)
+    return batches
+
+def run_pipeline(model: ModelName, texts: List[str], timer: StageTimer = None,
+                 render_html: bool = True) -> List[Dict[str, Any]]:
+    """Extract the entities of texts with a model, validate their checksums and
+    format them with get_data. The texts go to nlp.pipe in token_batches and the
+    results are returned in the order of the texts."""
+    timer = timer or StageTimer()
+    with using_model(model.value) as nlp:
+        if NER_PREFILTER:
+            # Texts without candidate entities are only tokenized
+            with timer.stage('prefilter'):
+                candidates = [index for index, text in enumerate(texts)
+                              if PREFILTERS[model].has_candidates(text)]
+            SKIPPED.inc(len(texts) - len(candidates), model=model.value)
+        else:
+            candidates = list(range(len(texts)))
+        with timer.stage('batching'):
+            batches = token_batches([texts[index] for index in candidates])
+        with timer.stage('nlp_pipe'):
+            docs = [None] * len(texts)
+            for batch in batches:
+                batch = [candidates[index] for index in batch]
+                processed = nlp.pipe((texts[index] for index in batch), batch_size=len(batch))
+                for index, doc in zip(batch, processed):
+                    docs[index] = doc
+            if len(candidates) < len(texts):
+                docs = [nlp.make_doc(text) if doc is None else doc
+                        for doc, text in zip(docs, texts)]
+        with timer.stage('checksum'):
+            validate_checksums(docs)
+        with timer.stage('get_data'):
+            results = [get_data(doc, timer, render_html) for doc in docs]
+    check_vocabulary(model.value)
+    return results
+
+def process_query(query: Query, timer: StageTimer = None) -> List[Dict[str, Any]]:
+    """Run the pipeline of the model of a query on its texts. With the auto model,
+    the texts are grouped by model and the results returned in the order of the texts."""
+    if query.model != ModelName.auto:
+        return run_pipeline(query.model, query.texts, timer, query.html)
+    timer = timer or StageTimer()
+    with timer.stage('langid'):
+        groups = detect_models(query.texts)
+    results = [None] * len(query.texts)
+    for model, indexes in groups.items():
+        texts = [query.texts[index] for index in indexes]
+        for index, result in zip(indexes, run_pipeline(model, texts, timer, query.html)):
+            results[index] = result
+    return results
+
 # Set up the FastAPI app and define the endpoints
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"])
@@ -219,10 +584,8 @@ def process_texts(query: InputModel):
     """Process a batch of texts and return the entities predicted by the
     given model. Each record in the data should have a key "text".
     """
-    nlp = MODELS[query.model]
-    response_body = []
-    texts = (text.content for text in query.texts)
-    for doc in nlp.pipe(texts):
-        response_body.append(get_data(doc))
-    print(response_body)
+    texts = [text.content for text in query.texts]
+    response_body = process_query(Query(texts, query.model, query.output, query.echo_text,
+                                        query.html))
+    logger.debug('Processed texts', count=len(response_body))
     return {"result": response_body}
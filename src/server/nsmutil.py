@@ -9,12 +9,29 @@ https://github.com/donkersgoed/nitropepper-enclave-app
 https://github.com/donkersgoed/aws-nitro-enclaves-nsm-api
 """
 import base64
+import math
+import threading
+import time
+
 import Crypto
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 
-from common.config import RSA_PRIVATE_KEY, ATTESTATION
-import server.libnsm as libnsm  # pylint: disable=import-error
+from common.config import RSA_PRIVATE_KEY, ATTESTATION, ATTESTATION_CACHE_SECONDS, \
+    ATTESTATION_NONCE_RATE, ATTESTATION_NONCE_BURST, ATTESTATION_MAX_NONCE_BYTES
+from common.limits import LimitExceeded, RateLimiter
+from common.log import get_logger
+from common.metrics import counter
+try:
+    import server.libnsm as libnsm  # pylint: disable=import-error
+except ImportError:
+    # The NSM library is only built for the enclave image. It is not needed for simulation.
+    libnsm = None
+
+logger = get_logger('nsmutil')
+
+ATTESTATIONS = counter('nitro_enclave_attestations_total',
+                       'Attestation documents returned by the enclave', ('source',))
 
 
 class NSMUtil():
@@ -30,6 +47,8 @@ class NSMUtil():
             # key is present in a signed Enclave attestation
             self._rsa_key = RSA.import_key(RSA_PRIVATE_KEY)
         else:
+            if libnsm is None:
+                raise RuntimeError('The NSM library (server/libnsm) is not available.')
             # Initialize the Rust NSM Library
             self._nsm_fd = libnsm.nsm_lib_init() # pylint:disable=c-extension-no-member
             # Create a new random function `nsm_rand_func`, which
@@ -53,18 +72,64 @@ class NSMUtil():
         self._nonce = 'nonce'
         self._user_data = 'user_data'
 
-    def get_attestation_doc(self):
-        """Get the attestation document from /dev/nsm."""
+        # Attestation document served to the requests without nonce and its expiry
+        self._attestation_doc = b''
+        self._attestation_expiry = 0.0
+        self._attestation_lock = threading.Lock()
+        self._nonce_limiter = RateLimiter(ATTESTATION_NONCE_RATE, ATTESTATION_NONCE_BURST)
+
+    @property
+    def public_key(self) -> bytes:
+        """DER encoded RSA public key of the attestation document"""
+        return self._public_key
+
+    def get_attestation_doc(self, nonce: bytes = b'') -> bytes:
+        """Get an attestation document. Without nonce, the same document is served for
+        ATTESTATION_CACHE_SECONDS without calling the NSM. With a nonce, a new document
+        is generated for it, at most ATTESTATION_NONCE_RATE per second.
+
+        Args:
+            nonce (bytes, optional): Nonce of the client, included in the document.
+
+        Raises:
+            LimitExceeded: If the nonce is too large or too many documents with a
+                nonce were requested.
+
+        Returns:
+            bytes: COSE signed attestation document.
+        """
+        if nonce:
+            if len(nonce) > ATTESTATION_MAX_NONCE_BYTES:
+                raise LimitExceeded('bytes',
+                                    f'Nonce larger than {ATTESTATION_MAX_NONCE_BYTES} bytes')
+            if not self._nonce_limiter.acquire():
+                raise LimitExceeded('attestation', 'Too many attestation requests',
+                                    math.ceil(1 / ATTESTATION_NONCE_RATE))
+            ATTESTATIONS.inc(source='nonce')
+            return self._generate_attestation_doc(nonce)
+
+        # Only one thread refreshes the document, the others wait for it
+        with self._attestation_lock:
+            now = time.monotonic()
+            if now >= self._attestation_expiry:
+                self._attestation_doc = self._generate_attestation_doc(self._nonce)
+                self._attestation_expiry = now + ATTESTATION_CACHE_SECONDS
+                ATTESTATIONS.inc(source='refresh')
+                logger.debug('Attestation document refreshed')
+            else:
+                ATTESTATIONS.inc(source='cache')
+            return self._attestation_doc
+
+    def _generate_attestation_doc(self, nonce: bytes):
+        """Get a new attestation document from /dev/nsm."""
         if self._simulate:
-            # Use a pre-computed attestation
+            # Use a pre-computed attestation, which does not contain the nonce
             libnsm_att_doc_cose_signed = base64.b64decode(ATTESTATION)
         else:
-            # TODO: Update interface to be able to specify nonce
-            # See: https://github.com/donkersgoed/aws-nitro-enclaves-nsm-api/commit/112a450082d108bf466ca57e687beaaeff19db4a
             libnsm_att_doc_cose_signed = libnsm.nsm_get_attestation_doc_nonce_user_data( # pylint:disable=c-extension-no-member
                 self._nsm_fd,
-                self._nonce,
-                len(self._nonce),
+                nonce,
+                len(nonce),
                 self._user_data,
                 len(self._user_data),
                 self._public_key,
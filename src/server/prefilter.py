@@ -0,0 +1,68 @@
+"""
+AWS Nitro Test
+
+Cheap pre-screening of the texts to process. A text is only given to the NER
+pipeline if it contains a candidate entity cue: a digit (all the entity ruler
+patterns have one), an email or URL shape, a person title or company legal form, or
+a capitalized word that does not merely start a sentence. Titles and legal forms
+that are also common words (e.g., me, sa or m in French) are only cues when written
+with dots, in any case (M., m., s.a., sa.); otherwise they are ordinary words. The
+other texts cannot hold any entity of the entity ruler and very rarely one of the
+statistical model. benchmark/prefilter.py measures the entities missed against the
+full pipeline and the texts skipped per language.
+"""
+import re
+
+from typing import Iterable
+
+# Kinds of cues, in the order they are looked for
+SHAPE = 'shape'
+KEYWORD = 'keyword'
+CAPITALIZED = 'capitalized'
+# Digits, email and URL shapes
+SHAPES = re.compile(r'\d|@|://|www\.|\w\.[a-z]{2,}\b')
+# Words, with the optional preceding end of sentence. The inner dots of
+# abbreviations are kept, e.g., b.v.b.a
+WORD = re.compile(r'(?P<start>(?:^|[.!?\n])[\s"\'«“(]*)?'
+                  r'(?P<word>[^\W\d_]+(?:\.[^\W\d_]+)*)')
+
+
+class PreFilter():
+    """Tell whether a text may contain an entity.
+
+    Args:
+        keywords (Iterable[str]): Words announcing an entity, e.g., person titles and
+            company legal forms. Case and dots are ignored, except for the keywords that
+            are also stop words or a single letter: they must contain dots (s.a.) or be
+            followed by a dot (M., sa.), in any case.
+        stop_words (Iterable[str]): Lowercase words that are not cues when they are
+            capitalized at the start of a sentence. Elided forms (e.g., l') also match
+            the word without apostrophe.
+    """
+    def __init__(self, keywords: Iterable[str], stop_words: Iterable[str]):
+        self._stop_words = frozenset(word.rstrip("'’") for word in stop_words)
+        keywords = frozenset(keyword.replace('.', '').lower() for keyword in keywords)
+        # Keywords that are also common words of the language
+        self._ambiguous = frozenset(keyword for keyword in keywords
+                                    if keyword in self._stop_words or len(keyword) == 1)
+        self._keywords = keywords - self._ambiguous
+
+    def has_candidates(self, text: str) -> bool:
+        """Return True if the text contains a candidate entity cue"""
+        return bool(self.cue(text))
+
+    def cue(self, text: str) -> str:
+        """Return the kind of the first candidate entity cue of the text (SHAPE,
+        KEYWORD or CAPITALIZED), or '' if it has none"""
+        if SHAPES.search(text):
+            return SHAPE
+        for match in WORD.finditer(text):
+            word = match['word']
+            lower = word.replace('.', '').lower()
+            if lower in self._keywords:
+                return KEYWORD
+            if lower in self._ambiguous and ('.' in word or text.startswith('.', match.end())):
+                return KEYWORD
+            if word[0].isupper() and (match['start'] is None or lower not in self._stop_words):
+                return CAPITALIZED
+        return ''
@@ -0,0 +1,149 @@
+"""
+AWS Nitro Test
+
+On-demand profiling of the enclave server, where py-spy or a debugger cannot be
+attached. A background thread samples the stacks of every thread of the server
+(receivers, model workers, reloads) for a few seconds and aggregates them in the
+collapsed format of flame graphs: one line per distinct stack, from the thread name
+to the innermost frame separated by semicolons, followed by its number of samples.
+Optionally, the allocations made during the profile are traced with tracemalloc.
+The stacks and allocations only contain code locations, never data of the requests.
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from typing import Dict, List
+
+from common.config import PROFILING, PROFILE_MAX_SECONDS, PROFILE_INTERVAL, \
+    PROFILE_TOP_ALLOCATIONS
+from common.log import get_logger
+
+logger = get_logger('profiler')
+
+_LOCK = threading.Lock()
+# Last profile: running, parameters and result
+_PROFILE = {'running': False}
+
+
+def frame_name(code, paths: List[str]) -> str:
+    """Name of a frame in a collapsed stack: function (file:line of its definition),
+    the file relative to the longest of paths containing it"""
+    filename = code.co_filename
+    for path in paths:
+        if filename.startswith(path):
+            filename = filename[len(path):]
+            break
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+
+def sample_stacks(seconds: float, interval: float) -> Dict[str, int]:
+    """Sample the stacks of the other threads every interval seconds.
+
+    Args:
+        seconds (float): Duration of the profile.
+        interval (float): Seconds between two samples.
+
+    Returns:
+        Dict[str, int]: Number of samples by collapsed stack.
+    """
+    own = threading.get_ident()
+    paths = sorted((os.path.join(os.path.abspath(path), '') for path in sys.path),
+                   key=len, reverse=True)
+    # Frame names by code object, computed once
+    names = {}
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = frame_name(code, paths)
+                frames.append(name)
+                frame = frame.f_back
+            frames.append(threads.get(ident, str(ident)))
+            stacks[';'.join(reversed(frames))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def start_profile(seconds: float, memory: bool = False,
+                  interval: float = PROFILE_INTERVAL) -> bool:
+    """Start profiling the server in the background. The result is returned by
+    profile_status once done.
+
+    Args:
+        seconds (float): Duration of the profile, at most PROFILE_MAX_SECONDS.
+        memory (bool, optional): If True, also trace the allocations with tracemalloc,
+            which slows the server down during the profile. Defaults to False.
+        interval (float, optional): Seconds between two samples. Defaults to
+            PROFILE_INTERVAL.
+
+    Raises:
+        ValueError: If profiling is disabled or the duration or interval is invalid.
+
+    Returns:
+        bool: False if a profile is already running.
+    """
+    if not PROFILING:
+        raise ValueError('Profiling is disabled')
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise ValueError(f'The duration must be between 0 and {PROFILE_MAX_SECONDS} seconds')
+    if interval <= 0:
+        raise ValueError('The interval must be positive')
+    with _LOCK:
+        if _PROFILE['running']:
+            return False
+        _PROFILE.clear()
+        _PROFILE.update(running=True, seconds=seconds, memory=memory, interval=interval)
+    threading.Thread(target=_profile, args=(seconds, memory, interval), name='profiler',
+                     daemon=True).start()
+    return True
+
+
+def _profile(seconds: float, memory: bool, interval: float):
+    """Run a profile and store its result"""
+    logger.info('Profile started', seconds=seconds, memory=memory, interval=interval)
+    result = {}
+    # Do not stop the tracing started by someone else
+    trace = memory and not tracemalloc.is_tracing()
+    try:
+        if trace:
+            tracemalloc.start()
+        stacks = sample_stacks(seconds, interval)
+        result['samples'] = sum(stacks.values())
+        result['collapsed'] = '\n'.join(f'{stack} {count}' for stack, count
+                                        in sorted(stacks.items()))
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            result['traced_mib'] = current / 2 ** 20
+            result['peak_mib'] = peak / 2 ** 20
+            result['allocations'] = [
+                {'location': str(stat.traceback), 'size_kib': stat.size / 2 ** 10,
+                 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]]
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception('Cannot profile')
+        result['error'] = str(error)
+    finally:
+        if trace:
+            tracemalloc.stop()
+        with _LOCK:
+            _PROFILE.update(running=False, **result)
+    logger.info('Profile done', samples=result.get('samples', 0))
+
+
+def profile_status() -> dict:
+    """Return whether a profile is running, and the parameters and result of the last one"""
+    with _LOCK:
+        return dict(_PROFILE)
@@ -0,0 +1,277 @@
+"""
+AWS Nitro Test
+
+Scheduling of the requests received by the enclave server. Control-plane actions
+are handled as soon as they are received. Other requests are queued by priority
+class and deadline in the scheduler of their NER model, and run by the workers of
+that model, some of them reserved for interactive requests. Requests whose deadline
+has passed are dropped before running. The worker threads are shared between the
+models according to their traffic. Only threads move: every model stays loaded once
+in the process and is shared by all its threads.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from typing import Callable, Dict, Iterable
+
+from common.config import INFERENCE_WORKERS, INTERACTIVE_WORKERS, INTERACTIVE_MAX_BYTES, \
+    MODEL_WORKERS, MODEL_REBALANCE_INTERVAL, MODEL_MIN_WORKERS
+from common.limits import CONTROL, INTERACTIVE, BULK, PRIORITIES
+from common.log import get_logger
+
+logger = get_logger('scheduler')
+
+# Cheap actions that never wait behind inference
+CONTROL_ACTIONS = ('health', 'get-attestation', 'metrics', 'models', 'message', 'model-status',
+                   'reload-model', 'profile', 'profile-result')
+
+
+def request_priority(action: str, requested: str, size: int) -> str:
+    """Get the priority class of a request.
+
+    Args:
+        action (str): Action of the request.
+        requested (str): Priority class set by the client, if any.
+        size (int): Size of the encrypted parameter of the request.
+
+    Returns:
+        str: CONTROL for the control-plane actions. Otherwise, the requested class
+            if it is INTERACTIVE or BULK, or else a class based on the size.
+    """
+    if action in CONTROL_ACTIONS:
+        return CONTROL
+    if requested in (INTERACTIVE, BULK):
+        return requested
+    return INTERACTIVE if size <= INTERACTIVE_MAX_BYTES else BULK
+
+
+def request_deadline(budget: float, received: float) -> float:
+    """Convert the time budget of a request to a deadline on the monotonic clock.
+
+    Args:
+        budget (float): Seconds left to answer the request when it was sent, 0 if none.
+        received (float): Time at which the request was received (time.monotonic).
+
+    Returns:
+        float: Deadline of the request, infinite if it has none.
+    """
+    return received + budget if budget and budget > 0 else math.inf
+
+
+class Scheduler():
+    """Priority queue of requests served by a pool of worker threads.
+
+    Requests are run by priority class, then by earliest deadline, then in order
+    of arrival. Reserved workers only run interactive requests so that they do not
+    wait for the end of a bulk request already running. The number of the other
+    workers can be changed with resize.
+    """
+    def __init__(self, workers: int = INFERENCE_WORKERS,
+                 interactive_workers: int = INTERACTIVE_WORKERS, name: str = 'scheduler'):
+        self._heap = []
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._name = name
+        self._threads = itertools.count()
+        # Workers running any request, and those to stop once their request is done
+        self._workers = 0
+        self._retiring = 0
+        for index in range(interactive_workers):
+            threading.Thread(target=self._work, args=(PRIORITIES.index(INTERACTIVE) + 1,),
+                             name=f'{name}-interactive-{index}', daemon=True).start()
+        self.resize(workers)
+
+    def submit(self, priority: str, deadline: float, run: Callable[[], None],
+               expire: Callable[[], None]) -> None:
+        """Queue a request.
+
+        Args:
+            priority (str): Priority class of the request (INTERACTIVE or BULK).
+            deadline (float): Deadline of the request on the monotonic clock.
+            run (Callable[[], None]): Function processing the request.
+            expire (Callable[[], None]): Function called instead of run if the
+                deadline has passed.
+        """
+        if time.monotonic() >= deadline:
+            expire()
+            return
+        with self._condition:
+            heapq.heappush(self._heap, (PRIORITIES.index(priority), deadline,
+                                        next(self._sequence), run, expire))
+            self._condition.notify_all()
+
+    def queued(self) -> int:
+        """Return the number of requests waiting for a worker."""
+        with self._condition:
+            return len(self._heap)
+
+    def workers(self) -> int:
+        """Return the number of workers running any request."""
+        with self._condition:
+            return self._workers
+
+    def resize(self, workers: int):
+        """Set the number of workers running any request. Workers in excess stop
+        once their current request is done."""
+        with self._condition:
+            # Workers still to be stopped are kept rather than replaced
+            kept = min(self._retiring, max(workers - self._workers, 0))
+            self._retiring -= kept
+            self._workers += kept
+            for _ in range(workers - self._workers):
+                threading.Thread(target=self._work, args=(len(PRIORITIES), True),
+                                 name=f'{self._name}-{next(self._threads)}', daemon=True).start()
+            if workers < self._workers:
+                self._retiring += self._workers - workers
+            self._workers = workers
+            self._condition.notify_all()
+
+    def _work(self, ranks: int, resizable: bool = False):
+        """Run the queued requests whose priority class is among the first ranks"""
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: (resizable and self._retiring)
+                                         or (self._heap and self._heap[0][0] < ranks))
+                if resizable and self._retiring:
+                    self._retiring -= 1
+                    return
+                _, deadline, _, run, expire = heapq.heappop(self._heap)
+            try:
+                if time.monotonic() >= deadline:
+                    expire()
+                else:
+                    run()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot run request')
+
+
+def allocate_workers(demand: Dict[str, float], total: int, minimum: int) -> Dict[str, int]:
+    """Share workers between models in proportion to their demand.
+
+    Args:
+        demand (Dict[str, float]): Demand of each model (e.g., seconds of inference).
+        total (int): Number of workers to share.
+        minimum (int): Minimum number of workers of each model.
+
+    Returns:
+        Dict[str, int]: Number of workers of each model. Their sum is total, unless it
+            is lower than minimum workers for each model.
+    """
+    workers = dict.fromkeys(demand, minimum)
+    free = total - minimum * len(demand)
+    if free <= 0:
+        return workers
+    overall = sum(demand.values())
+    if overall <= 0:
+        # Equal shares without any demand
+        demand = dict.fromkeys(demand, 1.0)
+        overall = len(demand)
+    # Largest remainder method
+    shares = {model: free * value / overall for model, value in demand.items()}
+    for model, share in shares.items():
+        workers[model] += int(share)
+    left = total - sum(workers.values())
+    for model in sorted(shares, key=lambda model: shares[model] - int(shares[model]),
+                        reverse=True)[:left]:
+        workers[model] += 1
+    return workers
+
+
+class ModelPools():
+    """Scheduler of each NER model, so that the requests of a model never wait for
+    those of another one. Each model starts with its number of worker threads in
+    MODEL_WORKERS (INFERENCE_WORKERS if not set). Every interval seconds, the same
+    total number of threads is shared again between the models in proportion to
+    their recent inference time and queued requests. The threads of a model all use
+    its single copy in MODELS: rebalancing shifts compute between the models, it
+    neither loads nor unloads model copies and frees no memory.
+
+    Args:
+        models (Iterable[str]): Names of the models.
+        workers (Dict[str, int], optional): Initial number of workers of each model.
+            Defaults to MODEL_WORKERS.
+        interactive_workers (int, optional): Workers of each model reserved for the
+            interactive requests. Defaults to INTERACTIVE_WORKERS.
+        interval (float, optional): Seconds between two rebalancings, 0 to keep the
+            initial numbers of workers. Defaults to MODEL_REBALANCE_INTERVAL.
+        minimum (int, optional): Minimum number of workers of each model when
+            rebalancing. Defaults to MODEL_MIN_WORKERS.
+    """
+    def __init__(self, models: Iterable[str], workers: Dict[str, int] = MODEL_WORKERS,
+                 interactive_workers: int = INTERACTIVE_WORKERS,
+                 interval: float = MODEL_REBALANCE_INTERVAL, minimum: int = MODEL_MIN_WORKERS):
+        models = list(models)
+        initial = {model: workers.get(model, INFERENCE_WORKERS) for model in models}
+        self._total = sum(initial.values())
+        self._minimum = minimum
+        self._schedulers = {model: Scheduler(count, interactive_workers, name=model)
+                            for model, count in initial.items()}
+        self._lock = threading.Lock()
+        # Inference time and requests of each model since the last rebalancing
+        self._busy = dict.fromkeys(models, 0.0)
+        self._runs = dict.fromkeys(models, 0)
+        # Smoothed demand of each model
+        self._demand = dict.fromkeys(models, 0.0)
+        if interval:
+            threading.Thread(target=self._rebalance_every, args=(interval,),
+                             name='rebalance', daemon=True).start()
+
+    def submit(self, model: str, priority: str, deadline: float, run: Callable[[], None],
+               expire: Callable[[], None]) -> None:
+        """Queue a request in the scheduler of its model (see Scheduler.submit). Requests
+        without a known model go to the scheduler with the fewest queued requests."""
+        if model not in self._schedulers:
+            model = min(self._schedulers, key=lambda name: self._schedulers[name].queued())
+
+        def timed():
+            started = time.monotonic()
+            try:
+                run()
+            finally:
+                with self._lock:
+                    self._busy[model] += time.monotonic() - started
+                    self._runs[model] += 1
+
+        self._schedulers[model].submit(priority, deadline, timed, expire)
+
+    def queued(self) -> int:
+        """Return the number of requests waiting for a worker, all models included."""
+        return sum(scheduler.queued() for scheduler in self._schedulers.values())
+
+    def workers(self) -> Dict[str, int]:
+        """Return the number of workers of each model, not counting the reserved ones."""
+        return {model: scheduler.workers() for model, scheduler in self._schedulers.items()}
+
+    def rebalance(self) -> Dict[str, int]:
+        """Share the workers between the models from the traffic observed since the
+        last call, and return the new number of workers of each model."""
+        with self._lock:
+            busy, runs = self._busy, self._runs
+            self._busy = dict.fromkeys(busy, 0.0)
+            self._runs = dict.fromkeys(runs, 0)
+        for model, scheduler in self._schedulers.items():
+            # Queued requests are expected to take as long as the last ones
+            mean = busy[model] / runs[model] if runs[model] else 0.0
+            demand = busy[model] + scheduler.queued() * mean
+            self._demand[model] = (self._demand[model] + demand) / 2
+        if not any(self._demand.values()):
+            # Nothing observed yet, keep the initial numbers of workers
+            return self.workers()
+        workers = allocate_workers(self._demand, self._total, self._minimum)
+        if workers != self.workers():
+            logger.info('Rebalancing worker threads', **workers)
+            for model, count in workers.items():
+                self._schedulers[model].resize(count)
+        return workers
+
+    def _rebalance_every(self, interval: float):
+        """Rebalance the workers periodically"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.rebalance()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot rebalance workers')